@@ -0,0 +1,314 @@
+"""
+Benchmarks for Stages 2 to 4 on synthetic data at several scales of the demo data (see synthetic).
+
+Run from the CandidatesPython folder, eg
+python -m benchmarks.run_benchmarks --scales 1 10 100 --output benchmarks/results.json
+python -m benchmarks.run_benchmarks --scales 1 10 --compare benchmarks/results.json
+
+Each benchmark runs in a new process, so the peak resident memory (RSS) recorded is its own. For each one
+the seconds taken, the items handled a second, the p50 and p99 latency of its lookups and the peak RSS
+are saved to a JSON file, which can be compared with the file from an earlier commit.
+
+The lookups go to a stand-in for the Proteins API serving synthetic records, run in a separate process so
+that it does not share the GIL with the code being measured. A lookup's latency is the time to its
+response headers, including any retries.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import subprocess
+import multiprocessing
+from datetime import datetime
+import benchmarks.synthetic as synthetic
+import logging
+logger = logging.getLogger(__name__)
+
+stage2_benchmarks = ['stage2_interpro_index', 'stage2_interpro_xml', 'stage2_unirule']
+stage3_benchmarks = ['stage3_counts_threads', 'stage3_counts_asyncio']
+stage4_benchmarks = ['stage4_collect', 'stage4_consistency_python', 'stage4_consistency_numpy']
+all_benchmarks = stage2_benchmarks + stage3_benchmarks + stage4_benchmarks
+
+# A change in seconds of more than this fraction is reported when comparing results
+compare_threshold = 0.1
+
+
+# The files for one scale, made once and shared by its benchmarks
+def prepare_scale(work_dir, scale) -> dict:
+    import candidates.interpro as interpro
+    import candidates.interpro_index as interpro_index
+    import candidates.unirule as unirule
+    scale_dir = os.path.join(work_dir, '{0}x'.format(scale))
+    if os.path.isdir(scale_dir):
+        shutil.rmtree(scale_dir)
+    os.makedirs(scale_dir)
+    paths = {name: os.path.join(scale_dir, name) for name in
+             ['interpro.xml', 'unirule-urml-latest.xml', 'used_signatures.list', 'prelim_candidates.list',
+              'candidates_filtered.tsv', 'InterPro_index.bin']}
+    paths['dir'] = scale_dir
+    paths['entries'] = synthetic.scale_interpro_xml(paths['interpro.xml'], scale)
+    paths['rules'] = synthetic.scale_urml(paths['unirule-urml-latest.xml'], scale)
+
+    ipr_index = interpro_index.build_index(paths['interpro.xml'])
+    interpro_index.save_index(ipr_index, paths['InterPro_index.bin'])
+    unirule.collect_used_signatures(paths['unirule-urml-latest.xml'], paths['used_signatures.list'])
+    interpro.write_interpro_candidate_list(ipr_index.get_nochild_list(), ipr_index.get_member_map(),
+                                           paths['used_signatures.list'], paths['prelim_candidates.list'])
+    # The Stage 3 result, worked out from the synthetic counts so Stage 4 does not depend on a Stage 3 benchmark
+    recordings = synthetic.SyntheticRecordings()
+    outfile = open(paths['candidates_filtered.tsv'], 'w')
+    for line in open(paths['prelim_candidates.list']):
+        ipr = line.rstrip()
+        reviewed, unreviewed = recordings.get_count(ipr, True), recordings.get_count(ipr, False)
+        if reviewed >= 10 and unreviewed >= 100:
+            outfile.write('{0}\t{1}\t{2}\n'.format(ipr, reviewed, unreviewed))
+    outfile.close()
+    return paths
+
+
+# Serves synthetic records until the process is ended, putting the port it listens on in the queue
+def serve_standin(port_queue):
+    server = synthetic.SyntheticStandInServer(synthetic.templates_dir)
+    port_queue.put(server.server_port)
+    server.serve_forever()
+
+
+def start_standin():
+    context = multiprocessing.get_context('spawn')
+    port_queue = context.Queue()
+    process = context.Process(target=serve_standin, args=(port_queue,), daemon=True)
+    process.start()
+    port = port_queue.get(timeout=60)
+    return process, 'http://127.0.0.1:{0}{1}'.format(port, synthetic.standin.api_path)
+
+
+# Wraps the functions that make lookups so each one's latency is added to the list returned
+def record_latencies() -> list:
+    import candidates.utils as utils
+    import candidates.uniprot.async_counts as async_counts
+    latencies = []
+    limited_get = utils.limited_get
+    get_count = async_counts.get_count
+
+    def timed_limited_get(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return limited_get(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    async def timed_get_count(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await get_count(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    utils.limited_get = timed_limited_get
+    async_counts.get_count = timed_get_count
+    return latencies
+
+
+# Returns the number of items handled, timing only the part being measured into timer['seconds']
+def run_benchmark(name, paths, settings, timer) -> int:
+    import candidates.interpro_index as interpro_index
+    import candidates.unirule as unirule
+    import candidates.uniprot.count_candidate_hits as uniprotcounter
+    import candidates.uniprot.collect_candidates as collector
+    out_dir = os.path.join(paths['dir'], name)
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    if name == 'stage2_interpro_index':
+        ipr_index = interpro_index.load_index(paths['InterPro_index.bin'])
+        ipr_index.get_member_map()
+        ipr_index.get_nochild_list()
+        items = paths['entries']
+    elif name == 'stage2_interpro_xml':
+        interpro_index.build_index(paths['interpro.xml'])
+        items = paths['entries']
+    elif name == 'stage2_unirule':
+        unirule.collect_used_signatures(paths['unirule-urml-latest.xml'], os.path.join(out_dir, 'used.list'))
+        items = paths['rules']
+    elif name.startswith('stage3_counts'):
+        engine = name.split('_')[-1]
+        uniprotcounter.collect_counts(paths['prelim_candidates.list'], 10, 100,
+                                      os.path.join(out_dir, 'filtered.tsv'), engine)
+        items = len(open(paths['prelim_candidates.list']).read().split())
+    elif name == 'stage4_collect':
+        collector.collect_candidates_with_threads(paths['candidates_filtered.tsv'],
+                                                  os.path.join(out_dir, 'CandidateRules.tsv'),
+                                                  processes=settings['processes'])
+        items = len(open(paths['candidates_filtered.tsv']).readlines())
+    else:
+        # Only the consistency test is timed, on records made before the timer starts
+        recordings = synthetic.SyntheticRecordings()
+        analysis = collector.get_analysis_settings({'engine': name.split('_')[-1]})
+        families = []
+        for line in open(paths['candidates_filtered.tsv']):
+            terms = collector.new_terms(analysis)
+            records = collector.extract_records(recordings.get_records(line.split('\t')[0]), terms=terms)
+            families.append((collector.group_records_by_taxonomy(records), terms))
+        start = time.perf_counter()
+        for taxonomy_groups, terms in families:
+            collector.analyse_taxonomy_groups(taxonomy_groups, analysis, terms)
+        items = len(families)
+    timer['seconds'] = time.perf_counter() - start
+    return items
+
+
+# Peak RSS in MB of this process and the largest of its children. On Linux ru_maxrss keeps the peak of the
+# parent across fork and exec, so VmHWM, which starts again in a new process, is read instead where there is one.
+def get_peak_rss() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    rss_unit = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / rss_unit
+    if os.path.isfile('/proc/self/status'):
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                peak = int(line.split()[1]) / 1024
+    return max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / rss_unit)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# Runs in its own process and puts a dictionary of results, or of the error, in the queue
+def run_case(name, paths, settings, result_queue):
+    try:
+        import candidates.utils as utils
+        import candidates.rate_limit as rate_limit
+        logging.basicConfig(level=logging.WARNING)
+        utils.proteins_api_url = settings['url']
+        rate_limit.configure(**settings['rate_limit'])
+        latencies = record_latencies()
+        timer = {}
+        items = run_benchmark(name, paths, settings, timer)
+        result = {'seconds': round(timer['seconds'], 4),
+                  'items': items,
+                  'items_per_second': round(items / timer['seconds'], 2) if timer['seconds'] else None,
+                  'requests': len(latencies),
+                  'requests_per_second': round(len(latencies) / timer['seconds'], 2) if latencies else None,
+                  'latency_p50_ms': round(percentile(latencies, 0.5) * 1000, 3) if latencies else None,
+                  'latency_p99_ms': round(percentile(latencies, 0.99) * 1000, 3) if latencies else None,
+                  'peak_rss_mb': round(get_peak_rss(), 1)}
+    except Exception as e:
+        result = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+    result_queue.put(result)
+
+
+def run_in_process(name, paths, settings) -> dict:
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=run_case, args=(name, paths, settings, result_queue))
+    process.start()
+    result = result_queue.get()
+    process.join()
+    return result
+
+
+# The benchmarks that cannot run here, as their optional packages are not installed
+def get_unavailable() -> set:
+    import candidates.uniprot.async_counts as async_counts
+    import candidates.uniprot.numpy_consistency as numpy_consistency
+    unavailable = set()
+    if not async_counts.is_available():
+        unavailable.add('stage3_counts_asyncio')
+    if not numpy_consistency.is_available():
+        unavailable.add('stage4_consistency_numpy')
+    return unavailable
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(scales, names, work_dir, settings) -> dict:
+    unavailable = get_unavailable()
+    results = {'created': '{:%Y-%m-%d %H:%M:%S}'.format(datetime.now()),
+               'commit': get_commit(),
+               'python': platform.python_version(),
+               'cpu_count': os.cpu_count(),
+               'scales': {}}
+    standin_process, settings['url'] = start_standin()
+    try:
+        for scale in scales:
+            paths = prepare_scale(work_dir, scale)
+            scale_results = results['scales']['{0}x'.format(scale)] = {}
+            for name in names:
+                if name in unavailable:
+                    logger.warning('Skipping {0}, its optional packages are not installed'.format(name))
+                    continue
+                scale_results[name] = run_in_process(name, paths, settings)
+                logger.info('{0}x {1}: {2}'.format(scale, name, scale_results[name]))
+    finally:
+        standin_process.terminate()
+        standin_process.join()
+    return results
+
+
+# Returns lines comparing the seconds of each benchmark in both results
+def compare_results(baseline: dict, results: dict) -> list:
+    lines = ['{0:<8}{1:<28}{2:>12}{3:>12}{4:>9}'.format('scale', 'benchmark', 'before (s)', 'after (s)', 'ratio')]
+    for scale, scale_results in results['scales'].items():
+        for name, result in scale_results.items():
+            before = baseline.get('scales', {}).get(scale, {}).get(name, {}).get('seconds')
+            after = result.get('seconds')
+            if before is None or after is None:
+                continue
+            ratio = after / before if before else float('inf')
+            change = ''
+            if ratio > 1 + compare_threshold:
+                change = '  slower'
+            elif ratio < 1 - compare_threshold:
+                change = '  faster'
+            lines.append('{0:<8}{1:<28}{2:>12.3f}{3:>12.3f}{4:>9.2f}{5}'.format(scale, name, before, after,
+                                                                             ratio, change))
+    return lines
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog='benchmarks.run_benchmarks')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100], metavar='N',
+                        help='multiples of the demo data to run at (default 1 10 100)')
+    parser.add_argument('--benchmarks', nargs='+', choices=all_benchmarks, default=all_benchmarks, metavar='NAME',
+                        help='the benchmarks to run (default all): ' + ', '.join(all_benchmarks))
+    parser.add_argument('--output', default=os.path.join('benchmarks', 'results.json'), metavar='PATH',
+                        help='where to save the results (default benchmarks/results.json)')
+    parser.add_argument('--compare', metavar='PATH', help='results of an earlier run to compare with')
+    parser.add_argument('--work-dir', default=os.path.join('benchmarks', 'work'), metavar='DIR',
+                        help='where the synthetic data is written (default benchmarks/work)')
+    parser.add_argument('--processes', type=int, metavar='N',
+                        help='processes for parsing and analysing the Stage 4 records (default 0, in the fetching threads)')
+    parser.add_argument('--request-rate', type=float, default=100000, metavar='N',
+                        help='requests a second allowed by the rate limiter (default 100000, so no limit)')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(module)s:  %(message)s')
+    args = parse_arguments(sys.argv[1:])
+    # Start with as many requests in flight as the limiter allows, so the engines rather than the limiter are measured
+    settings = {'processes': args.processes,
+                'rate_limit': {'rate': args.request_rate, 'burst': int(args.request_rate),
+                               'initial_limit': 100, 'max_limit': 100}}
+    baseline = None
+    if args.compare:
+        baseline = json.load(open(args.compare))
+    benchmark_results = run_benchmarks(args.scales, args.benchmarks, args.work_dir, settings)
+    with open(args.output, 'w') as f:
+        json.dump(benchmark_results, f, indent=2)
+    logger.info('Results saved to {0}'.format(args.output))
+    if baseline is not None:
+        print('\n'.join(compare_results(baseline, benchmark_results)))
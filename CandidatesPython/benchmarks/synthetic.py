@@ -0,0 +1,123 @@
+"""
+Synthetic data for the benchmarks, made by scaling up the demo data in data/demo/input.
+
+scale_interpro_xml and scale_urml write copies of the demo files with every entry or rule repeated
+factor times. Each copy has its own InterPro ids and member signatures, eg IPR01000030 and PF00823_c1
+for the first copy of IPR000030 and PF00823, so a 10x file has ten times the candidates.
+
+SyntheticRecordings stands in for the recordings of candidates.standin. The counts and reviewed records
+of each InterPro id are made up when they are first asked for, from a seed and the id, so every run of a
+benchmark sees the same data without it being stored. The records are copies, with new accessions, of a
+few of the records in test/testdata/input, so the annotations of a family are mostly consistent.
+"""
+import os
+import re
+import json
+import random
+import candidates.standin as standin
+import logging
+logger = logging.getLogger(__name__)
+
+demo_input = os.sep.join(['data', 'demo', 'input'])
+templates_dir = os.sep.join(['test', 'testdata', 'input'])
+seed = 1
+
+interpro_id = re.compile(r'IPR(\d{6})')
+member_key = re.compile(r'dbkey="([^"]+)"')
+rule_signature = re.compile(r'(<field attribute="value">)([^<]+)(<)')
+rule_id = re.compile(r'(<rule id=")([^"]+)(")')
+
+
+# Returns the text before the first element, the elements and the text after the last one
+def split_elements(text, start_tag, end_tag):
+    start = text.index(start_tag)
+    end = text.rindex(end_tag) + len(end_tag) + 1
+    body = text[start:end]
+    elements = [element + end_tag + '\n' for element in body.split(end_tag + '\n') if element.strip()]
+    return text[:start], elements, text[end:]
+
+
+# The copy of an InterPro entry or rule, with every InterPro id and member signature changed
+def copy_ids(text, copy):
+    if copy == 0:
+        return text
+    text = interpro_id.sub(lambda m: 'IPR{0:02d}{1}'.format(copy, m.group(1)), text)
+    text = member_key.sub(lambda m: 'dbkey="{0}_c{1}"'.format(m.group(1), copy), text)
+    # InterPro ids used in rules have already been changed
+    text = rule_signature.sub(lambda m: m.group(0) if m.group(2).startswith('IPR') else
+                              '{0}{1}_c{2}{3}'.format(m.group(1), m.group(2), copy, m.group(3)), text)
+    return rule_id.sub(lambda m: '{0}{1}_c{2}{3}'.format(m.group(1), m.group(2), copy, m.group(3)), text)
+
+
+def scale_file(source_path, dest_path, factor, start_tag, end_tag, encoding):
+    text = open(source_path, encoding=encoding).read()
+    head, elements, tail = split_elements(text, start_tag, end_tag)
+    outfile = open(dest_path, 'w', encoding=encoding)
+    outfile.write(head)
+    for copy in range(factor):
+        for element in elements:
+            outfile.write(copy_ids(element, copy))
+    outfile.write(tail)
+    outfile.close()
+    logger.info('Wrote {0} copies of the {1} elements of {2} to {3}'.format(factor, len(elements),
+                                                                          source_path, dest_path))
+    return len(elements) * factor
+
+
+def scale_interpro_xml(dest_path, factor, source_path=os.path.join(demo_input, 'interpro.xml')) -> int:
+    return scale_file(source_path, dest_path, factor, '<interpro ', '</interpro>', 'ISO-8859-1')
+
+
+def scale_urml(dest_path, factor, source_path=os.path.join(demo_input, 'unirule-urml-latest.xml')) -> int:
+    return scale_file(source_path, dest_path, factor, '<rule ', '</rule>', 'utf-8')
+
+
+def load_templates(path=templates_dir) -> list:
+    templates = []
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.json'):
+            data = json.load(open(os.path.join(path, name)))
+            templates.extend(data if isinstance(data, list) else [data])
+    return templates
+
+
+class SyntheticRecordings(standin.Recordings):
+    def __init__(self, recordings_dir=templates_dir):
+        standin.Recordings.__init__(self, recordings_dir)
+        self.templates = load_templates(recordings_dir)
+        # Made up rather than read from counts.tsv
+        self.counts = {}
+
+    # About a third of the ids have 10 or more reviewed records, a few of them hundreds
+    def _make_counts(self, interpro):
+        rng = random.Random('{0}:{1}'.format(seed, interpro))
+        reviewed = min(int(rng.paretovariate(1.2) * 4), 500)
+        return reviewed, reviewed * rng.randint(5, 60)
+
+    def get_records(self, interpro):
+        with self._lock:
+            if interpro not in self._records:
+                reviewed = self._get_counts(interpro)[0]
+                rng = random.Random('{0}:{1}:records'.format(seed, interpro))
+                # Most of a family are copies of one record, the rest of a few others
+                family = [rng.choice(self.templates) for i in range(4)]
+                records = []
+                for i in range(reviewed):
+                    record = dict(family[0] if rng.random() < 0.9 else rng.choice(family))
+                    record['accession'] = 'S{0}{1:05d}'.format(interpro[3:], i)
+                    records.append(record)
+                self._records[interpro] = records
+            return self._records[interpro]
+
+    def _get_counts(self, interpro):
+        if interpro not in self.counts:
+            self.counts[interpro] = self._make_counts(interpro)
+        return self.counts[interpro]
+
+    def get_count(self, interpro, reviewed: bool) -> int:
+        with self._lock:
+            return self._get_counts(interpro)[0 if reviewed else 1]
+
+
+class SyntheticStandInServer(standin.StandInServer):
+    recordings_class = SyntheticRecordings
@@ -67,7 +67,8 @@ else
   printf "\nRunning with the parameter \'${run_type}\' from %s\n\n" "$DIR"
   if [ $get_data == true ]; then
     wget ftp://ftp.ebi.ac.uk/pub/databases/interpro/current/interpro.xml.gz -O data/main/input/interpro.xml.gz
-    gunzip data/main/input/interpro.xml.gz
+    # The xml is read compressed, so remove any unzipped copy of an earlier release
+    rm -f data/main/input/interpro.xml
     wget ftp://ftp.ebi.ac.uk/pub/contrib/UniProt/UniFIRE/rules/unirule-urml-latest.xml -O data/main/input/unirule-urml-latest.xml
   fi
   python -m candidates.candidates_main $run_type
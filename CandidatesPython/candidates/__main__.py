@@ -0,0 +1,4 @@
+import sys
+import candidates.cli as cli
+
+sys.exit(cli.main())
@@ -0,0 +1,320 @@
+"""
+A local cache of Proteins API responses, so a rerun does not download everything again.
+
+Each response is stored under a key made from a hash of the url and the request headers.
+The body is saved gzip compressed in <key>.gz, and the url, status, response headers and the
+time it was saved are kept alongside in <key>.json. Entries expire after a time to live, or
+when they were saved for a different UniProtKB release than the one the cache is set to.
+When the cache grows beyond its size budget the least recently used entries are removed.
+
+An entry is written to temporary files which then replace the body and, last, the details. The details
+keep the size and the gzip trailer (the CRC32 and length of the uncompressed body) of the body saved with
+them, so a body that does not match its details, as after a crash between the two, is not read.
+Temporary files left by writes that never finished are removed when the cache is opened.
+
+The cache is switched on for a run with enable(), after which utils.get_url_with_retry
+uses it for every lookup.
+"""
+import os
+import gzip
+import json
+import time
+import hashlib
+import threading
+import candidates.metrics as metrics
+import logging
+logger = logging.getLogger(__name__)
+
+default_max_bytes = 2 * 1024 ** 3
+default_ttl = 28 * 24 * 3600
+# Seconds since a temporary file was last written after which its write is taken to have been abandoned
+stale_tmp_age = 3600
+
+_active_cache = None
+
+
+class CachedResponse:
+    """
+    Holds a response read from the cache with the parts of the requests.Response interface used in this package
+    """
+    def __init__(self, url, status_code, headers, content):
+        # Imported here so that cache-stats does not load requests
+        from requests.structures import CaseInsensitiveDict
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.from_cache = True
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def raise_for_status(self):
+        if not self.ok:
+            import requests
+            raise requests.HTTPError('Cached response status {0} for {1}'.format(self.status_code, self.url),
+                                     response=self)
+
+
+class ResponseCache:
+    def __init__(self, cache_dir, max_bytes=default_max_bytes, ttl=default_ttl, release=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.release = release
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # key: [size in bytes, time last used]
+        self._index = {}
+        self._total_bytes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    # Scan the cache folder to find the size and last use of each stored entry,
+    # and remove the temporary files of writes that were abandoned
+    def _load_index(self):
+        now = time.time()
+        for subdir in os.scandir(self.cache_dir):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                key, extension = os.path.splitext(entry.name)
+                stat = entry.stat()
+                if extension == '.tmp' and now - stat.st_mtime > stale_tmp_age:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                if extension not in ('.gz', '.json'):
+                    continue
+                item = self._index.setdefault(key, [0, 0])
+                item[0] += stat.st_size
+                item[1] = max(item[1], stat.st_mtime)
+                self._total_bytes += stat.st_size
+        logger.info('Response cache in {0} holds {1} entries using {2:.1f} MB'.format(
+                                                        self.cache_dir, len(self._index), self._total_bytes / 1024 ** 2))
+
+    @staticmethod
+    def make_key(url, headers=None) -> str:
+        text = url
+        if headers:
+            text += '\n' + '\n'.join('{0}: {1}'.format(k.lower(), headers[k]) for k in sorted(headers))
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _paths(self, key):
+        folder = os.path.join(self.cache_dir, key[:2])
+        return os.path.join(folder, key + '.json'), os.path.join(folder, key + '.gz')
+
+    def _is_current(self, meta) -> bool:
+        if self.ttl is not None and time.time() - meta['created'] > self.ttl:
+            return False
+        if self.release is not None and meta.get('release') != self.release:
+            return False
+        return True
+
+    def _read_meta(self, key):
+        meta_path, body_path = self._paths(key)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not self._is_current(meta):
+            self.remove(key)
+            return None
+        return meta
+
+    # Returns the stored details and the open body file of a current entry, or (None, None)
+    def _open(self, key):
+        meta = self._read_meta(key)
+        body = None
+        if meta is not None:
+            try:
+                body = gzip.open(self._paths(key)[1], 'rb')
+                # Checked on the open file, so that the body cannot be replaced after it
+                if get_body_check(body.fileobj) != meta.get('body_check'):
+                    body.close()
+                    body = None
+            except OSError:
+                body = None
+        metrics.record_cache_lookup(body is not None)
+        with self._lock:
+            if body is None:
+                self.misses += 1
+                return None, None
+            self.hits += 1
+        self.touch(key)
+        return meta, body
+
+    def get(self, url, headers=None):
+        """
+        Returns a CachedResponse, or None if the url is not in the cache or the entry is out of date
+        """
+        meta, body = self._open(self.make_key(url, headers))
+        if body is None:
+            return None
+        try:
+            content = body.read()
+        except (OSError, EOFError):
+            return None
+        finally:
+            body.close()
+        return CachedResponse(meta['url'], meta['status'], meta['headers'], content)
+
+    def open_body(self, url, headers=None):
+        """
+        Returns the body of the cached response as a file object that decompresses as it is read,
+        or None if the url is not in the cache or the entry is out of date
+        """
+        return self._open(self.make_key(url, headers))[1]
+
+    def put(self, url, headers, status_code, response_headers, content: bytes) -> CachedResponse:
+        writer = self.start_put(url, headers, status_code, response_headers)
+        writer.write(content)
+        writer.commit()
+        return CachedResponse(url, status_code, response_headers, content)
+
+    def start_put(self, url, headers, status_code, response_headers):
+        """
+        Returns a CacheWriter to save a response body that arrives in parts
+        """
+        return CacheWriter(self, self.make_key(url, headers), {'url': url,
+                                                               'status': status_code,
+                                                               'headers': dict(response_headers),
+                                                               'release': self.release})
+
+    def put_response(self, url, headers, r) -> CachedResponse:
+        return self.put(url, headers, r.status_code, r.headers, r.content)
+
+    def touch(self, key):
+        meta_path, body_path = self._paths(key)
+        now = time.time()
+        try:
+            os.utime(body_path, (now, now))
+        except OSError:
+            pass
+        with self._lock:
+            if key in self._index:
+                self._index[key][1] = now
+
+    def remove(self, key):
+        for path in self._paths(key):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        with self._lock:
+            item = self._index.pop(key, None)
+            if item is not None:
+                self._total_bytes -= item[0]
+
+    def _record(self, key, size):
+        with self._lock:
+            old = self._index.get(key)
+            if old is not None:
+                self._total_bytes -= old[0]
+            self._index[key] = [size, time.time()]
+            self._total_bytes += size
+            over_budget = self._total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    # Remove the least recently used entries until the cache is back under 90% of its budget
+    def evict(self):
+        with self._lock:
+            target = self.max_bytes * 0.9
+            if self._total_bytes <= target:
+                return
+            oldest_first = sorted(self._index, key=lambda k: self._index[k][1])
+            to_remove = []
+            removed_bytes = 0
+            for key in oldest_first:
+                if self._total_bytes - removed_bytes <= target:
+                    break
+                to_remove.append(key)
+                removed_bytes += self._index[key][0]
+        for key in to_remove:
+            self.remove(key)
+        logger.info('Removed {0} least recently used entries ({1:.1f} MB) from the response cache'.format(
+                                                                            len(to_remove), removed_bytes / 1024 ** 2))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._index),
+                    'bytes': self._total_bytes,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+
+class CacheWriter:
+    """
+    Writes one entry to the cache. The body is compressed into temporary files as it is written,
+    which only replace the cache entry on commit, so other threads never read a partly written entry.
+    """
+    def __init__(self, response_cache, key, meta):
+        self.response_cache = response_cache
+        self.key = key
+        self.meta = meta
+        self.meta_path, self.body_path = response_cache._paths(key)
+        os.makedirs(os.path.dirname(self.meta_path), exist_ok=True)
+        self.suffix = '.{0}.{1}.tmp'.format(os.getpid(), threading.get_ident())
+        self._body = gzip.open(self.body_path + self.suffix, 'wb', compresslevel=6)
+
+    def write(self, data: bytes):
+        self._body.write(data)
+
+    # The body is put in place before the details that describe it
+    def commit(self):
+        self._body.close()
+        self.meta['created'] = time.time()
+        with open(self.body_path + self.suffix, 'rb') as f:
+            self.meta['body_check'] = get_body_check(f)
+        with open(self.meta_path + self.suffix, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(self.body_path + self.suffix, self.body_path)
+        os.replace(self.meta_path + self.suffix, self.meta_path)
+        self.response_cache._record(self.key, os.path.getsize(self.body_path) + os.path.getsize(self.meta_path))
+
+    # Throw away a partly written entry, eg when the download failed
+    def abort(self):
+        self._body.close()
+        for path in (self.body_path + self.suffix, self.meta_path + self.suffix):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# The size of a gzip compressed body and its trailer, which holds the CRC32 and length of the uncompressed body.
+# body_file is the file opened as bytes, which is left at its start.
+def get_body_check(body_file) -> list:
+    size = body_file.seek(0, os.SEEK_END)
+    body_file.seek(max(size - 8, 0))
+    trailer = body_file.read(8).hex()
+    body_file.seek(0)
+    return [size, trailer]
+
+
+# Switch on caching of all lookups made with utils.get_url_with_retry
+def enable(cache_dir, max_bytes=default_max_bytes, ttl=default_ttl, release=None) -> ResponseCache:
+    global _active_cache
+    _active_cache = ResponseCache(cache_dir, max_bytes, ttl, release)
+    return _active_cache
+
+
+def disable():
+    global _active_cache
+    if _active_cache is not None:
+        logger.info('Response cache use: {0}'.format(_active_cache.stats()))
+    _active_cache = None
+
+
+def get_cache():
+    return _active_cache
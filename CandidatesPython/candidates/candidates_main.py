@@ -1,11 +1,10 @@
 import sys
+import argparse
 import os
 import os.path
-import candidates.interpro as interpro
-import candidates.unirule as unirule
-import candidates.uniprot.count_candidate_hits as uniprotcounter
-import candidates.utils as utils
-import candidates.uniprot.collect_candidates as uniprotcollector
+import candidates.output as output
+import candidates.metrics as metrics
+import candidates.profiling as profiling
 from datetime import datetime
 import time
 import logging
@@ -14,51 +13,143 @@ logger = logging.getLogger()
 data_path = os.sep.join(['data', 'main'])
 
 
-def run_analysis(timestamp, start_time, interpro_path, unirule_path):
+# The stage modules are imported in the functions that use them rather than above, as between them they load
+# lxml, requests and the rest, so that commands needing only some of them start quickly (see cli)
+def run_analysis(timestamp, start_time, interpro_path, unirule_path, options):
+    import candidates.interpro as interpro
+    import candidates.interpro_index as interpro_index
+    import candidates.unirule as unirule
+    import candidates.utils as utils
+    import candidates.uniprot.count_candidate_hits as uniprotcounter
+    import candidates.uniprot.collect_candidates as uniprotcollector
     global data_path
     logger.info('Starting main analysis run')
+    # Results for Stages 3 and 4 are saved here as they are collected so the run can be resumed
+    journal_dir = os.sep.join([data_path, 'output', 'Journal_{0}'.format(timestamp)])
 
-    # Map InterProId to member signatures
-    interpro_2_member_path = os.sep.join([data_path, 'output', 'InterProId_MemberId_{0}.tsv'.format(timestamp)])
-    interpro.create_interproid_to_memberid_map(interpro_path, interpro_2_member_path)
+    # The time taken by each stage and the requests made in it are kept in the metrics
+    with metrics.stage('stage2'):
+        # Load the index of the InterPro xml file, which is rebuilt in a single pass through the file if it
+        # has changed
+        index_path = os.sep.join([data_path, 'output', 'InterPro_index.bin'])
+        ipr_index = interpro_index.load_or_build_index(interpro_path, index_path)
 
-    # Map InterProId to InterPro type (Family, Domain, etc)
-    interpro_2_type_path = os.sep.join([data_path, 'output', 'InterProId_Type_{0}.tsv'.format(timestamp)])
-    interpro.create_interproid_to_type_map(interpro_path, interpro_2_type_path)
+        # From the index save:
+        # Map InterProId to member signatures
+        interpro_2_member_path = os.sep.join([data_path, 'output', 'InterProId_MemberId_{0}.tsv'.format(timestamp)])
+        # Map InterProId to InterPro type (Family, Domain, etc)
+        interpro_2_type_path = os.sep.join([data_path, 'output', 'InterProId_Type_{0}.tsv'.format(timestamp)])
+        # InterPro families that do not contain other families as subsets
+        interpro_nochild_path = os.sep.join([data_path, 'output',
+                                             'InterPro_nochild_nohamap_nopir_{0}.list'.format(timestamp)])
+        ipr_index.write_text_outputs(interpro_2_member_path, interpro_2_type_path, interpro_nochild_path)
+        member_map = ipr_index.get_member_map()
 
-    # Extract InterPro families that do not contain other families as subsets
-    interpro_nochild_path = os.sep.join([data_path, 'output', 'InterPro_nochild_nohamap_nopir_{0}.list'.format(timestamp)])
-    interpro.get_family_nochild_interpro(interpro_path, interpro_nochild_path)
+        # Extract the list of used signatures from the unifire xml file unirule-urml-latest.xml
+        used_signatures_outpath = os.sep.join([data_path, 'output', 'used_signatures_from_urml_file.list'])
+        unirule.collect_used_signatures(unirule_path, used_signatures_outpath)
 
-    # Extract the list of used signatures from the unifire xml file unirule-urml-latest.xml
-    used_signatures_outpath = os.sep.join([data_path, 'output', 'used_signatures_from_urml_file.list'])
-    unirule.collect_used_signatures(unirule_path, used_signatures_outpath)
-
-    # Filter the extracted InterPro families to remove any that contain signatures already used in rules
-    prelim_candidates_path = os.sep.join([data_path, 'output', 'Prelim_Candidates_{0}.list'.format(timestamp)])
-    interpro.create_interpro_candidate_list(interpro_2_member_path, used_signatures_outpath,
-                                            interpro_nochild_path, prelim_candidates_path)
+        # Filter the extracted InterPro families to remove any that contain signatures already used in rules
+        prelim_candidates_path = os.sep.join([data_path, 'output', 'Prelim_Candidates_{0}.list'.format(timestamp)])
+        interpro.write_interpro_candidate_list(ipr_index.get_nochild_list(), member_map,
+                                               used_signatures_outpath, prelim_candidates_path)
+    if options.stop_after == 'stage2':
+        logger.info('Stopped after Stage 2. Preliminary candidates are in file: {0}'.format(prelim_candidates_path))
+        return
 
     # Filter the preliminary candidate signatures based on the number of UniProt reviewed and unreviewed hits.
-    min_reviewed = 10
-    min_unreviewed = 100
     candidates_filtered_path = os.sep.join([data_path, 'output', 'CandidatesFilteredByHits_{0}.tsv'.format(timestamp)])
-    uniprotcounter.collect_counts(prelim_candidates_path, min_reviewed, min_unreviewed, candidates_filtered_path)
+    with metrics.stage('stage3'):
+        uniprotcounter.collect_counts(prelim_candidates_path, options.min_reviewed, options.min_unreviewed,
+                                      candidates_filtered_path, options.engine, journal_dir)
     logger.info('ElapsedTime: ' + utils.get_elapsed_time(start_time))
+    if options.stop_after == 'stage3':
+        logger.info('Stopped after Stage 3. Candidates with their counts are in file: {0}'.format(
+                                                                                        candidates_filtered_path))
+        return
 
     # Look up the reviewed records for the remaining families and collect those with consistent annotation
     outfile_path = os.sep.join([data_path, 'output', 'CandidateRules_{0}.tsv'.format(timestamp)])
-    uniprotcollector.collect_candidates_with_threads(candidates_filtered_path, outfile_path)
+    with metrics.stage('stage4'):
+        # In an incremental run only the signatures that changed since the earlier run are looked up
+        carry_forward = None
+        if options.incremental:
+            carry_forward = get_carry_forward(options.incremental, candidates_filtered_path, member_map)
+        uniprotcollector.collect_candidates_with_threads(candidates_filtered_path, outfile_path, journal_dir,
+                                                         options.processes, get_analysis_settings(options),
+                                                         carry_forward)
+    with metrics.stage('export'):
+        output.export_results(outfile_path, candidates_filtered_path, options.output_formats)
     logger.info('Analysis completed. Elapsed time: ' + utils.get_elapsed_time(start_time))
     logger.info('Intermediate and final data saved to: {0}/{1}/output/'.format(os.getcwd(), data_path))
     logger.info('Final data for candidates is in file: CandidateRules_{0}.tsv'.format(timestamp))
 
 
-def logger_setup(timestamp):
+# Runs Stages 3 and 4 again with the current thresholds on the counts and records saved by an earlier run,
+# without looking anything up
+def run_reanalysis(timestamp, start_time, source_timestamp, options):
+    import candidates.utils as utils
+    import candidates.record_store as record_store
+    import candidates.uniprot.count_candidate_hits as uniprotcounter
+    import candidates.uniprot.collect_candidates as uniprotcollector
+    global data_path
+    logger.info('Analysing again the data saved by the run started at {0}'.format(source_timestamp))
+    source_journal_dir = os.sep.join([data_path, 'output', 'Journal_{0}'.format(source_timestamp)])
+    prelim_candidates_path = os.sep.join([data_path, 'output', 'Prelim_Candidates_{0}.list'.format(source_timestamp)])
+    records_path = record_store.get_record_store_path(source_journal_dir)
+    if not os.path.isfile(prelim_candidates_path) or not os.path.isfile(records_path):
+        logger.critical('Missing saved data: {0} or {1}'.format(prelim_candidates_path, records_path))
+        sys.exit(0)
+
+    candidates_filtered_path = os.sep.join([data_path, 'output', 'CandidatesFilteredByHits_{0}.tsv'.format(timestamp)])
+    with metrics.stage('stage3'):
+        uniprotcounter.filter_saved_counts(prelim_candidates_path, options.min_reviewed, options.min_unreviewed,
+                                           candidates_filtered_path, source_journal_dir)
+
+    outfile_path = os.sep.join([data_path, 'output', 'CandidateRules_{0}.tsv'.format(timestamp)])
+    with metrics.stage('stage4'):
+        uniprotcollector.reanalyse_candidates(candidates_filtered_path, outfile_path, records_path,
+                                              get_analysis_settings(options))
+    with metrics.stage('export'):
+        output.export_results(outfile_path, candidates_filtered_path, options.output_formats)
+    logger.info('Analysis completed. Elapsed time: ' + utils.get_elapsed_time(start_time))
+    logger.info('Final data for candidates is in file: CandidateRules_{0}.tsv'.format(timestamp))
+
+
+# Returns the record store of the earlier run started at previous_timestamp and the signatures whose records
+# can be carried forward from it, or None if the earlier run did not save the data needed
+def get_carry_forward(previous_timestamp, candidates_filtered_path, member_map):
+    import candidates.incremental as incremental
+    import candidates.record_store as record_store
+    global data_path
+    previous_filtered_path = os.sep.join([data_path, 'output',
+                                          'CandidatesFilteredByHits_{0}.tsv'.format(previous_timestamp)])
+    previous_member_path = os.sep.join([data_path, 'output', 'InterProId_MemberId_{0}.tsv'.format(previous_timestamp)])
+    previous_records_path = record_store.get_record_store_path(
+                                    os.sep.join([data_path, 'output', 'Journal_{0}'.format(previous_timestamp)]))
+    for path in (previous_filtered_path, previous_member_path, previous_records_path):
+        if not os.path.isfile(path):
+            logger.warning('Missing saved data from the run started at {0}: {1}, '
+                           'so every candidate will be looked up'.format(previous_timestamp, path))
+            return None
+    unchanged = incremental.find_unchanged_signatures(candidates_filtered_path, member_map, previous_filtered_path,
+                                                      previous_member_path, previous_records_path)
+    return previous_records_path, unchanged
+
+
+# The settings for the Stage 4 grouping and consistency test from the command line options
+def get_analysis_settings(options) -> dict:
+    return {'engine': options.analysis_engine,
+            'taxonomy_depths': options.taxonomy_depths,
+            'cutoff': options.consistency_cutoff}
+
+
+# When resuming a run the log is added to rather than replaced
+def logger_setup(timestamp, resume=False):
     logger.setLevel(logging.DEBUG)
     ch = logging.StreamHandler()
     logpath = os.sep.join(['logs', 'log_{0}.txt'.format(timestamp)])
-    fh = logging.FileHandler(logpath, 'w')
+    fh = logging.FileHandler(logpath, 'a' if resume else 'w')
     ch.setLevel(logging.INFO)
     fh.setLevel(logging.INFO)
     log_format = logging.Formatter('%(asctime)s - %(levelname)s - %(module)s - %(funcName)s:  %(message)s',
@@ -79,24 +170,172 @@ def check_input_data_exists(interpro_path, unirule_path):
         return False
 
 
-def run_candidates(run_type):
-    timestamp = '{:%Y-%m-%d_%H%M%S}'.format(datetime.now())
-    logger_setup(timestamp)
+# options are the parsed command line arguments, the defaults are used if none are given
+def run_candidates(run_type, options=None):
+    if options is None:
+        options = parse_arguments([run_type])
     global data_path
     data_path = os.sep.join(['data', run_type])
+    if options.resume:
+        # Reuse the timestamp so the journals and output files of the earlier run are picked up
+        timestamp = options.resume
+        logger_setup(timestamp, resume=True)
+        logger.info('Resuming the run started at {0}'.format(timestamp))
+        if not os.path.isdir(os.sep.join([data_path, 'output', 'Journal_{0}'.format(timestamp)])):
+            logger.warning('No journal found for {0}, so the run will start from the beginning'.format(timestamp))
+    else:
+        timestamp = '{:%Y-%m-%d_%H%M%S}'.format(datetime.now())
+        logger_setup(timestamp)
+    # The metrics are written next to the log while the run goes, and summarised there at the end
+    metrics.start_reporting(os.sep.join(['logs', 'metrics_{0}.prom'.format(timestamp)]),
+                            options.metrics_interval, options.metrics_port)
+    if options.profile:
+        profiling.start(os.sep.join(['logs', 'profile_{0}'.format(timestamp)]), options.profile_interval)
+    try:
+        run_stages(run_type, timestamp, options)
+    finally:
+        profiling.stop()
+        metrics.stop_reporting()
+        metrics.write_summary(os.sep.join(['logs', 'summary_{0}.json'.format(timestamp)]),
+                              {'run_type': run_type, 'timestamp': timestamp, 'options': vars(options)})
 
-    # The point for setting the two input file paths
+
+def run_stages(run_type, timestamp, options):
+    import candidates.utils as utils
+    if options.reanalyse:
+        run_reanalysis(timestamp, time.time(), options.reanalyse, options)
+        return
+
+    # The point for setting the two input file paths, which can also be compressed (.gz, .xz or .zst)
     interpro_xmlpath = os.sep.join([data_path, 'input', 'interpro.xml'])
     unirule_xmlpath = os.sep.join([data_path, 'input', 'unirule-urml-latest.xml'])
+    interpro_xmlpath = utils.find_input_file(interpro_xmlpath) or interpro_xmlpath
+    unirule_xmlpath = utils.find_input_file(unirule_xmlpath) or unirule_xmlpath
     if check_input_data_exists(interpro_xmlpath, unirule_xmlpath):
+        replay_server = None
+        # Nothing is looked up if the run stops after Stage 2, so the modules for the lookups are not loaded
+        lookups = options.stop_after != 'stage2'
+        if lookups:
+            import candidates.session as session
+            import candidates.cache as cache
+            import candidates.rate_limit as rate_limit
+            rate_limit.configure(rate=options.request_rate, burst=max(1, int(options.request_rate)))
+            if options.replay:
+                # Lookups go to a local stand-in for the Proteins API, and are not cached
+                import candidates.standin as standin
+                replay_server = standin.StandInServer(options.replay, latency=options.replay_latency,
+                                                      error_rate=options.replay_error_rate,
+                                                      throttle_rate=options.replay_throttle_rate).start()
+                utils.proteins_api_url = replay_server.url
+            elif options.cache or options.cache_release:
+                # Only used when asked for, as responses saved before a UniProtKB release would be reused after it
+                cache.enable(os.sep.join([data_path, 'cache']), max_bytes=options.cache_size * 1024 ** 2,
+                             ttl=options.cache_ttl * 24 * 3600, release=options.cache_release)
         start_time = time.time()
-        run_analysis(timestamp, start_time, interpro_xmlpath, unirule_xmlpath)
+        try:
+            run_analysis(timestamp, start_time, interpro_xmlpath, unirule_xmlpath, options)
+        finally:
+            if replay_server is not None:
+                replay_server.stop()
+            if lookups:
+                cache.disable()
+                session.close_sessions()
     else:
         sys.exit(0)
 
 
+# The arguments are added in groups, which the subcommands of cli share
+def add_count_arguments(parser):
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='how the Stage 3 hit counts are collected (asyncio needs aiohttp)')
+    add_threshold_arguments(parser)
+
+
+def add_threshold_arguments(parser):
+    parser.add_argument('--min-reviewed', type=int, default=10, metavar='N',
+                        help='fewest reviewed hits for a candidate signature (default 10)')
+    parser.add_argument('--min-unreviewed', type=int, default=100, metavar='N',
+                        help='fewest unreviewed hits for a candidate signature (default 100)')
+
+
+def add_analysis_arguments(parser):
+    parser.add_argument('--analysis-engine', choices=['python', 'numpy'], default='python',
+                        help='how the Stage 4 consistency test is run (numpy needs numpy)')
+    parser.add_argument('--taxonomy-depths', type=int, nargs='+', default=[2], metavar='DEPTH',
+                        help='depths of lineage the Stage 4 records are grouped at, eg 1 2 3 (default 2)')
+    parser.add_argument('--processes', type=int, default=0, metavar='N',
+                        help='processes for parsing and analysing the Stage 4 records (default 0, '
+                             'where they are parsed and analysed in the fetching threads)')
+    parser.add_argument('--consistency-cutoff', type=float, default=0.9, metavar='FRACTION',
+                        help='fraction of the records in a taxonomic group that must share an annotation (default 0.9)')
+    parser.add_argument('--output-formats', nargs='+', choices=sorted(output.backends), default=[],
+                        metavar='FORMAT', help='also write the results as sqlite and/or parquet (needs pyarrow)')
+
+
+def add_lookup_arguments(parser):
+    parser.add_argument('--request-rate', type=float, default=50, metavar='N',
+                        help='most requests started each second on the Proteins API (default 50)')
+    parser.add_argument('--replay', metavar='DIR',
+                        help='look everything up in a local stand-in for the Proteins API serving the recordings '
+                             'in DIR (counts.tsv and <InterProId>.json files) rather than the real service')
+    parser.add_argument('--replay-latency', type=float, default=0.0, metavar='SECONDS',
+                        help='delay before each response of the stand-in (default 0)')
+    parser.add_argument('--replay-error-rate', type=float, default=0.0, metavar='FRACTION',
+                        help='fraction of the stand-in responses that fail with status 500 (default 0)')
+    parser.add_argument('--replay-throttle-rate', type=float, metavar='N',
+                        help='requests a second above which the stand-in answers 429 (default no limit)')
+    parser.add_argument('--cache', action='store_true',
+                        help='save the Proteins API responses in data/<run_type>/cache and use them again in later '
+                             'runs (off by default)')
+    parser.add_argument('--cache-ttl', type=float, default=28, metavar='DAYS',
+                        help='days before a cached response is looked up again (default 28)')
+    parser.add_argument('--cache-size', type=int, default=2048, metavar='MB',
+                        help='size the response cache is kept under (default 2048)')
+    parser.add_argument('--cache-release', metavar='RELEASE',
+                        help='UniProtKB release, cached responses saved for another release are not used '
+                             '(switches the cache on)')
+
+
+def add_report_arguments(parser):
+    parser.add_argument('--metrics-interval', type=float, default=30, metavar='SECONDS',
+                        help='how often the metrics are written to logs/metrics_<timestamp>.prom and '
+                             'summarised in the log (default 30)')
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help='also serve the metrics for Prometheus at http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--profile', action='store_true',
+                        help='sample where the time of each stage goes and save it to logs/profile_<timestamp>_*, '
+                             'with the time taken by each Stage 4 signature')
+    parser.add_argument('--profile-interval', type=float, metavar='SECONDS',
+                        help='seconds between the profile samples (default 0.01)')
+
+
+def add_run_type_argument(parser):
+    parser.add_argument('run_type', nargs='?', choices=['demo', 'main'], default='demo',
+                        help='run on the data in data/demo/input (default) or data/main/input')
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog='candidates')
+    add_run_type_argument(parser)
+    add_count_arguments(parser)
+    add_analysis_arguments(parser)
+    # A run is either resumed or analysed again, not both
+    rerun = parser.add_mutually_exclusive_group()
+    rerun.add_argument('--resume', metavar='TIMESTAMP',
+                       help='resume an earlier run, eg 2020-03-01_120000, skipping the signatures it completed')
+    rerun.add_argument('--reanalyse', metavar='TIMESTAMP',
+                       help='apply the thresholds again to the counts and records saved by an earlier run, '
+                            'without looking anything up')
+    parser.add_argument('--incremental', metavar='TIMESTAMP',
+                        help='only look up in Stage 4 the signatures that changed since an earlier run, '
+                             'and carry forward the records of the others')
+    parser.add_argument('--stop-after', choices=['stage2', 'stage3'],
+                        help='stop after Stage 2 (the preliminary candidates) or Stage 3 (the hit counts)')
+    add_lookup_arguments(parser)
+    add_report_arguments(parser)
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
-    if len(sys.argv) == 2 and sys.argv[1] == 'main':
-        run_candidates('main')
-    else:
-        run_candidates('demo')
+    args = parse_arguments(sys.argv[1:])
+    run_candidates(args.run_type, args)
@@ -0,0 +1,94 @@
+"""
+The candidates command, installed with the package (see setup.py) or run with python -m candidates, eg
+candidates run main --resume 2020-03-01_120000
+candidates stage2-only demo
+candidates counts-only main --engine asyncio
+candidates reanalyse 2020-03-01_120000 main --min-reviewed 20
+candidates cache-stats main
+
+Each subcommand only loads the modules it needs, when it needs them, so short commands start quickly.
+The same runs can be made with python -m candidates.candidates_main, which takes every option at once.
+"""
+import os
+import sys
+import argparse
+import candidates.candidates_main as candidates_main
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='candidates', description='Find candidate InterPro signatures for new '
+                                                                    'UniRule annotation rules')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+
+    run = subparsers.add_parser('run', help='run all four stages')
+    candidates_main.add_run_type_argument(run)
+    candidates_main.add_count_arguments(run)
+    candidates_main.add_analysis_arguments(run)
+    run.add_argument('--resume', metavar='TIMESTAMP',
+                     help='resume an earlier run, eg 2020-03-01_120000, skipping the signatures it completed')
+    run.add_argument('--incremental', metavar='TIMESTAMP',
+                     help='only look up in Stage 4 the signatures that changed since an earlier run, '
+                          'and carry forward the records of the others')
+    candidates_main.add_lookup_arguments(run)
+    candidates_main.add_report_arguments(run)
+
+    stage2 = subparsers.add_parser('stage2-only', help='only list the preliminary candidates from the input files')
+    candidates_main.add_run_type_argument(stage2)
+    candidates_main.add_report_arguments(stage2)
+    stage2.set_defaults(stop_after='stage2')
+
+    counts = subparsers.add_parser('counts-only', help='run Stages 2 and 3, ending with the hit counts')
+    candidates_main.add_run_type_argument(counts)
+    candidates_main.add_count_arguments(counts)
+    counts.add_argument('--resume', metavar='TIMESTAMP',
+                        help='resume an earlier run, eg 2020-03-01_120000, skipping the counts it collected')
+    candidates_main.add_lookup_arguments(counts)
+    candidates_main.add_report_arguments(counts)
+    counts.set_defaults(stop_after='stage3')
+
+    reanalyse = subparsers.add_parser('reanalyse', help='apply the thresholds again to the counts and records '
+                                                        'saved by an earlier run, without looking anything up')
+    reanalyse.add_argument('reanalyse', metavar='timestamp', help='the timestamp of the earlier run')
+    candidates_main.add_run_type_argument(reanalyse)
+    candidates_main.add_threshold_arguments(reanalyse)
+    candidates_main.add_analysis_arguments(reanalyse)
+    candidates_main.add_report_arguments(reanalyse)
+
+    cache_stats = subparsers.add_parser('cache-stats', help='show the size of the Proteins API response cache')
+    candidates_main.add_run_type_argument(cache_stats)
+    return parser
+
+
+# The options for candidates_main, with the defaults of its own arguments for those a subcommand does not take
+def get_run_options(args):
+    options = candidates_main.parse_arguments([])
+    for key, value in vars(args).items():
+        setattr(options, key, value)
+    return options
+
+
+def show_cache_stats(cache_dir):
+    # Only the cache module is loaded
+    import candidates.cache as cache
+    if not os.path.isdir(cache_dir):
+        print('No response cache in {0}'.format(cache_dir))
+        return
+    stats = cache.ResponseCache(cache_dir).stats()
+    print('Response cache in {0}'.format(cache_dir))
+    print('Entries: {0}'.format(stats['entries']))
+    print('Size: {0:.1f} MB of {1:.1f} MB'.format(stats['bytes'] / 1024 ** 2, stats['max_bytes'] / 1024 ** 2))
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == 'cache-stats':
+        show_cache_stats(os.sep.join(['data', args.run_type, 'cache']))
+    else:
+        options = get_run_options(args)
+        candidates_main.run_candidates(options.run_type, options)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
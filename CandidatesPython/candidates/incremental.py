@@ -0,0 +1,49 @@
+"""
+Compares the candidates of a run with those of an earlier run, eg last month's, so that Stage 4 only looks up
+the records of the signatures that have changed since.
+
+A signature is looked up again if:
+- it was not a candidate in the earlier run, eg it is a new InterPro entry, or one of its members is no
+  longer used in a UniRule rule,
+- its member signatures have changed,
+- its reviewed count in Stage 3 has changed,
+- or the earlier run has no saved records for it.
+The records of the other signatures are carried forward from the record store of the earlier run, and are
+analysed again with the current settings. Signatures that are no longer candidates, eg because one of their
+members is now used in a rule, are left out by Stages 2 and 3 as usual.
+"""
+import candidates.interpro as interpro
+import candidates.output as output
+import candidates.record_store as record_store
+import logging
+logger = logging.getLogger(__name__)
+
+
+# candidates_filtered_path and member_map are the Stage 3 counts and InterPro to members map of this run,
+# the previous paths the same files and the record store of the earlier run.
+# Returns the set of signatures whose records can be carried forward.
+def find_unchanged_signatures(candidates_filtered_path, member_map: dict, previous_filtered_path,
+                              previous_member_path, previous_records_path) -> set:
+    previous_counts = {interpro_id: reviewed for interpro_id, reviewed, unreviewed
+                       in output.read_counts(previous_filtered_path)}
+    previous_member_map = interpro.get_member_map(previous_member_path)
+    saved = record_store.index_record_store(previous_records_path)
+
+    unchanged = set()
+    new_count = member_count = reviewed_count = unsaved_count = total = 0
+    for interpro_id, reviewed, unreviewed in output.read_counts(candidates_filtered_path):
+        total += 1
+        if interpro_id not in previous_counts:
+            new_count += 1
+        elif member_map.get(interpro_id, set()) != previous_member_map.get(interpro_id, set()):
+            member_count += 1
+        elif reviewed != previous_counts[interpro_id]:
+            reviewed_count += 1
+        elif interpro_id not in saved:
+            unsaved_count += 1
+        else:
+            unchanged.add(interpro_id)
+    logger.info('{0} of {1} InterPro candidates are unchanged since the earlier run. Looking up {2} new, '
+                '{3} with changed members, {4} with changed reviewed counts and {5} with no saved records'.format(
+                    len(unchanged), total, new_count, member_count, reviewed_count, unsaved_count))
+    return unchanged
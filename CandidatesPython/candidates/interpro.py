@@ -5,6 +5,43 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+# Yields, in a single pass through the xml file, a tuple for each InterPro entry of its id, its type,
+# its member database signatures and whether it is a Family with no children and no HAMAP or PIRSF members
+def iter_entries(xmlfilepath):
+    xmlfile = utils.open_input(xmlfilepath)
+    try:
+        context = etree.iterparse(xmlfile, events=('end',), tag='interpro')
+        for event, interpro in context:
+            yield (interpro.attrib['id'], interpro.attrib['type'], get_member_signatures(interpro),
+                   is_family_nochild_nohamap_nopir(interpro))
+            clear_entry(interpro)
+    finally:
+        xmlfile.close()
+
+
+# The member database signatures of one interpro entry
+def get_member_signatures(interpro) -> list:
+    signatures = []
+    for memberlist in interpro.iter('member_list'):
+        for member in memberlist.iter('db_xref'):
+            signatures.append(member.attrib['dbkey'])
+    return signatures
+
+
+def is_family_nochild_nohamap_nopir(interpro) -> bool:
+    if interpro.attrib['type'] != 'Family' or interpro.find('child_list') is not None:
+        return False
+    memberlist = interpro.find('member_list')
+    return not any(member.attrib['db'] in ('HAMAP', 'PIRSF') for member in memberlist.findall('db_xref'))
+
+
+# Tidy up after dealing with an entry tag
+def clear_entry(interpro):
+    interpro.clear()
+    while interpro.getprevious() is not None:
+        del interpro.getparent()[0]
+
+
 def create_interproid_to_memberid_map(xmlfilepath, outfilepath):
     """
     Extracts the InterPro ids and the signatures associated with these
@@ -13,21 +50,17 @@ def create_interproid_to_memberid_map(xmlfilepath, outfilepath):
     """
     outfile = open(outfilepath, 'w')
     record_count = 0
-    context = etree.iterparse(xmlfilepath, events=('end',), tag='interpro')
+    xmlfile = utils.open_input(xmlfilepath)
+    context = etree.iterparse(xmlfile, events=('end',), tag='interpro')
 
     for event, interpro in context:
         id = interpro.attrib['id']
         record_count += 1
-        for memberlist in interpro.getiterator('member_list'):
-            for member in memberlist.getiterator('db_xref'):
-                sig = member.attrib['dbkey']
-                outfile.write('{0}\t{1}\n'.format(id, sig))
-
-        # Tidy up after dealing with an entry tag
-        interpro.clear()
-        while interpro.getprevious() is not None:
-            del interpro.getparent()[0]
+        for sig in get_member_signatures(interpro):
+            outfile.write('{0}\t{1}\n'.format(id, sig))
+        clear_entry(interpro)
 
+    xmlfile.close()
     outfile.close()
     logger.info('Mapping for {0} InterProId to MemberId saved to {1}'.format(record_count, outfilepath))
 
@@ -42,19 +75,17 @@ def create_interproid_to_type_map(xmlfilepath, outfilepath):
     record_count = 0
     outfile = open(outfilepath, 'w')
 
-    context = etree.iterparse(xmlfilepath, events=('end',), tag='interpro')
+    xmlfile = utils.open_input(xmlfilepath)
+    context = etree.iterparse(xmlfile, events=('end',), tag='interpro')
 
     for event, interpro in context:
         id = interpro.attrib['id']
         iptype = interpro.attrib['type']
         record_count += 1
         outfile.write('{0}\t{1}\n'.format(id, iptype))
+        clear_entry(interpro)
 
-        # Tidy up after dealing with an entry tag
-        interpro.clear()
-        while interpro.getprevious() is not None:
-            del interpro.getparent()[0]
-
+    xmlfile.close()
     outfile.close()
     logger.info('Mapping for {0} InterProId to Type saved to {1}'.format(record_count, outfilepath))
 
@@ -66,25 +97,16 @@ def get_family_nochild_interpro(xmlfilepath, outfilepath):
     """
     outfile = open(outfilepath, 'w')
     record_count = 0
-    context = etree.iterparse(xmlfilepath, events=('end',), tag='interpro')
+    xmlfile = utils.open_input(xmlfilepath)
+    context = etree.iterparse(xmlfile, events=('end',), tag='interpro')
 
     for event, interpro in context:
-        id = interpro.attrib['id']
-        iptype = interpro.attrib['type']
-        childlist = interpro.find('child_list')
-        if iptype == 'Family' and childlist is None:
-            memberlist = interpro.find('member_list')
-            if any(member.attrib['db'] in ('HAMAP', 'PIRSF') for member in memberlist.findall('db_xref')):
-                continue
-            else:
-                record_count += 1
-                outfile.write(id + '\n')
-
-        # Tidy up after dealing with an entry tag
-        interpro.clear()
-        while interpro.getprevious() is not None:
-            del interpro.getparent()[0]
+        if is_family_nochild_nohamap_nopir(interpro):
+            record_count += 1
+            outfile.write(interpro.attrib['id'] + '\n')
+        clear_entry(interpro)
 
+    xmlfile.close()
     outfile.close()
     logger.info('Found {0} InterPro records with no children and no Hamap or PIR members'.format(record_count))
 
@@ -102,11 +124,15 @@ def create_interpro_candidate_list(ipr_to_member_filepath, unirule_used_path,
                                    interpro_nochild_filepath, outfilepath):
 
     ip_members_map = get_member_map(ipr_to_member_filepath)
-    used_sigs = utils.file_list_to_set(unirule_used_path)
     ip_candidate_list = []
     for ip_line in open(interpro_nochild_filepath):
         ip_candidate_list.append(ip_line.rstrip())
+    write_interpro_candidate_list(ip_candidate_list, ip_members_map, unirule_used_path, outfilepath)
 
+
+# The same as create_interpro_candidate_list for data already read in, eg from the interpro_index
+def write_interpro_candidate_list(ip_candidate_list, ip_members_map, unirule_used_path, outfilepath):
+    used_sigs = utils.file_list_to_set(unirule_used_path)
     filtered_candidates = __filter_candidates(ip_candidate_list, used_sigs, ip_members_map)
     outfile = open(outfilepath, 'w')
     outfile.write('\n'.join(filtered_candidates))
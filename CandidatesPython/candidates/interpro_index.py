@@ -0,0 +1,193 @@
+"""
+A binary index of the data Stage 2 takes from the InterPro xml file, so that when the xml file
+has not changed since the last run it does not need to be parsed again.
+
+The index holds, for every InterPro entry in the order of the xml file, its type, whether it is a
+Family with no children and no HAMAP or PIRSF members, and its member database signatures.
+Identifiers are stored once each in a string table and referred to by number, and the members
+of each entry are a slice of one array of signature numbers. The file starts with a small JSON
+header followed by the arrays, which are read through a memory map when the index is loaded.
+
+The index is keyed on the InterPro release in the xml file together with a checksum of the whole
+file, and is rebuilt whenever the key does not match.
+"""
+import os
+import re
+import sys
+import mmap
+import json
+import struct
+import hashlib
+from array import array
+import candidates.utils as utils
+import candidates.interpro as interpro
+import logging
+logger = logging.getLogger(__name__)
+
+magic = b'IPRINDEX'
+index_version = 1
+# Each section of the file starts on a multiple of this many bytes
+alignment = 8
+# Typecode for 4 byte unsigned integers
+uint32 = 'I' if array('I').itemsize == 4 else 'L'
+
+
+class InterProIndex:
+    def __init__(self, key, entries, type_names, types, nochild, member_offsets, members, signatures):
+        self.key = key
+        self.entries = entries                  # InterPro ids in xml file order
+        self.type_names = type_names            # Type names referred to by the numbers in types
+        self.types = types                      # Type number for each entry
+        self.nochild = nochild                  # 1 for a Family with no children and no HAMAP or PIRSF members
+        self.member_offsets = member_offsets    # Members of entry i are members[member_offsets[i]:member_offsets[i + 1]]
+        self.members = members                  # Signature numbers
+        self.signatures = signatures            # Member database signatures referred to by the numbers in members
+
+    def get_members(self, i) -> list:
+        return [self.signatures[m] for m in self.members[self.member_offsets[i]:self.member_offsets[i + 1]]]
+
+    def get_member_map(self) -> dict:
+        return {ipr: set(self.get_members(i)) for i, ipr in enumerate(self.entries)}
+
+    def get_nochild_list(self) -> list:
+        return [ipr for i, ipr in enumerate(self.entries) if self.nochild[i]]
+
+    # Writes the same files as interpro.create_interproid_to_memberid_map, create_interproid_to_type_map
+    # and get_family_nochild_interpro
+    def write_text_outputs(self, member_outfilepath, type_outfilepath, nochild_outfilepath):
+        member_outfile = open(member_outfilepath, 'w')
+        type_outfile = open(type_outfilepath, 'w')
+        nochild_outfile = open(nochild_outfilepath, 'w')
+        for i, ipr in enumerate(self.entries):
+            for sig in self.get_members(i):
+                member_outfile.write('{0}\t{1}\n'.format(ipr, sig))
+            type_outfile.write('{0}\t{1}\n'.format(ipr, self.type_names[self.types[i]]))
+            if self.nochild[i]:
+                nochild_outfile.write(ipr + '\n')
+        member_outfile.close()
+        type_outfile.close()
+        nochild_outfile.close()
+
+
+# The InterPro release from the start of the xml file, eg '77.0 14-NOV-19'
+def get_release(xmlfilepath) -> str:
+    xmlfile = utils.open_input(xmlfilepath)
+    start = xmlfile.read(64 * 1024).decode('latin-1')
+    xmlfile.close()
+    match = re.search(r'<dbinfo dbname="INTERPRO"[^>]*?file_date="([^"]*)"[^>]*?version="([^"]*)"', start)
+    if match:
+        return '{0} {1}'.format(match.group(2), match.group(1))
+    return 'unknown'
+
+
+# Key made from the release and a checksum of the whole file, as it is stored (compressed or not)
+def get_index_key(xmlfilepath) -> str:
+    checksum = hashlib.sha256()
+    with open(xmlfilepath, 'rb') as f:
+        chunk = f.read(1024 ** 2)
+        while chunk:
+            checksum.update(chunk)
+            chunk = f.read(1024 ** 2)
+    return '{0} {1}'.format(get_release(xmlfilepath), checksum.hexdigest()[:16])
+
+
+def build_index(xmlfilepath, key=None) -> InterProIndex:
+    entries, types, nochild = [], array('B'), array('B')
+    member_offsets, members = array(uint32, [0]), array(uint32)
+    type_numbers, signature_numbers = {}, {}
+
+    for ipr, entry_type, signatures, is_nochild in interpro.iter_entries(xmlfilepath):
+        entries.append(ipr)
+        types.append(type_numbers.setdefault(entry_type, len(type_numbers)))
+        nochild.append(1 if is_nochild else 0)
+        for sig in signatures:
+            members.append(signature_numbers.setdefault(sig, len(signature_numbers)))
+        member_offsets.append(len(members))
+
+    logger.info('Built index of {0} InterPro entries with {1} member signatures'.format(len(entries), len(members)))
+    return InterProIndex(key, entries, sorted(type_numbers, key=type_numbers.get), types, nochild,
+                         member_offsets, members, sorted(signature_numbers, key=signature_numbers.get))
+
+
+def save_index(index: InterProIndex, indexpath):
+    sections = [('entries', '\n'.join(index.entries).encode('utf-8')),
+                ('signatures', '\n'.join(index.signatures).encode('utf-8')),
+                ('types', index.types.tobytes()),
+                ('nochild', index.nochild.tobytes()),
+                ('member_offsets', index.member_offsets.tobytes()),
+                ('members', index.members.tobytes())]
+    header = {'version': index_version,
+              'key': index.key,
+              'byteorder': sys.byteorder,
+              'type_names': index.type_names,
+              'sections': {}}
+    # Work out the section positions after the header, which has a fixed size prefix and is padded to the alignment
+    header_size = 4096
+    while True:
+        position = header_size
+        for name, data in sections:
+            header['sections'][name] = [position, len(data)]
+            position += len(data) + (-len(data) % alignment)
+        header_bytes = json.dumps(header).encode('utf-8')
+        if len(magic) + 4 + len(header_bytes) <= header_size:
+            break
+        header_size *= 2
+
+    temp_path = indexpath + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(magic + struct.pack('<I', len(header_bytes)) + header_bytes)
+        f.write(b'\0' * (header_size - f.tell()))
+        for name, data in sections:
+            f.write(data)
+            f.write(b'\0' * (-len(data) % alignment))
+    os.replace(temp_path, indexpath)
+    logger.info('InterPro index saved to {0}'.format(indexpath))
+
+
+# Returns None if the file is missing, is not an index, or was made for a different key or by a different version
+def load_index(indexpath, key=None):
+    if not os.path.isfile(indexpath):
+        return None
+    with open(indexpath, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            return None
+        header_length = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_length).decode('utf-8'))
+        if header['version'] != index_version or header['byteorder'] != sys.byteorder:
+            return None
+        if key is not None and header['key'] != key:
+            return None
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(mapped)
+
+    def section(name):
+        position, length = header['sections'][name]
+        return view[position:position + length]
+
+    return InterProIndex(header['key'],
+                         split_strings(section('entries')),
+                         header['type_names'],
+                         section('types'),
+                         section('nochild'),
+                         section('member_offsets').cast(uint32),
+                         section('members').cast(uint32),
+                         split_strings(section('signatures')))
+
+
+def split_strings(data) -> list:
+    if len(data) == 0:
+        return []
+    return bytes(data).decode('utf-8').split('\n')
+
+
+def load_or_build_index(xmlfilepath, indexpath) -> InterProIndex:
+    key = get_index_key(xmlfilepath)
+    index = load_index(indexpath, key)
+    if index is not None:
+        logger.info('Loaded InterPro index for release {0} from {1}'.format(key, indexpath))
+        return index
+    logger.info('No InterPro index for release {0}, building one from {1}'.format(key, xmlfilepath))
+    index = build_index(xmlfilepath, key)
+    save_index(index, indexpath)
+    return index
@@ -0,0 +1,125 @@
+"""
+Journals record the result for each signature as soon as it is collected, so that a run which
+stops part way through can be resumed without looking up the completed signatures again.
+
+A journal is a JSON lines file. Each line holds the key of one item and either its result or
+the error that stopped it being collected. When a journal is reopened the last line for each key wins.
+The file (and its folder) is only created when the first line is written, so reading the journal of a
+run that has none leaves nothing behind.
+"""
+import os
+import json
+import threading
+import candidates.utils as utils
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Journal:
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        self.failed = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            self._load()
+        self._file = None
+
+    def _load(self):
+        for line in open(self.path):
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may be incomplete if the run was killed while writing it
+                continue
+            key = entry['key']
+            if 'result' in entry:
+                self.completed[key] = entry['result']
+                self.failed.pop(key, None)
+            else:
+                self.failed[key] = entry['error']
+                self.completed.pop(key, None)
+        logger.info('Journal {0} has {1} completed and {2} failed items'.format(
+                                                                    self.path, len(self.completed), len(self.failed)))
+
+    def _write(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            if self._file is None:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                self._file = open(self.path, 'a')
+            self._file.write(line)
+            self._file.flush()
+
+    def record(self, key, result):
+        self._write({'key': key, 'result': result})
+        with self._lock:
+            self.completed[key] = result
+            self.failed.pop(key, None)
+
+    def record_failure(self, key, error):
+        self._write({'key': key, 'error': error})
+        with self._lock:
+            self.failed[key] = error
+            self.completed.pop(key, None)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def open_journal(journal_dir, name):
+    if journal_dir is None:
+        return None
+    return Journal(os.path.join(journal_dir, name + '.jsonl'))
+
+
+# Runs worker(item, thread_id) for every item on a shared work queue and returns a dictionary key(item): result
+# Items already completed in the journal are not run again, and every result is written to the journal as it arrives.
+# Items that fail are tried again once the others are done, and left out of the results if they fail a second time.
+def run_with_journal(worker, items: list, thread_count: int, journal=None, key=None, description='items') -> dict:
+    if key is None:
+        def key(item):
+            return item
+
+    results = {}
+    todo = []
+    for item in items:
+        if journal is not None and key(item) in journal.completed:
+            results[key(item)] = journal.completed[key(item)]
+        else:
+            todo.append(item)
+    if results:
+        logger.info('{0} of {1} {2} already collected in {3}'.format(len(results), len(items), description,
+                                                                       journal.path))
+
+    def journalled_worker(item, thread_id):
+        try:
+            result = worker(item, thread_id)
+        except Exception as e:
+            if journal is not None:
+                journal.record_failure(key(item), str(e))
+            raise
+        if journal is not None:
+            journal.record(key(item), result)
+        return result
+
+    for attempt in ('first', 'last'):
+        if not todo:
+            break
+        if attempt == 'last':
+            logger.warning('Trying {0} failed {1} again'.format(len(todo), description))
+        futures = utils.run_work_queue(journalled_worker, todo, min(thread_count, len(todo)), description)
+        failed = []
+        for item, future in zip(todo, futures):
+            if future.exception() is None:
+                results[key(item)] = future.result()
+            else:
+                failed.append(item)
+        todo = failed
+
+    for item in todo:
+        logger.error('Gave up collecting {0}, it will be tried again if the run is resumed'.format(key(item)))
+    return results
@@ -0,0 +1,61 @@
+"""
+An index of the taxonomic lineages of the reviewed records, so records can be grouped at any depth of
+their lineage without building and hashing a taxon string for every record.
+
+Each lineage is added to a trie of taxon names, in which every node has a number. A record keeps the
+number of the node for its full lineage, and the group of the record at a depth is the ancestor of
+that node at the depth, eg depth 1 for the superkingdom and depth 2 for 'Eukaryota Metazoa'.
+One index is shared by all the threads during a run, so each lineage is added to it once.
+"""
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LineageIndex:
+    def __init__(self):
+        # Node 0 is the root, with an empty lineage
+        self.names = ['']
+        self.parents = [-1]
+        self.paths = [()]           # Node numbers from depth 1 down to the node
+        self.lineages = [()]        # Taxon names from depth 1 down to the node
+        self.labels = ['']          # Taxon names joined with spaces, as written in the output
+        self._children = [{}]
+        self._lineage_nodes = {(): 0}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    # Returns the node number for the full lineage, adding its nodes if they are new
+    def add(self, lineage) -> int:
+        lineage = tuple(lineage)
+        node = self._lineage_nodes.get(lineage)
+        if node is not None:
+            return node
+        with self._lock:
+            node = 0
+            for name in lineage:
+                child = self._children[node].get(name)
+                if child is None:
+                    child = len(self.names)
+                    self.names.append(name)
+                    self.parents.append(node)
+                    self.paths.append(self.paths[node] + (child,))
+                    self.lineages.append(self.lineages[node] + (name,))
+                    self.labels.append(name if node == 0 else self.labels[node] + ' ' + name)
+                    self._children.append({})
+                    self._children[node][name] = child
+                node = child
+            self._lineage_nodes[lineage] = node
+        return node
+
+    def depth(self, node) -> int:
+        return len(self.paths[node])
+
+    # The ancestor of the node at the depth, or the node itself if its lineage is no deeper than that
+    def ancestor(self, node, depth) -> int:
+        path = self.paths[node]
+        if depth >= len(path):
+            return node
+        return path[depth - 1] if depth > 0 else 0
@@ -0,0 +1,447 @@
+"""
+Counters, gauges and histograms describing a run, so the number of threads and processes can be sized and
+a slow or failing Proteins API can be spotted while the run is going.
+
+The metrics are kept for the whole process and updated by every thread: the requests sent and their status,
+the time to their response headers, the bytes downloaded, the requests tried again, the response cache hits,
+the items waiting in each work queue and the threads busy on them, the records parsed, and how long each
+stage took. Requests are labelled with the stage running when they were made, set with stage().
+
+While reporting is started (see start_reporting) the metrics are written every interval to a file in the
+Prometheus text format, which the node exporter textfile collector can read, and a one line summary is
+logged. They can also be served at http://host:port/metrics for Prometheus to scrape. At the end of a run
+write_summary saves the totals, stage durations and latency percentiles to a JSON file.
+"""
+import os
+import json
+import math
+import time
+import threading
+import contextlib
+import logging
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry = []
+_current_stage = {'name': 'none'}
+# stage name: start time of the stages still running
+_running_stages = {}
+_reporter = None
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    # The child holding the value for the label values given in the order of labelnames
+    def labels(self, *labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError('{0} needs the labels {1}'.format(self.name, self.labelnames))
+        return MetricChild(self, tuple(str(value) for value in labelvalues))
+
+    def _new_value(self):
+        return 0.0
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    # Returns a list of (label values, value) sorted by label values
+    def collect(self) -> list:
+        with self._lock:
+            return sorted((key, self._copy(value)) for key, value in self._values.items())
+
+    def _copy(self, value):
+        return value
+
+
+class MetricChild:
+    def __init__(self, metric, labelvalues):
+        self.metric = metric
+        self.labelvalues = labelvalues
+
+    def inc(self, amount=1):
+        metric = self.metric
+        with metric._lock:
+            metric._values[self.labelvalues] = metric._values.get(self.labelvalues, 0.0) + amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self.metric._lock:
+            self.metric._values[self.labelvalues] = float(value)
+
+    def observe(self, value):
+        metric = self.metric
+        with metric._lock:
+            histogram = metric._values.get(self.labelvalues)
+            if histogram is None:
+                histogram = metric._values[self.labelvalues] = metric._new_value()
+            histogram['count'] += 1
+            histogram['sum'] += value
+            for i, bound in enumerate(metric.buckets):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+                    break
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=latency_buckets):
+        Metric.__init__(self, name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    # Each bucket counts only the values above the bound before it, they are added up when exported
+    def _new_value(self):
+        return {'count': 0, 'sum': 0.0, 'buckets': [0] * len(self.buckets)}
+
+    def _copy(self, value):
+        return {'count': value['count'], 'sum': value['sum'], 'buckets': list(value['buckets'])}
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+requests_total = Counter('candidates_requests_total', 'Requests sent to the Proteins API, by the status of the '
+                         'response or error if none came back', ['stage', 'status'])
+request_seconds = Histogram('candidates_request_duration_seconds',
+                            'Seconds from sending a request to its response headers', ['stage'])
+response_bytes = Counter('candidates_response_bytes_total', 'Bytes of response bodies downloaded', ['stage'])
+retries_total = Counter('candidates_retries_total', 'Requests tried again, because the server was overloaded '
+                        '(throttled) or after an error or failed status (error)', ['stage', 'reason'])
+cache_lookups = Counter('candidates_cache_lookups_total', 'Lookups in the response cache', ['stage', 'result'])
+requests_in_flight = Gauge('candidates_requests_in_flight', 'Requests sent and not yet finished')
+request_limit = Gauge('candidates_request_limit', 'Requests allowed in flight by the rate limiter')
+queue_items = Gauge('candidates_work_queue_items', 'Items waiting to be started in a work queue', ['work'])
+busy_threads = Gauge('candidates_busy_threads', 'Threads working on an item of a work queue', ['work'])
+items_total = Counter('candidates_items_total', 'Items of a work queue finished, or failed', ['work', 'result'])
+responses_streaming = Gauge('candidates_responses_streaming', 'Response bodies being read after their headers '
+                            'arrived, which no longer count as requests in flight')
+analysis_waiting = Gauge('candidates_analysis_waiting', 'Families handed to the analysis processes and '
+                         'not yet analysed')
+records_parsed = Counter('candidates_records_parsed_total', 'Reviewed records parsed in Stage 4')
+stage_seconds = Gauge('candidates_stage_duration_seconds', 'Seconds each stage took, or has taken so far', ['stage'])
+
+
+def reset():
+    for metric in _registry:
+        metric.reset()
+    _running_stages.clear()
+    _current_stage['name'] = 'none'
+
+
+def get_stage() -> str:
+    return _current_stage['name']
+
+
+# Labels the requests made in the block with the stage name and records how long the block took
+@contextlib.contextmanager
+def stage(name):
+    previous = _current_stage['name']
+    _current_stage['name'] = name
+    start = time.monotonic()
+    _running_stages[name] = start
+    try:
+        yield
+    finally:
+        _running_stages.pop(name, None)
+        stage_seconds.labels(name).set(time.monotonic() - start)
+        _current_stage['name'] = previous
+
+
+# Records a response, or an error if status is None
+def record_request(status, seconds=None, size=0):
+    current = get_stage()
+    requests_total.labels(current, 'error' if status is None else status).inc()
+    if seconds is not None:
+        request_seconds.labels(current).observe(seconds)
+    if size:
+        response_bytes.labels(current).inc(size)
+
+
+# Records part of a response body read after record_request, as with a streamed response
+def record_bytes(size):
+    response_bytes.labels(get_stage()).inc(size)
+
+
+def record_retry(reason):
+    retries_total.labels(get_stage(), reason).inc()
+
+
+def record_cache_lookup(hit: bool):
+    cache_lookups.labels(get_stage(), 'hit' if hit else 'miss').inc()
+
+
+def update_stage_durations():
+    now = time.monotonic()
+    for name, start in list(_running_stages.items()):
+        stage_seconds.labels(name).set(now - start)
+
+
+def format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names, values, extra=None) -> str:
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = [(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for name, value in pairs]
+    return '{' + ','.join('{0}="{1}"'.format(name, value) for name, value in escaped) + '}'
+
+
+# All the metrics in the Prometheus text exposition format
+def to_prometheus() -> str:
+    update_stage_durations()
+    lines = []
+    for metric in _registry:
+        lines.append('# HELP {0} {1}'.format(metric.name, metric.documentation))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+        for labelvalues, value in metric.collect():
+            if metric.kind != 'histogram':
+                lines.append('{0}{1} {2}'.format(metric.name, format_labels(metric.labelnames, labelvalues),
+                                                 format_value(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (math.inf,), value['buckets'] + [value['count']]):
+                cumulative = count if bound == math.inf else cumulative + count
+                lines.append('{0}_bucket{1} {2}'.format(metric.name, format_labels(
+                    metric.labelnames, labelvalues, ('le', format_value(bound))), cumulative))
+            lines.append('{0}_sum{1} {2}'.format(metric.name, format_labels(metric.labelnames, labelvalues),
+                                                 format_value(value['sum'])))
+            lines.append('{0}_count{1} {2}'.format(metric.name, format_labels(metric.labelnames, labelvalues),
+                                                   value['count']))
+    return '\n'.join(lines) + '\n'
+
+
+# Written to a temporary file first, so a collector never reads a partly written file
+def write_prometheus(path):
+    temp_path = path + '.tmp'
+    outfile = open(temp_path, 'w')
+    outfile.write(to_prometheus())
+    outfile.close()
+    os.replace(temp_path, path)
+
+
+# Adds up the values of a metric over the labels not named in by, eg total(requests_total, 'status')
+def total(metric, *by):
+    positions = [metric.labelnames.index(name) for name in by]
+    totals = {}
+    for labelvalues, value in metric.collect():
+        key = tuple(labelvalues[i] for i in positions)
+        if metric.kind == 'histogram':
+            merged = totals.setdefault(key, metric._new_value())
+            merged['count'] += value['count']
+            merged['sum'] += value['sum']
+            merged['buckets'] = [a + b for a, b in zip(merged['buckets'], value['buckets'])]
+        else:
+            totals[key] = totals.get(key, 0.0) + value
+    if not by:
+        return totals.get((), metric._new_value())
+    return {key[0] if len(key) == 1 else key: value for key, value in totals.items()}
+
+
+# Estimates a quantile of a histogram from its buckets, as Prometheus histogram_quantile does,
+# assuming the values are spread evenly within each bucket. Returns None if nothing was observed.
+def estimate_quantile(histogram: dict, buckets, quantile):
+    if histogram['count'] == 0:
+        return None
+    rank = quantile * histogram['count']
+    cumulative = 0
+    lower = 0.0
+    for bound, count in zip(buckets, histogram['buckets']):
+        if count and cumulative + count >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / count
+        cumulative += count
+        lower = bound
+    # In the bucket above the largest bound, which has no upper limit
+    return buckets[-1]
+
+
+def describe_latency(histogram: dict) -> dict:
+    description = {'count': histogram['count'],
+                   'mean': histogram['sum'] / histogram['count'] if histogram['count'] else None}
+    for name, quantile in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+        description[name] = estimate_quantile(histogram, request_seconds.buckets, quantile)
+    return description
+
+
+# The totals of the run so far, the durations of its stages and the latency of its requests in each stage
+def get_summary() -> dict:
+    update_stage_durations()
+    stages = {name: value for name, value in total(stage_seconds, 'stage').items()}
+    stage4_seconds = stages.get('stage4')
+    records = total(records_parsed)
+    summary = {'stages_seconds': stages,
+               'requests': total(requests_total),
+               'requests_by_status': total(requests_total, 'status'),
+               'requests_by_stage': total(requests_total, 'stage'),
+               'latency_seconds': describe_latency(total(request_seconds)),
+               'latency_seconds_by_stage': {name: describe_latency(value)
+                                            for name, value in total(request_seconds, 'stage').items()},
+               'bytes_downloaded': total(response_bytes),
+               'retries': total(retries_total, 'reason'),
+               'cache_lookups': total(cache_lookups, 'result'),
+               'items': {'{0} {1}'.format(work, result): value
+                         for (work, result), value in total(items_total, 'work', 'result').items()},
+               'records_parsed': records,
+               'records_per_second': records / stage4_seconds if stage4_seconds else None}
+    for stage_name, count in summary['requests_by_stage'].items():
+        if stages.get(stage_name):
+            summary.setdefault('requests_per_second_by_stage', {})[stage_name] = count / stages[stage_name]
+    return summary
+
+
+# Saves the summary and every metric to a JSON file, with anything in extra (eg the run type and settings)
+def write_summary(path, extra=None):
+    summary = dict(extra or {})
+    summary.update(get_summary())
+    summary['metrics'] = {metric.name: [{'labels': dict(zip(metric.labelnames, labelvalues)), 'value': value}
+                                        for labelvalues, value in metric.collect()] for metric in _registry}
+    outfile = open(path, 'w')
+    json.dump(summary, outfile, indent=1, sort_keys=True)
+    outfile.close()
+    logger.info('Run summary saved to {0}'.format(path))
+
+
+# A line for the log about the requests since the last report, eg to spot the API slowing down. previous is
+# the latency histogram at the last report, and the current one is returned with the line for the next.
+def describe_progress(previous: dict, seconds: float) -> str:
+    latency = total(request_seconds)
+    recent = {'count': latency['count'] - previous['count'], 'sum': latency['sum'] - previous['sum'],
+              'buckets': [a - b for a, b in zip(latency['buckets'], previous['buckets'])]}
+    statuses = total(requests_total, 'status')
+    failed = sum(count for status, count in statuses.items() if status == 'error' or int(status) >= 400)
+    waiting = sum(total(queue_items, 'work').values())
+    busy = sum(total(busy_threads, 'work').values())
+    p50, p99 = [estimate_quantile(recent, request_seconds.buckets, q) for q in (0.5, 0.99)]
+    text = 'Metrics ({0}): {1:.0f} requests ({2:.1f}/s'.format(get_stage(), total(requests_total),
+                                                                recent['count'] / seconds if seconds else 0)
+    if p50 is not None:
+        text += ', p50 {0:.2f}s, p99 {1:.2f}s'.format(p50, p99)
+    text += '), {0:.0f} failed, {1:.0f} retried, {2:.0f}/{3:.0f} in flight, {4:.0f} waiting, ' \
+            '{5:.0f} threads busy, {6:.1f} MB downloaded'.format(failed, sum(total(retries_total, 'reason').values()),
+                                                                 total(requests_in_flight), total(request_limit),
+                                                                 waiting, busy, total(response_bytes) / 1024 ** 2)
+    return text, latency
+
+
+# A server answering /metrics with the metrics in the Prometheus text format. http.server is imported here
+# as it is slow to import and most runs do not serve the metrics.
+def create_server(host, port):
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    class MetricsServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+    return MetricsServer((host, port), MetricsHandler)
+
+
+# Writes the metrics to path and logs a summary every interval seconds in a background thread
+class Reporter:
+    def __init__(self, path, interval, port=None, host='127.0.0.1'):
+        self.path = path
+        self.interval = interval
+        self.server = None
+        if port is not None:
+            self.server = create_server(host, port)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info('Serving metrics at http://{0}:{1}/metrics'.format(host, self.server.server_port))
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        previous = request_seconds._new_value()
+        last = time.monotonic()
+        while not self._stopped.wait(self.interval):
+            now = time.monotonic()
+            try:
+                if self.path is not None:
+                    write_prometheus(self.path)
+                text, previous = describe_progress(previous, now - last)
+                logger.info(text)
+            except Exception as e:
+                logger.warning('Could not report the metrics: {0}'.format(e))
+            last = now
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        if self.path is not None:
+            write_prometheus(self.path)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+# Starts with the metrics at zero. path is where the Prometheus text file is written, and port,
+# if given, where the metrics are served over HTTP (0 for any free port).
+def start_reporting(path, interval=30.0, port=None) -> Reporter:
+    global _reporter
+    stop_reporting()
+    reset()
+    _reporter = Reporter(path, interval, port)
+    return _reporter
+
+
+def stop_reporting():
+    global _reporter
+    if _reporter is not None:
+        _reporter.stop()
+        _reporter = None
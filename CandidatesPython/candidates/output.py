@@ -0,0 +1,230 @@
+"""
+Writes the CandidateRules output file while Stage 4 is running.
+
+The block of lines for each signature is added to <output>.partial as soon as the signature is finished,
+so the partial results can be followed during a run (eg with tail -f). The position of every block is
+saved in <output>.index, and when the run is finished the blocks are copied to the output file in the
+order of their InterPro ids, after which the partial and index files are removed. Only the positions
+of the blocks are held in memory.
+
+If a run is stopped, the blocks already written are kept and picked up again when the run is resumed.
+
+The finished output and the counts of the signatures that passed Stage 3 can also be exported to other
+formats for querying, see export_results: an SQLite database, or Parquet files (which need pyarrow, not
+installed with the other requirements).
+"""
+import os
+import re
+import sqlite3
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+# pyarrow is imported by load_pyarrow when Parquet files are written, as it is slow to import
+pyarrow = None
+
+column_header = '# Columns: TaxonomicGroup / AnnotationCode / Total / Consistent / AnnotationText\n'
+
+
+class CandidateWriter:
+    def __init__(self, outfile_path):
+        self.outfile_path = outfile_path
+        self.partial_path = outfile_path + '.partial'
+        self.index_path = outfile_path + '.index'
+        # InterPro id: (updated key, position, length) of its block in the partial file
+        self.blocks = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(self.partial_path) and os.path.isfile(self.index_path):
+            self._load_index()
+        else:
+            for path in (self.partial_path, self.index_path):
+                if os.path.isfile(path):
+                    os.remove(path)
+        self._partial = open(self.partial_path, 'ab')
+        self._index = open(self.index_path, 'a')
+
+    def _load_index(self):
+        partial_size = os.path.getsize(self.partial_path)
+        with open(self.index_path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                # The last line may be incomplete if the run was killed while writing it
+                if not line.endswith('\n') or len(fields) != 5:
+                    continue
+                position, length = int(fields[3]), int(fields[4])
+                if position + length <= partial_size:
+                    self.blocks[fields[0]] = ('\t'.join(fields[:3]), position, length)
+        logger.info('Found {0} candidate signatures already written to {1}'.format(len(self.blocks),
+                                                                                  self.partial_path))
+
+    # key is the string Interpro_id \t reviewed_count \t unreviewed_count
+    def write(self, key, lines: list):
+        interpro, reviewed, unreviewed = key.split('\t')
+        text = '\n# {0}  Reviewed:  {1}  Unreviewed:  {2}\n'.format(interpro, reviewed, unreviewed)
+        block = (text + '\n'.join(lines) + '\n').encode('utf-8')
+        with self._lock:
+            position = self._partial.seek(0, os.SEEK_END)
+            self._partial.write(block)
+            self._partial.flush()
+            self._index.write('{0}\t{1}\t{2}\n'.format(key, position, len(block)))
+            self._index.flush()
+            self.blocks[interpro] = (key, position, len(block))
+
+    def close(self):
+        self._partial.close()
+        self._index.close()
+
+    # Writes the output file with the blocks sorted by InterPro id and removes the partial and index files
+    def finish(self):
+        self.close()
+        temp_path = self.outfile_path + '.tmp'
+        with open(self.partial_path, 'rb') as partial, open(temp_path, 'wb') as outfile:
+            outfile.write(column_header.encode('utf-8'))
+            for interpro in sorted(self.blocks):
+                key, position, length = self.blocks[interpro]
+                partial.seek(position)
+                outfile.write(partial.read(length))
+        os.replace(temp_path, self.outfile_path)
+        os.remove(self.partial_path)
+        os.remove(self.index_path)
+        logger.info('Collected candidate data for {0} candidate signatures'.format(len(self.blocks)))
+
+
+# Yields a tuple (InterProId, reviewed_count, unreviewed_count, rows) for each signature in a CandidateRules file,
+# where rows are lists [TaxonomicGroup, AnnotationCode, Total, Consistent, AnnotationText]
+def read_candidates(path):
+    header = re.compile(r'^# (\S+)  Reviewed:  (\d+)  Unreviewed:  (\d+)$')
+    signature = None
+    with open(path, encoding='utf-8') as infile:
+        for line in infile:
+            line = line.rstrip('\n')
+            match = header.match(line)
+            if match:
+                if signature is not None:
+                    yield signature
+                signature = (match.group(1), int(match.group(2)), int(match.group(3)), [])
+            elif signature is not None and line:
+                taxon, code, total, consistent, annotation = line.split('\t', 4)
+                signature[3].append([taxon, code, int(total), int(consistent), annotation])
+    if signature is not None:
+        yield signature
+
+
+# Yields a tuple (InterProId, reviewed_count, unreviewed_count) for each line of a CandidatesFilteredByHits file
+def read_counts(path):
+    with open(path) as infile:
+        for line in infile:
+            interpro, reviewed, unreviewed = line.rstrip('\n').split('\t')
+            yield interpro, int(reviewed), int(unreviewed)
+
+
+# Tables: filtered_counts (the Stage 3 counts of the signatures that passed the thresholds), candidates
+# (the counts in the output) and annotations (the output rows), with the annotations indexed by InterPro id,
+# taxonomic group and annotation code
+class SqliteBackend:
+    extension = '.sqlite'
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.isfile(path):
+            os.remove(path)
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript("""
+            CREATE TABLE filtered_counts (interpro TEXT PRIMARY KEY, reviewed INTEGER, unreviewed INTEGER);
+            CREATE TABLE candidates (interpro TEXT PRIMARY KEY, reviewed INTEGER, unreviewed INTEGER);
+            CREATE TABLE annotations (interpro TEXT, taxon TEXT, code TEXT, total INTEGER, consistent INTEGER,
+                                      annotation TEXT);
+            """)
+
+    def write_filtered_counts(self, counts):
+        self._connection.executemany('INSERT INTO filtered_counts VALUES (?, ?, ?)', counts)
+
+    def write_candidate(self, interpro, reviewed, unreviewed, rows):
+        self._connection.execute('INSERT INTO candidates VALUES (?, ?, ?)', (interpro, reviewed, unreviewed))
+        self._connection.executemany('INSERT INTO annotations VALUES (?, ?, ?, ?, ?, ?)',
+                                     [[interpro] + row for row in rows])
+
+    def close(self):
+        self._connection.executescript("""
+            CREATE INDEX annotations_interpro ON annotations (interpro);
+            CREATE INDEX annotations_taxon ON annotations (taxon);
+            CREATE INDEX annotations_code ON annotations (code);
+            """)
+        self._connection.commit()
+        self._connection.close()
+
+
+# <output>.parquet holds the annotations, with the counts in the output repeated on each row, and
+# <output>_filtered_counts.parquet the Stage 3 counts of the signatures that passed the thresholds.
+# Rows are in InterPro id order and written in batches.
+class ParquetBackend:
+    extension = '.parquet'
+    batch_size = 100000
+
+    def __init__(self, path):
+        if not load_pyarrow():
+            raise Exception('Parquet output needs pyarrow to be installed')
+        self.path = path
+        self.counts_path = path[:-len(self.extension)] + '_filtered_counts' + self.extension
+        self._schema = pyarrow.schema([('interpro', pyarrow.string()), ('reviewed', pyarrow.int64()),
+                                       ('unreviewed', pyarrow.int64()), ('taxon', pyarrow.string()),
+                                       ('code', pyarrow.string()), ('total', pyarrow.int64()),
+                                       ('consistent', pyarrow.int64()), ('annotation', pyarrow.string())])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        self._batch = []
+
+    def write_filtered_counts(self, counts):
+        columns = list(zip(*counts)) or [[], [], []]
+        table = pyarrow.table({'interpro': pyarrow.array(columns[0], pyarrow.string()),
+                               'reviewed': pyarrow.array(columns[1], pyarrow.int64()),
+                               'unreviewed': pyarrow.array(columns[2], pyarrow.int64())})
+        pyarrow.parquet.write_table(table, self.counts_path)
+
+    def write_candidate(self, interpro, reviewed, unreviewed, rows):
+        for row in rows:
+            self._batch.append([interpro, reviewed, unreviewed] + row)
+        if len(self._batch) >= self.batch_size:
+            self._write_batch()
+
+    def _write_batch(self):
+        columns = list(zip(*self._batch)) or [[] for field in self._schema]
+        self._writer.write_table(pyarrow.table([pyarrow.array(column, field.type)
+                                                for column, field in zip(columns, self._schema)],
+                                               schema=self._schema))
+        self._batch = []
+
+    def close(self):
+        self._write_batch()
+        self._writer.close()
+
+
+backends = {'sqlite': SqliteBackend, 'parquet': ParquetBackend}
+
+
+# Imports pyarrow if it has not been already, and returns False if it is not installed
+def load_pyarrow() -> bool:
+    global pyarrow
+    if pyarrow is None:
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            return False
+    return True
+
+
+# Writes the CandidateRules file at candidates_path and the CandidatesFilteredByHits file at counts_path to each
+# of the formats, named after candidates_path, eg CandidateRules_<timestamp>.sqlite
+def export_results(candidates_path, counts_path, formats):
+    for name in formats:
+        if name == 'parquet' and not load_pyarrow():
+            logger.warning('Parquet output needs pyarrow to be installed, so it is not written')
+            continue
+        backend_class = backends[name]
+        backend = backend_class(os.path.splitext(candidates_path)[0] + backend_class.extension)
+        backend.write_filtered_counts(list(read_counts(counts_path)))
+        signature_count = 0
+        for interpro, reviewed, unreviewed, rows in read_candidates(candidates_path):
+            backend.write_candidate(interpro, reviewed, unreviewed, rows)
+            signature_count += 1
+        backend.close()
+        logger.info('Exported {0} candidate signatures to {1}'.format(signature_count, backend.path))
@@ -0,0 +1,255 @@
+"""
+A sampling profiler for a run started with --profile, to find where the time of a stage goes: waiting on
+the network, parsing the JSON records, extracting their annotations or the consistency test.
+
+A background thread takes the stack of every thread every settings['interval'] seconds (sys._current_frames),
+which costs the threads being sampled very little, unlike cProfile, which slows every function call. Only
+the threads running code of this package are counted, so idle threads waiting for work are left out, and the
+stacks are kept for the stage running when they were taken (see metrics.stage). The analysis processes of
+Stage 4 sample themselves while analysing and send their stacks back with each result, under a root frame
+'analysis_process'.
+
+Times are thread seconds, the samples of a stack times the interval added up over the threads, so 50 threads
+waiting on the network for a minute count as 50 minutes. At the end, for each stage:
+- <prefix>_<stage>.folded has a line 'frame;frame;frame samples' for each stack, root first, which flamegraph.pl
+  (https://github.com/brendangregg/FlameGraph) or speedscope can draw,
+- <prefix>_<stage>_functions.tsv has the self and cumulative seconds of each function, largest first,
+and <prefix>_signatures.tsv has the time taken by each Stage 4 signature, slowest first.
+"""
+import sys
+import threading
+import candidates.metrics as metrics
+import logging
+logger = logging.getLogger(__name__)
+
+settings = {'interval': 0.01,          # Seconds between samples
+            'max_depth': 100,          # Frames kept from the top of each stack
+            'slowest_logged': 10}      # Signatures listed in the log at the end
+
+# Modules of the package whose threads are not part of the pipeline, eg the metrics reporter
+excluded_modules = ('candidates.metrics', 'candidates.standin')
+
+_profiler = None
+# code object: (frame name, whether in the package, whether in an excluded module), so each is only worked out once
+_code_names = {}
+# The sampler of an analysis process, started on its first profiled task
+_process_sampler = None
+
+
+class Sampler:
+    """
+    Counts the stacks of the threads running code of the package, every interval seconds in a background thread.
+    If only_thread is given only that thread is sampled, and only while enable() is in effect.
+    """
+    def __init__(self, interval, only_thread=None):
+        self.interval = interval
+        self.only_thread = only_thread
+        # stage: {stack tuple: samples}
+        self.stacks = {}
+        self.samples = 0
+        self._lock = threading.Lock()
+        self._enabled = threading.Event()
+        if only_thread is None:
+            self._enabled.set()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            if not self._enabled.is_set():
+                continue
+            stage = metrics.get_stage()
+            frames = sys._current_frames()
+            stacks = []
+            for thread_id, frame in frames.items():
+                if thread_id == own_id or (self.only_thread is not None and thread_id != self.only_thread):
+                    continue
+                stack = get_stack(frame)
+                if stack is not None:
+                    stacks.append(stack)
+            del frames
+            with self._lock:
+                self.samples += 1
+                counts = self.stacks.setdefault(stage, {})
+                for stack in stacks:
+                    counts[stack] = counts.get(stack, 0) + 1
+
+    def enable(self):
+        self._enabled.set()
+
+    def disable(self):
+        self._enabled.clear()
+
+    # Returns the stacks counted since the last call, and starts counting again
+    def drain(self) -> dict:
+        with self._lock:
+            stacks, self.stacks = self.stacks, {}
+        return stacks
+
+    # Adds the stacks of another sampler, as {stage: {stack: samples}}, to the stage given
+    def add(self, stacks: dict, stage, root=None):
+        with self._lock:
+            stage_counts = self.stacks.setdefault(stage, {})
+            for counts in stacks.values():
+                for stack, count in counts.items():
+                    if root is not None:
+                        stack = (root,) + stack
+                    stage_counts[stack] = stage_counts.get(stack, 0) + count
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+# The frames of a stack from the root as 'module:function', or None if the thread is not running package code
+# or was started by one of the excluded modules, as found from the package frame nearest the root
+def get_stack(frame):
+    names = []
+    in_package = False
+    excluded = False
+    while frame is not None and len(names) < settings['max_depth']:
+        code = frame.f_code
+        described = _code_names.get(code)
+        if described is None:
+            module = frame.f_globals.get('__name__', '?')
+            described = _code_names[code] = ('{0}:{1}'.format(module, code.co_name),
+                                             module.split('.')[0] == 'candidates', module in excluded_modules)
+        name, package_code, excluded_code = described
+        if package_code:
+            in_package = True
+            excluded = excluded_code
+        names.append(name)
+        frame = frame.f_back
+    if not in_package or excluded:
+        return None
+    names.reverse()
+    return tuple(names)
+
+
+class Profiler:
+    def __init__(self, prefix, interval):
+        self.prefix = prefix
+        self.interval = interval
+        self.sampler = Sampler(interval)
+        # signature: (seconds, records, fetch and parse seconds, analysis seconds)
+        self.signatures = {}
+        self._lock = threading.Lock()
+
+    def record_signature(self, signature, seconds, records, fetch_seconds, analysis_seconds):
+        with self._lock:
+            self.signatures[signature] = (seconds, records, fetch_seconds, analysis_seconds)
+
+    def stop(self):
+        self.sampler.stop()
+        stacks = self.sampler.drain()
+        for stage in sorted(stacks):
+            write_folded(stacks[stage], '{0}_{1}.folded'.format(self.prefix, stage))
+            write_functions(stacks[stage], self.interval, '{0}_{1}_functions.tsv'.format(self.prefix, stage))
+        logger.info('Profiled {0} samples of the stages {1}, saved to {2}_*'.format(
+                                                        self.sampler.samples, ', '.join(sorted(stacks)), self.prefix))
+        if self.signatures:
+            slowest = write_signatures(self.signatures, '{0}_signatures.tsv'.format(self.prefix))
+            for signature in slowest[:settings['slowest_logged']]:
+                seconds, records, fetch_seconds, analysis_seconds = self.signatures[signature]
+                logger.info('Slow signature {0}: {1:.2f} seconds for {2} records ({3:.2f} fetching and parsing, '
+                            '{4:.2f} analysing)'.format(signature, seconds, records, fetch_seconds, analysis_seconds))
+
+
+def write_folded(stacks: dict, path):
+    outfile = open(path, 'w')
+    for stack, count in sorted(stacks.items()):
+        outfile.write('{0} {1}\n'.format(';'.join(frame.replace(';', ':').replace(' ', '_') for frame in stack),
+                                         count))
+    outfile.close()
+
+
+# The self and cumulative seconds of each function. A function is counted once in the cumulative time of a
+# stack however many times it appears in it, as with recursion.
+def get_function_times(stacks: dict, interval) -> dict:
+    times = {}
+    for stack, count in stacks.items():
+        for frame in set(stack):
+            times.setdefault(frame, [0, 0])[1] += count
+        times[stack[-1]][0] += count
+    return {frame: (self_count * interval, cumulative * interval) for frame, (self_count, cumulative) in times.items()}
+
+
+def write_functions(stacks: dict, interval, path):
+    times = get_function_times(stacks, interval)
+    outfile = open(path, 'w')
+    outfile.write('function\tself_seconds\tcumulative_seconds\n')
+    for frame in sorted(times, key=lambda f: (-times[f][1], -times[f][0], f)):
+        outfile.write('{0}\t{1:.3f}\t{2:.3f}\n'.format(frame, times[frame][0], times[frame][1]))
+    outfile.close()
+
+
+# Returns the signatures slowest first
+def write_signatures(signatures: dict, path) -> list:
+    slowest = sorted(signatures, key=lambda s: signatures[s][0], reverse=True)
+    outfile = open(path, 'w')
+    outfile.write('signature\tseconds\trecords\tfetch_and_parse_seconds\tanalysis_seconds\n')
+    for signature in slowest:
+        seconds, records, fetch_seconds, analysis_seconds = signatures[signature]
+        outfile.write('{0}\t{1:.3f}\t{2}\t{3:.3f}\t{4:.3f}\n'.format(signature, seconds, records, fetch_seconds,
+                                                                    analysis_seconds))
+    outfile.close()
+    return slowest
+
+
+# Starts sampling every thread. The output files are named <prefix>_<stage>.folded and so on.
+def start(prefix, interval=None) -> Profiler:
+    global _profiler
+    stop()
+    _profiler = Profiler(prefix, interval or settings['interval'])
+    logger.info('Profiling every {0} seconds'.format(_profiler.interval))
+    return _profiler
+
+
+def stop():
+    global _profiler
+    if _profiler is not None:
+        _profiler.stop()
+        _profiler = None
+
+
+def is_active() -> bool:
+    return _profiler is not None
+
+
+# The seconds between samples of the running profiler, which the analysis processes sample at too, so that
+# their samples count for the same time as those of the main process
+def get_interval() -> float:
+    profiler = _profiler
+    if profiler is not None:
+        return profiler.interval
+    return settings['interval']
+
+
+# Called with the times of each Stage 4 signature, and ignored unless profiling
+def record_signature(signature, seconds, records, fetch_seconds, analysis_seconds):
+    profiler = _profiler
+    if profiler is not None:
+        profiler.record_signature(signature, seconds, records, fetch_seconds, analysis_seconds)
+
+
+# Runs function(*args) in an analysis process, sampling it with the interval given, and returns a tuple of its
+# result and the stacks sampled, for add_process_stacks in the main process
+def run_profiled(interval, function, *args):
+    global _process_sampler
+    if _process_sampler is None:
+        _process_sampler = Sampler(interval, only_thread=threading.get_ident())
+    _process_sampler.enable()
+    try:
+        result = function(*args)
+    finally:
+        _process_sampler.disable()
+    return result, _process_sampler.drain()
+
+
+# The stacks of an analysis process are added to the stage running in the main process
+def add_process_stacks(stacks: dict):
+    profiler = _profiler
+    if profiler is not None:
+        profiler.sampler.add(stacks, metrics.get_stage(), root='analysis_process')
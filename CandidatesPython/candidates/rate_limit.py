@@ -0,0 +1,198 @@
+"""
+A client-side limit on the requests made to the Proteins API, shared by every thread of a run (and by the
+asyncio engine), so the threads back off together rather than each on its own.
+
+A request waits for a token from a token bucket, refilled at settings['rate'] requests a second up to
+settings['burst'], and for one of the slots for requests in flight, held until the response headers arrive
+(a streamed body is read after its slot is released). The number of slots is adjusted in the
+way of TCP congestion control, additive increase and multiplicative decrease (AIMD): it grows by one for
+each full set of responses that come back quickly and without throttling, and is halved when the server
+answers 429, 503 or another server error, when a request fails with no response (eg a timeout), or when the
+smoothed time to the response headers grows to latency_factor times the base latency. Latencies are only
+compared within a kind of request (see get_request_kind), so the Stage 4 bundles of every record of a family
+are not taken as overload for being slower than the Stage 3 counts. The base latency of a kind is the fastest
+seen, drifting slowly up towards the latencies since, so that a lasting change becomes the new normal.
+The limit is cut at most once per cool-down, as the many responses to the same overload arrive together.
+
+A Retry-After header pauses every request, not just the one that got it. The requests refused are tried
+again after a backoff with full jitter (a random time up to an exponentially growing cap), or after the
+Retry-After time plus a little jitter, so the threads do not all try again at the same moment.
+"""
+import time
+import random
+import threading
+import email.utils
+import urllib.parse
+import candidates.metrics as metrics
+import logging
+logger = logging.getLogger(__name__)
+
+# Default settings, changed with configure()
+settings = {'rate': 50.0,                   # Requests started per second
+            'burst': 50,                    # Requests that can be started at once after a quiet spell
+            'initial_limit': 10,            # Requests in flight at the start
+            'min_limit': 1,
+            'max_limit': 100,
+            'latency_factor': 4.0,          # Smoothed latency, as a multiple of the base, that counts as overload
+            'min_base_latency': 0.1,        # Seconds, so that small changes in very fast responses are not overload
+            'cooldown': 2.0,                # Seconds after cutting the limit before it can be cut again
+            'throttle_statuses': (429, 503),
+            'max_throttle_retries': 8,
+            'backoff_base': 1.0,            # Backoff caps of 2, 4, 8... seconds
+            'backoff_cap': 120.0}
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    """
+    Change the limiter settings. The shared limiter is replaced, so this should be called before any lookups are made.
+    """
+    global _limiter
+    for key in kwargs:
+        if key not in settings:
+            raise ValueError('Unknown rate limit setting: {0}'.format(key))
+    settings.update(kwargs)
+    with _limiter_lock:
+        _limiter = None
+
+
+# Returns the limiter shared by the run, creating it on first use
+def get_limiter():
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter(settings['rate'], settings['burst'], settings['initial_limit'],
+                                   settings['min_limit'], settings['max_limit'], settings['latency_factor'],
+                                   settings['cooldown'])
+        return _limiter
+
+
+class RateLimiter:
+    def __init__(self, rate, burst, initial_limit, min_limit, max_limit, latency_factor, cooldown):
+        self.rate = rate
+        self.burst = burst
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.limit = float(initial_limit)
+        self.in_flight = 0
+        metrics.request_limit.set(int(self.limit))
+        self.tokens = float(burst)
+        self.paused_until = 0.0
+        # Both by kind of request
+        self.base_latency = {}
+        self.smoothed_latency = {}
+        self._refilled = time.monotonic()
+        self._last_decrease = float('-inf')
+        self._condition = threading.Condition()
+
+    # Takes a token and a slot if a request can start now and returns 0, otherwise returns the seconds to wait,
+    # or None if it has to wait for a request in flight to finish. Called holding the condition.
+    def _try_acquire(self):
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self.tokens = min(self.burst, self.tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+        if self.in_flight >= int(self.limit):
+            return None
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        self.in_flight += 1
+        metrics.requests_in_flight.set(self.in_flight)
+        return 0
+
+    # Waits until a request can start. Every acquire must be followed by a release.
+    def acquire(self):
+        with self._condition:
+            wait = self._try_acquire()
+            while wait != 0:
+                self._condition.wait(wait)
+                wait = self._try_acquire()
+
+    # The same as acquire for a coroutine, checking again every poll_interval while all the slots are in use
+    async def acquire_async(self, poll_interval=0.02):
+        # Imported here as only the asyncio engine needs it
+        import asyncio
+        while True:
+            with self._condition:
+                wait = self._try_acquire()
+            if wait == 0:
+                return
+            await asyncio.sleep(poll_interval if wait is None else wait)
+
+    # Adjusts the limit for a response: status is its status code, or None if the request failed without one,
+    # latency the seconds to its headers, retry_after the seconds from any Retry-After header, and kind the
+    # kind of request (see get_request_kind)
+    def record(self, status, latency=None, retry_after=None, kind=None):
+        with self._condition:
+            now = time.monotonic()
+            if status is None or status >= 500 or status in settings['throttle_statuses']:
+                self._decrease(now, 'no response' if status is None else 'status {0}'.format(status))
+                if retry_after:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif latency is not None:
+                base = self.base_latency.get(kind)
+                if base is None or latency < base:
+                    base = latency
+                else:
+                    base += 0.001 * (latency - base)
+                self.base_latency[kind] = base
+                smoothed = self.smoothed_latency.get(kind)
+                if smoothed is None:
+                    smoothed = latency
+                else:
+                    smoothed += 0.1 * (latency - smoothed)
+                self.smoothed_latency[kind] = smoothed
+                if smoothed > self.latency_factor * max(base, settings['min_base_latency']):
+                    self._decrease(now, 'latency {0:.2f}s'.format(smoothed))
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            metrics.request_limit.set(int(self.limit))
+
+    def _decrease(self, now, reason):
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit / 2)
+        # Start measuring again, so the latency has to stay high for the limit to be cut again
+        self.smoothed_latency.clear()
+        logger.info('Overload ({0}), lowering the requests in flight to {1}'.format(reason, int(self.limit)))
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            metrics.requests_in_flight.set(self.in_flight)
+            self._condition.notify_all()
+
+
+# Seconds to wait before trying a throttled request again, for the number of tries so far
+def backoff_delay(tries, retry_after=None) -> float:
+    if retry_after:
+        return retry_after + random.uniform(0, settings['backoff_base'])
+    return random.uniform(0, min(settings['backoff_cap'], settings['backoff_base'] * 2 ** tries))
+
+
+# The kind of a request to the Proteins API, for comparing its latency only with those of the same kind:
+# the number of records asked for, eg 1 for the Stage 3 counts and -1 for the Stage 4 bundles of a family
+def get_request_kind(url):
+    return urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get('size', [None])[0]
+
+
+# The Retry-After header in seconds, given either as seconds or as a date, or None if there is none
+def get_retry_after(headers):
+    value = headers.get('Retry-After')
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,95 @@
+"""
+The annotations extracted from the reviewed records of each signature in Stage 4 are saved in a record
+store, so the analysis can be run again with other thresholds without fetching the records again.
+
+A record store is a text file with one line for each signature: the key, a tab and a JSON list of its
+records. Lines are only added, and when a key appears more than once (eg after resuming a run) the last
+line wins. Reading the store first finds the last line for each key, so that only the lines wanted are parsed.
+"""
+import os
+import json
+import threading
+import logging
+logger = logging.getLogger(__name__)
+
+
+class RecordStore:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.isfile(path):
+            remove_incomplete_line(path)
+        self._file = open(path, 'a')
+
+    def write(self, key, records: list):
+        self.write_json(key, dump_records(records))
+
+    # records_json is the records already encoded with dump_records, eg by an analysis process
+    def write_json(self, key, records_json: str):
+        line = '{0}\t{1}\n'.format(key, records_json)
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def dump_records(records: list) -> str:
+    return json.dumps(records, separators=(',', ':'))
+
+
+# Removes the end of the file after the last complete line, left if the last run was killed while writing it
+def remove_incomplete_line(path):
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        end = size
+        while end > 0:
+            start = max(end - 64 * 1024, 0)
+            f.seek(start)
+            newline = f.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        if end < size:
+            logger.warning('Removing an incomplete line from the end of {0}'.format(path))
+            f.truncate(end)
+
+
+def open_record_store(journal_dir, name='stage4_records'):
+    if journal_dir is None:
+        return None
+    os.makedirs(journal_dir, exist_ok=True)
+    return RecordStore(get_record_store_path(journal_dir, name))
+
+
+def get_record_store_path(journal_dir, name='stage4_records') -> str:
+    return os.path.join(journal_dir, name + '.tsv')
+
+
+# Returns a dictionary key: position of the last line for the key
+def index_record_store(path) -> dict:
+    positions = {}
+    with open(path, 'rb') as f:
+        position = f.tell()
+        for line in iter(f.readline, b''):
+            # The last line may be incomplete if the run was killed while writing it
+            if line.endswith(b'\n'):
+                key = line.split(b'\t', 1)[0].decode('utf-8')
+                positions[key] = position
+            position = f.tell()
+    return positions
+
+
+# Yields (key, records) for the keys given, or every key if keys is None, in the order of the file
+def read_record_store(path, keys=None):
+    positions = index_record_store(path)
+    if keys is not None:
+        keys = set(keys)
+        positions = {key: position for key, position in positions.items() if key in keys}
+    with open(path, 'rb') as f:
+        for position in sorted(positions.values()):
+            f.seek(position)
+            key, records = f.readline().decode('utf-8').split('\t', 1)
+            yield key, json.loads(records)
@@ -0,0 +1,79 @@
+"""
+Shared HTTP sessions for looking up data in the Proteins API.
+
+Each thread reuses its own requests.Session, so connections to the server are kept alive
+between calls instead of a new TLS connection being opened for every lookup. Sessions are
+not shared between threads because requests does not guarantee that a Session is thread safe.
+The sessions make no retries of their own. Connection errors and server errors are tried again with
+exponential backoff by utils.limited_get, which also tries again responses of 429 and 503 (the server is
+overloaded), so that each try goes through the shared rate limiter (see rate_limit) and is seen by it.
+"""
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import logging
+logger = logging.getLogger(__name__)
+
+# Default settings, changed with configure()
+settings = {'pool_connections': 4,      # Number of hosts to keep a connection pool for
+            'pool_maxsize': 4,          # Connections kept alive per host in each thread's pool
+            'max_retries': 5,
+            'backoff_factor': 1,        # Sleeps of 1, 2, 4, 8, 16 seconds between tries
+            'retry_statuses': (500, 502, 504),
+            'timeout': (10, 300)}       # Connect and read timeouts in seconds
+
+_local = threading.local()
+_lock = threading.Lock()
+_sessions = []
+
+
+def configure(**kwargs):
+    """
+    Change the session settings. Sessions already created keep the settings they were created with,
+    so this should be called before any lookups are made.
+    """
+    for key in kwargs:
+        if key not in settings:
+            raise ValueError('Unknown session setting: {0}'.format(key))
+    settings.update(kwargs)
+
+
+def create_session() -> requests.Session:
+    # No retries here, see utils.limited_get
+    adapter = HTTPAdapter(pool_connections=settings['pool_connections'],
+                          pool_maxsize=settings['pool_maxsize'],
+                          max_retries=0)
+    s = requests.Session()
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
+
+
+# Returns the session for the current thread, creating it on first use
+def get_session() -> requests.Session:
+    s = getattr(_local, 'session', None)
+    if s is None:
+        s = create_session()
+        _local.session = s
+        with _lock:
+            _sessions.append(s)
+    return s
+
+
+def get_timeout():
+    return settings['timeout']
+
+
+# Seconds to wait before trying a failed request again, for the number of tries so far
+def backoff_delay(tries) -> float:
+    return settings['backoff_factor'] * 2 ** (tries - 1)
+
+
+# Close the connection pools of every session created so far
+def close_sessions():
+    with _lock:
+        for s in _sessions:
+            s.close()
+        logger.debug('Closed {0} HTTP sessions'.format(len(_sessions)))
+        del _sessions[:]
+    _local.__dict__.pop('session', None)
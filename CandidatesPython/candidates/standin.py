@@ -0,0 +1,194 @@
+"""
+A local stand-in for the Proteins API, so the whole pipeline can be run offline, the engines can be
+load tested, and slow or failing servers can be reproduced.
+
+It answers the lookups the pipeline makes, InterPro:<id>?offset=<n>&size=<n>&reviewed=<true|false>, from
+a folder of recordings:
+- counts.tsv, with lines InterProId \\t reviewed_count \\t unreviewed_count (as in a CandidatesFilteredByHits
+  file), giving the x-pagination-totalrecords header of each lookup,
+- <InterProId>.json, the reviewed records of a signature as returned by the Proteins API, served a page
+  at a time. The reviewed count of a signature with records is always the number of records.
+A signature with no recordings has no hits, so it is dropped in Stage 3 as it would be by the real service.
+Unreviewed lookups are only used for their counts, so they are answered with an empty list.
+
+How the server behaves is set with the behaviour settings: a latency (with random jitter) before each
+response, a fraction of responses that fail with status 500, and a request rate above which requests are
+refused with 429 and a Retry-After header, as an overloaded server would.
+
+It can be run on its own for other processes to use, eg
+python -m candidates.standin test/testdata/input --port 8000 --latency 0.2 --throttle-rate 20
+or started in a thread of a run with --replay (see candidates_main).
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import logging
+logger = logging.getLogger(__name__)
+
+# Default behaviour, all of which can be changed for each server
+default_behaviour = {'latency': 0.0,            # Seconds before each response
+                     'latency_jitter': 0.0,     # Up to this many seconds more, at random
+                     'error_rate': 0.0,         # Fraction of responses that fail with status 500
+                     'throttle_rate': None,     # Requests a second above which requests are refused with 429
+                     'retry_after': 1,          # Seconds sent in the Retry-After header of a refused request
+                     'seed': None}              # For the random choices, so a run can be repeated
+
+api_path = '/proteins/api/proteins'
+
+
+class Recordings:
+    def __init__(self, recordings_dir):
+        self.recordings_dir = recordings_dir
+        # InterProId: (reviewed, unreviewed)
+        self.counts = {}
+        counts_path = os.path.join(recordings_dir, 'counts.tsv')
+        if os.path.isfile(counts_path):
+            for line in open(counts_path):
+                interpro, reviewed, unreviewed = line.rstrip('\n').split('\t')
+                self.counts[interpro] = (int(reviewed), int(unreviewed))
+        self._records = {}
+        self._lock = threading.Lock()
+
+    # The reviewed records of a signature, read from its file the first time they are asked for, or None
+    def get_records(self, interpro):
+        with self._lock:
+            if interpro not in self._records:
+                path = os.path.join(self.recordings_dir, interpro + '.json')
+                self._records[interpro] = json.load(open(path)) if os.path.isfile(path) else None
+            return self._records[interpro]
+
+    def get_count(self, interpro, reviewed: bool) -> int:
+        if reviewed:
+            records = self.get_records(interpro)
+            if records is not None:
+                return len(records)
+        return self.counts.get(interpro, (0, 0))[0 if reviewed else 1]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if not url.path.startswith(api_path + '/InterPro:'):
+            self.send_body(404, b'')
+            return
+        status = server.choose_status()
+        if status != 200:
+            headers = {'Retry-After': str(server.behaviour['retry_after'])} if status == 429 else {}
+            self.send_body(status, b'', headers)
+            return
+        interpro = url.path.split('InterPro:', 1)[1]
+        query = parse_qs(url.query)
+        reviewed = query.get('reviewed', ['true'])[0] == 'true'
+        offset = int(query.get('offset', ['0'])[0])
+        size = int(query.get('size', ['-1'])[0])
+        records = (server.recordings.get_records(interpro) if reviewed else None) or []
+        records = records[offset:] if size == -1 else records[offset:offset + size]
+        total = server.recordings.get_count(interpro, reviewed)
+        self.send_body(200, json.dumps(records).encode('utf-8'), {'x-pagination-totalrecords': str(total)})
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # Made from the recordings_dir, and can be replaced in a subclass to serve recordings kept another way
+    recordings_class = Recordings
+
+    def __init__(self, recordings_dir, host='127.0.0.1', port=0, **behaviour):
+        for key in behaviour:
+            if key not in default_behaviour:
+                raise ValueError('Unknown stand-in setting: {0}'.format(key))
+        self.behaviour = dict(default_behaviour)
+        self.behaviour.update(behaviour)
+        self.recordings = self.recordings_class(recordings_dir)
+        self.requests = 0
+        self._random = random.Random(self.behaviour['seed'])
+        self._lock = threading.Lock()
+        self._tokens = self.behaviour['throttle_rate']
+        self._refilled = time.monotonic()
+        self._thread = None
+        HTTPServer.__init__(self, (host, port), StandInHandler)
+
+    @property
+    def url(self) -> str:
+        return 'http://{0}:{1}{2}'.format(self.server_address[0], self.server_port, api_path)
+
+    # Waits for the latency and returns the status to answer with
+    def choose_status(self) -> int:
+        with self._lock:
+            self.requests += 1
+            delay = self.behaviour['latency'] + self._random.uniform(0, self.behaviour['latency_jitter'])
+            failed = self._random.random() < self.behaviour['error_rate']
+            throttled = False
+            rate = self.behaviour['throttle_rate']
+            if rate is not None:
+                now = time.monotonic()
+                self._tokens = min(max(rate, 1), self._tokens + (now - self._refilled) * rate)
+                self._refilled = now
+                throttled = self._tokens < 1
+                if not throttled:
+                    self._tokens -= 1
+        if delay > 0:
+            time.sleep(delay)
+        if throttled:
+            return 429
+        return 500 if failed else 200
+
+    # Serves requests in a background thread until stop is called
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info('Proteins API stand-in serving {0} at {1}'.format(self.recordings.recordings_dir, self.url))
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        logger.info('Proteins API stand-in answered {0} requests'.format(self.requests))
+
+
+def parse_arguments(argv):
+    parser = argparse.ArgumentParser(prog='candidates.standin', description='Local stand-in for the Proteins API')
+    parser.add_argument('recordings_dir', help='folder with counts.tsv and <InterProId>.json files')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, metavar='SECONDS')
+    parser.add_argument('--latency-jitter', type=float, default=0.0, metavar='SECONDS')
+    parser.add_argument('--error-rate', type=float, default=0.0, metavar='FRACTION')
+    parser.add_argument('--throttle-rate', type=float, metavar='N', help='requests a second before answering 429')
+    parser.add_argument('--retry-after', type=int, default=1, metavar='SECONDS')
+    parser.add_argument('--seed', type=int)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    args = parse_arguments(sys.argv[1:])
+    server = StandInServer(args.recordings_dir, args.host, args.port, latency=args.latency,
+                           latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate, retry_after=args.retry_after, seed=args.seed)
+    logger.info('Proteins API stand-in serving {0} at {1}'.format(args.recordings_dir, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,182 @@
+"""
+An optional asyncio engine for collecting the reviewed and unreviewed hit counts (Stage 3).
+
+All the requests run on one event loop, so thousands of lookups can be waiting on the server
+at the same time instead of being limited by the number of threads. The number of requests in
+flight is bounded by a semaphore, and the connector limits the connections opened to each host.
+Requests also go through the shared rate limiter (see rate_limit), which keeps the number actually
+sent at once to what the server can take.
+The same two phases are used as in count_candidate_hits.collect_counts: reviewed counts for every
+signature, then unreviewed counts only for those signatures with enough reviewed hits.
+
+This engine needs aiohttp, which is not installed with the other requirements.
+"""
+import time
+import asyncio
+import candidates.session as session
+import candidates.cache as cache
+import candidates.rate_limit as rate_limit
+import candidates.metrics as metrics
+import candidates.uniprot.count_candidate_hits as uniprotcounter
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# Default limits for the number of requests in flight at once and per host
+max_concurrency = 500
+max_per_host = 100
+
+
+def is_available() -> bool:
+    return aiohttp is not None
+
+
+# Returns a list of tuples (InterProId, reviewed_count, unreviewed_count) for the signatures passing both filters
+# Journals work as for count_candidate_hits.collect_counts
+def collect_counts(interpro_list: list, min_rev, min_unrev, reviewed_journal=None, unreviewed_journal=None,
+                   concurrency=max_concurrency, per_host=max_per_host) -> list:
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(collect_counts_async(interpro_list, min_rev, min_unrev, reviewed_journal,
+                                                            unreviewed_journal, concurrency, per_host))
+    finally:
+        loop.close()
+
+
+async def collect_counts_async(interpro_list: list, min_rev, min_unrev, reviewed_journal, unreviewed_journal,
+                               concurrency, per_host) -> list:
+    semaphore = asyncio.BoundedSemaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=per_host)
+    connect_timeout, read_timeout = session.get_timeout()
+    timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as client:
+        logger.info('Collecting reviewed hits from {0} InterPro ids with up to {1} requests in flight'.format(
+                                                                                len(interpro_list), concurrency))
+        reviewed_results_dict = await get_counts(client, semaphore, interpro_list, True, reviewed_journal)
+        filtered_interpro_list = [x for x in interpro_list
+                                  if x in reviewed_results_dict and reviewed_results_dict[x] >= min_rev]
+
+        logger.info('Collecting unreviewed hits from {0} InterPro ids with up to {1} requests in flight'.format(
+                                                                       len(filtered_interpro_list), concurrency))
+        unreviewed_results_dict = await get_counts(client, semaphore, filtered_interpro_list, False,
+                                                   unreviewed_journal)
+
+    final_interpro_hits_list = []
+    for ipr in filtered_interpro_list:
+        if ipr in unreviewed_results_dict and unreviewed_results_dict[ipr] >= min_unrev:
+            final_interpro_hits_list.append((ipr, reviewed_results_dict[ipr], unreviewed_results_dict[ipr]))
+    return final_interpro_hits_list
+
+
+# Counts already in the journal are reused, and failed counts are tried again once all the others are done
+async def get_counts(client, semaphore, id_list: list, isreviewed: bool, count_journal=None) -> dict:
+    results = {}
+    todo = []
+    for ipr in id_list:
+        if count_journal is not None and ipr in count_journal.completed:
+            results[ipr] = count_journal.completed[ipr]
+        else:
+            todo.append(ipr)
+
+    # Write each count to the journal as soon as it arrives
+    # The counts not yet finished and those finished are kept in the metrics, as for utils.run_work_queue
+    description = '{0} counts'.format('reviewed' if isreviewed else 'unreviewed')
+    waiting = metrics.queue_items.labels(description)
+
+    async def count_and_record(ipr):
+        try:
+            count = await get_count(client, semaphore, ipr, isreviewed)
+        except Exception as e:
+            metrics.items_total.labels(description, 'failed').inc()
+            if count_journal is not None:
+                count_journal.record_failure(ipr, str(e))
+            raise
+        finally:
+            waiting.dec()
+        metrics.items_total.labels(description, 'done').inc()
+        if count_journal is not None:
+            count_journal.record(ipr, count)
+        return count
+
+    for attempt in ('first', 'last'):
+        if not todo:
+            break
+        if attempt == 'last':
+            logger.warning('Trying {0} failed counts again'.format(len(todo)))
+        waiting.set(len(todo))
+        counts = await asyncio.gather(*[count_and_record(ipr) for ipr in todo], return_exceptions=True)
+        failed = []
+        for ipr, count in zip(todo, counts):
+            if isinstance(count, Exception):
+                failed.append(ipr)
+            else:
+                results[ipr] = count
+        todo = failed
+
+    for ipr in todo:
+        logger.error('Gave up collecting {0}, it will be tried again if the run is resumed'.format(ipr))
+    return results
+
+
+# Retries follow the same settings as the sessions used by the threaded engine, and throttled requests
+# (429 or 503) are tried again as in utils.limited_get
+async def get_count(client, semaphore, ip: str, isreviewed: bool) -> int:
+    url = uniprotcounter.get_count_url(ip, isreviewed)
+    response_cache = cache.get_cache()
+    if response_cache is not None:
+        cached = response_cache.get(url, uniprotcounter.count_headers)
+        if cached is not None:
+            return int(cached.headers['x-pagination-totalrecords'])
+    limiter = rate_limit.get_limiter()
+    kind = rate_limit.get_request_kind(url)
+    max_tries = session.settings['max_retries'] + 1
+    max_throttled = rate_limit.settings['max_throttle_retries']
+    tries = throttled = 0
+    while True:
+        async with semaphore:
+            await limiter.acquire_async()
+            start = time.monotonic()
+            try:
+                async with client.get(url, headers=uniprotcounter.count_headers) as r:
+                    retry_after = rate_limit.get_retry_after(r.headers)
+                    limiter.record(r.status, time.monotonic() - start, retry_after, kind)
+                    content = await r.read()
+                    metrics.record_request(r.status, time.monotonic() - start, len(content))
+                    if r.status == 200:
+                        if response_cache is not None:
+                            # Writing to the cache blocks, so it is done in a thread rather than in the event loop
+                            await asyncio.get_running_loop().run_in_executor(
+                                None, response_cache.put, url, uniprotcounter.count_headers, r.status,
+                                dict(r.headers), content)
+                        return int(r.headers['x-pagination-totalrecords'])
+                    elif r.status in rate_limit.settings['throttle_statuses'] and throttled < max_throttled:
+                        throttled += 1
+                        metrics.record_retry('throttled')
+                        delay = rate_limit.backoff_delay(throttled, retry_after)
+                        logger.warning('Status {0}. Trying again in {1:.1f} seconds ({2}/{3}) for {4}'.format(
+                                                                    r.status, delay, throttled, max_throttled, url))
+                    elif r.status in session.settings['retry_statuses'] and tries + 1 < max_tries:
+                        tries += 1
+                        metrics.record_retry('error')
+                        delay = retry_after or session.backoff_delay(tries)
+                        logger.error('Status {0}. Try {1}/{2} for {3}'.format(r.status, tries, max_tries, url))
+                    else:
+                        r.raise_for_status()
+                        raise Exception('Completely failed to access {0}'.format(url))
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                tries += 1
+                limiter.record(None, kind=kind)
+                metrics.record_request(None)
+                logger.error('{0}. Try {1}/{2} for {3}'.format(type(e).__name__, tries, max_tries, url))
+                if tries >= max_tries:
+                    raise Exception('Completely failed to access {0}'.format(url))
+                metrics.record_retry('error')
+                delay = session.backoff_delay(tries)
+            finally:
+                limiter.release()
+        # Sleep outside the semaphore so waiting requests do not block others
+        await asyncio.sleep(delay)
@@ -24,12 +24,19 @@ Eukaryota Metazoa	SPKW	115	114	Signal
 Eukaryota Metazoa	SPKW	115	114	Transport
 
 """
-import concurrent.futures
-import sys
 import json
+import time
+import contextlib
+import threading
+import multiprocessing
+import concurrent.futures
 import candidates.utils as utils
-from copy import deepcopy
-import traceback
+import candidates.journal as journal
+import candidates.lineage as lineage
+import candidates.record_store as record_store
+import candidates.output as output
+import candidates.metrics as metrics
+import candidates.profiling as profiling
 import logging
 logger = logging.getLogger(__name__)
 
@@ -41,175 +48,512 @@ annotation_string_types = ['accession', 'DERF',  'GNNM']
 
 excluded_keywords = ['Complete proteome', ]
 
-
-def collect_candidates_on_main_thread(signature_with_counts_list: list, outfilepath: str):
-    n = len(signature_with_counts_list)
-    logger.info('Starting to collect candidate rules from {0} InterPro signatures on main thread'.format(n))
-
-    outfile = open(outfilepath, 'w')
-    outfile.write('# Columns: TaxonomicGroup / AnnotationCode / Total / Consistent / AnnotationText\n')
-    count = 0
-    for signature_line in signature_with_counts_list:
-        signature, reviewed, unreviewed = signature_line.split('\t')
-        count += 1
-        if count % 20 == 0:
-            logger.info('Data collected for {0} candidate signatures'.format(count))
-        # this gets a single json object containing several uniprot records
-        jsonrecords = get_reviewed_uniprot_jsons_from_interpro_id(signature)
-        # update the reviewed count read in to signature_with_counts_list from infilepath
-        reviewed = len(jsonrecords)
-        taxonomy_groups = group_records_by_taxonomy_from_json(jsonrecords)
-        text = '\n# {0}  Reviewed: {1}  Unreviewed: {2}'.format(signature, reviewed, unreviewed)
-        outfile.write(text + '\n')
-        for taxon in taxonomy_groups:
-            annotation_collection = get_json_data_grouped_by_annotations(taxonomy_groups[taxon])
-            consistent_annotations = get_consistent_annotations(annotation_collection)
-            get_taxonomy_annotation_collection(taxon, consistent_annotations, outfile)
-
-    outfile.close()
-    logger.info('Data collected for {0} candidate signatures'.format(count))
-
-
-def collect_candidates_with_threads(infile_path: str, outfile_path: str):
+# Annotations are tested for consistency in this order, single terms first
+consistency_string_types = ['DERF', 'GNNM']
+consistency_list_types = ['DERS', 'DEEC', 'DEAF', 'CCFU', 'CCLO', 'CCPA', 'CCSI', 'CCSU', 'SPKW', 'CCCO', 'CCCA']
+# Annotations found in at least this fraction of the records in a taxonomic group are consistent
+consistency_cutoff = 0.9
+
+# Records are grouped by the first two taxa of their lineage, eg 'Eukaryota Metazoa', unless other depths are given
+default_taxonomy_depths = (2,)
+# Shared by all the threads so each lineage is only added once in a run
+lineage_index = lineage.LineageIndex()
+
+# How the records are grouped and tested for consistency
+# engine is either 'python' or 'numpy' (which needs numpy to be installed)
+# taxonomy_depths are the depths of lineage the records are grouped at, and consistency is tested at each of them
+default_analysis = {'engine': 'python',
+                    'taxonomy_depths': default_taxonomy_depths,
+                    'cutoff': consistency_cutoff}
+
+# Families with more reviewed records than page_size are fetched in pages of this many records
+page_size = 100
+# Threads shared by all families for fetching pages, and how many pages of one family are fetched ahead
+page_threads = 16
+pages_ahead = 4
+# Processes for parsing and analysing the records, 0 for none (see AnalysisPool)
+default_processes = 0
+
+_page_executor = None
+_page_executor_lock = threading.Lock()
+
+
+class PagesChanged(Exception):
+    pass
+
+
+# Runs the parsing, extraction and analysis of the records in separate processes, so they are not held up by the
+# GIL of the fetching threads, which only read the raw responses. At most max_waiting families are handed over
+# at once, and a thread with another one to hand over waits until one is finished, so the fetching threads cannot
+# get far ahead of the analysis and the responses held in memory are limited.
+class AnalysisPool:
+    def __init__(self, processes: int, max_waiting=None):
+        self.processes = processes
+        # Start new processes rather than forking, as the fetching threads are already running
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=processes,
+                                                                mp_context=multiprocessing.get_context('spawn'))
+        self._slots = threading.BoundedSemaphore(max_waiting or 2 * processes)
+
+    # Returns the result of analyse_bodies run in one of the processes
+    def analyse(self, bodies: list, analysis=None, keep_records=False) -> tuple:
+        with self._slots:
+            metrics.analysis_waiting.inc()
+            try:
+                if not profiling.is_active():
+                    return self._executor.submit(analyse_bodies, bodies, analysis, keep_records).result()
+                # The process samples itself and sends back where its time went with the result
+                result, stacks = self._executor.submit(profiling.run_profiled, profiling.get_interval(),
+                                                       analyse_bodies, bodies, analysis, keep_records).result()
+                profiling.add_process_stacks(stacks)
+                return result
+            finally:
+                metrics.analysis_waiting.dec()
+
+    def close(self):
+        self._executor.shutdown()
+
+
+# Each signature is added to the output file as soon as it is finished (see output.CandidateWriter).
+# If a journal_dir is given the signatures finished are recorded there, and signatures already finished
+# are not collected again. The extracted records are saved there too, so they can be analysed again by
+# reanalyse_candidates.
+# The records are parsed and analysed in the threads that fetch them if processes is 0, and in a pool of that
+# many processes if it is more (see AnalysisPool). None means default_processes, which is 0.
+# analysis holds any settings to change from default_analysis
+# carry_forward is a tuple (records_path, signatures) of signatures whose records are read from the record store
+# of an earlier run at records_path rather than looked up again, as in an incremental run
+def collect_candidates_with_threads(infile_path: str, outfile_path: str, journal_dir=None, processes=None,
+                                    analysis=None, carry_forward=None):
     sig_with_counts_strings = [line.rstrip() for line in open(infile_path)]
     list_length = len(sig_with_counts_strings)
     thread_count = utils.calculate_thread_count(len(sig_with_counts_strings))
-    if thread_count == 1:
-        collect_candidates_on_main_thread(sig_with_counts_strings, outfile_path)
-        return
+    if processes is None:
+        processes = default_processes
+    analysis = get_analysis_settings(analysis)
+    logger.info('Collecting data for {0} InterPro candidates using {1} threads and {2} processes'.format(
+                                                                          list_length, thread_count, processes))
+
+    # Start with the families that have the most reviewed records so that a large family
+    # is not left running on its own at the end of the run
+    largest_first = sorted(sig_with_counts_strings, key=lambda x: int(x.split('\t')[1]), reverse=True)
+    writer = output.CandidateWriter(outfile_path)
+    candidate_journal = journal.open_journal(journal_dir, 'stage4_candidates')
+    if candidate_journal is not None:
+        # Collect again any signature whose lines did not reach the output before the run stopped
+        for signature in list(candidate_journal.completed):
+            if signature not in writer.blocks:
+                del candidate_journal.completed[signature]
+    records_out = record_store.open_record_store(journal_dir)
+    if carry_forward is not None:
+        records_path, carried = carry_forward
+        carried = set(carried)
+        carried_counts = {}
+        for data in sig_with_counts_strings:
+            signature, reviewed, unreviewed = data.split('\t')
+            # Signatures carried forward before the run stopped are already in the output
+            if signature in carried and signature not in writer.blocks:
+                carried_counts[signature] = unreviewed
+        write_saved_candidates(records_path, carried_counts, writer, analysis, records_out)
+        # Any signature with no saved records is looked up after all
+        carried.intersection_update(writer.blocks)
+        largest_first = [data for data in largest_first if data.split('\t')[0] not in carried]
+        logger.info('Carried forward {0} InterPro candidates from {1}'.format(len(carried), records_path))
+    analysis_pool = AnalysisPool(processes) if processes > 0 else None
+
+    # Only the updated key is kept for each signature, the lines go straight to the output
+    def worker(data, thread_id):
+        updated_key, lines = collect_candidate(data, thread_id, analysis_pool, analysis, records_out)
+        writer.write(updated_key, lines)
+        return updated_key
+
+    try:
+        journal.run_with_journal(worker, largest_first, thread_count, candidate_journal,
+                                 key=lambda x: x.split('\t')[0], description='candidate signatures')
+    finally:
+        if analysis_pool is not None:
+            analysis_pool.close()
+        close_page_executor()
+        writer.close()
+        for f in (candidate_journal, records_out):
+            if f is not None:
+                f.close()
+    writer.finish()
+
+
+# Runs the analysis again on the records saved in a record store by collect_candidates_with_threads,
+# for the signatures in infile_path, which can have been filtered with other thresholds since.
+# Signatures with no saved records, eg those that did not pass the thresholds of the earlier run, are left out.
+def reanalyse_candidates(infile_path: str, outfile_path: str, records_path: str, analysis=None):
+    analysis = get_analysis_settings(analysis)
+    unreviewed_counts = {}
+    for line in open(infile_path):
+        signature, reviewed, unreviewed = line.rstrip().split('\t')
+        unreviewed_counts[signature] = unreviewed
+    logger.info('Analysing the saved records of {0} InterPro candidates'.format(len(unreviewed_counts)))
+
+    writer = output.CandidateWriter(outfile_path)
+    write_saved_candidates(records_path, unreviewed_counts, writer, analysis)
+    missing = len(unreviewed_counts) - len(writer.blocks)
+    if missing:
+        logger.warning('No saved records for {0} InterPro candidates, these are left out'.format(missing))
+    writer.finish()
+
+
+# Analyses the records saved at records_path for the signatures in unreviewed_counts (signature: unreviewed count)
+# and adds their lines to the writer. The records are also saved to the records_out store if one is given.
+def write_saved_candidates(records_path: str, unreviewed_counts: dict, writer, analysis, records_out=None):
+    index = lineage.LineageIndex()
+    for signature, stored_records in record_store.read_record_store(records_path, unreviewed_counts):
+        if records_out is not None:
+            records_out.write(signature, stored_records)
+        strings = {}
+        terms = new_terms(analysis)
+        records = [AnnotationRecord.from_list(item, strings, index, terms) for item in stored_records]
+        taxonomy_groups = group_records_by_taxonomy(records, analysis['taxonomy_depths'], index)
+        updated_key = '{0}\t{1}\t{2}'.format(signature, len(records), unreviewed_counts[signature])
+        writer.write(updated_key, analyse_taxonomy_groups(taxonomy_groups, analysis, terms))
+
+
+# A dictionary to number the annotations of a family in as they are read, if the engine uses them
+def new_terms(analysis):
+    return {} if analysis['engine'] == 'numpy' else None
+
+
+# Fills in the settings not given from default_analysis
+def get_analysis_settings(analysis=None) -> dict:
+    settings = dict(default_analysis)
+    if analysis is not None:
+        settings.update(analysis)
+    if settings['engine'] == 'numpy':
+        # Imported here as the engine is optional and numpy may not be installed
+        import candidates.uniprot.numpy_consistency as numpy_consistency
+        if not numpy_consistency.is_available():
+            logger.warning('The numpy engine needs numpy to be installed, so python will be used instead')
+            settings['engine'] = 'python'
+    return settings
+
+
+# data is a string Interpro_id \t reviewed_count \t unreviewed_count
+# Returns a tuple of the updated data string and the candidate text lines for the signature
+# The records are parsed and analysed in the analysis_pool if one is given, and saved to the records_out store
+# if one is given. The time taken is recorded for profiling, see profiling.record_signature
+def collect_candidate(data: str, thread_id=1, analysis_pool=None, analysis=None, records_out=None) -> tuple:
+    if analysis is None:
+        analysis = default_analysis
+    start = time.perf_counter()
+    signature, reviewed, unreviewed = data.split('\t')
+    terms = new_terms(analysis) if analysis_pool is None else None
+    # large families are fetched in pages planned from the reviewed count found in Stage 3
+    try:
+        fetched = fetch_reviewed_records(signature, thread_id, int(reviewed), analysis_pool is None, terms)
+    except PagesChanged as e:
+        logger.warning('Thread {0}. {1}, fetching {2} again in one request'.format(thread_id, e, signature))
+        fetched = fetch_reviewed_records(signature, thread_id, None, analysis_pool is None, terms)
+    if analysis_pool is None:
+        records = fetched
+        record_count = len(records)
+        if records_out is not None:
+            records_out.write(signature, [record.to_list() for record in records])
+        taxonomy_groups = group_records_by_taxonomy(records, analysis['taxonomy_depths'])
+        analysis_start = time.perf_counter()
+        lines = analyse_taxonomy_groups(taxonomy_groups, analysis, terms)
     else:
-        logger.info('Collecting data for {0} InterPro candidates using {1} threads'.format(list_length, thread_count))
-
-    params = get_candidate_parameters_for_executor_map(thread_count, sig_with_counts_strings)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(params)) as executor:
-        results = executor.map(collect_batch_of_candidates, params)
-        # Candidate is returned from each thread as a dictionary ipr: candidate_text_lines
-        # all_results is a list of dictionaries
-        all_results = list(results)
-    # Merge the results
-    all_results_dict = all_results[0]
-    for i in range(1, len(all_results)):
-        all_results_dict.update(all_results[i])
-
-    outfile = open(outfile_path, 'w')
-    outfile.write('# Columns: TaxonomicGroup / AnnotationCode / Total / Consistent / AnnotationText\n')
-    # IPR000030  Reviewed: 96  Unreviewed: 13114
-
-    # May as well sort on the keys!
-    for key in sorted(all_results_dict):
-        interpro, reviewed, unreviewed = key.split('\t')
-        text = '\n# {0}  Reviewed:  {1}  Unreviewed:  {2}\n'.format(interpro, reviewed, unreviewed)
-        outfile.write(text)
-        outfile.write('\n'.join(all_results_dict[key]) + '\n')
-    outfile.close()
-    logger.info('Collected candidate data for {0} candidate signatures'.format(len(all_results_dict)))
-
-
-# string_list is list of (InterProId \t rev \t unrev)
-def get_candidate_parameters_for_executor_map(threads: int, string_list: list) -> list:
-    parameter_list = []
-    for split in utils.calculate_split_positions(len(string_list), threads):
-        thread_id, start, end = split
-        parameter_list.append((thread_id, string_list[start:end]))
-    return parameter_list
-
-
-# input_data is thread_id, and list of strings Interpro_id \t reviewed_count \t unreviewed_count
-def collect_batch_of_candidates(input_data: tuple) -> dict:
-    thread_id, interpro_data_list = input_data
-    if thread_id == 1:
-        logger.info('Thread {0} has started collecting {1} candidates'.format(thread_id, len(interpro_data_list)))
-    result_dict = {}
-    count = 0
-    for data in interpro_data_list:
-        signature, reviewed, unreviewed = data.split('\t')
-        count += 1
-        if thread_id == 1 and count % 5 == 0:
-            logger.info('Thread {0} collected data for {1} candidate signatures'.format(thread_id, count))
-        # this gets a single json object containing several uniprot records
-        jsonrecords = get_reviewed_uniprot_jsons_from_interpro_id(signature, thread_id)
-        # update the reviewed count in case there is an update in the database
-        reviewed = len(jsonrecords)
-        updated_key = '{0}\t{1}\t{2}'.format(signature, reviewed, unreviewed)
-        all_tax_data = []
-        taxonomy_groups = group_records_by_taxonomy_from_json(jsonrecords)
-        for taxon in taxonomy_groups:
-            annotation_collection = get_json_data_grouped_by_annotations(taxonomy_groups[taxon])
-            consistent_annotations = get_consistent_annotations(annotation_collection)
-            candidate_data = get_taxonomy_annotation_collection(taxon, consistent_annotations)
-            all_tax_data.extend(candidate_data)
-        result_dict[updated_key] = all_tax_data
-    if thread_id == 1:
-        logger.info('Thread {0} has finished collecting data for {1} candidates '
-                        'out of {2}'.format(thread_id, count, len(interpro_data_list)))
-    return result_dict
+        # Only the fetching is done in this thread, the parsing is part of the analysis in the process
+        analysis_start = time.perf_counter()
+        lines, record_count, records_json = analysis_pool.analyse(fetched, analysis, records_out is not None)
+        if records_out is not None:
+            records_out.write_json(signature, records_json)
+    metrics.records_parsed.inc(record_count)
+    # update the reviewed count in case there is an update in the database
+    updated_key = '{0}\t{1}\t{2}'.format(signature, record_count, unreviewed)
+    end = time.perf_counter()
+    profiling.record_signature(signature, end - start, record_count, analysis_start - start, end - analysis_start)
+    return updated_key, lines
+
+
+# The reviewed records of a family as annotation records, read one at a time from the response as it arrives and
+# only keeping their annotations, or if parse is False the raw responses for analyse_bodies
+# terms is passed on to extract_records
+def fetch_reviewed_records(signature: str, thread_id=1, total=None, parse=True, terms=None) -> list:
+    if parse:
+        # Closed here, as a record that fails to be extracted would otherwise leave the response open
+        with contextlib.closing(iter_reviewed_uniprot_jsons_from_interpro_id(signature, thread_id, total)) as items:
+            return extract_records(items, terms=terms)
+    return get_reviewed_uniprot_bodies(signature, thread_id, total)
+
+
+# Run in an analysis process on the raw responses holding the records of one family (see
+# get_reviewed_uniprot_bodies): parses them, extracts and groups the records and tests them for consistency.
+# Returns a tuple of the candidate text lines, the number of records and, if keep_records, the records encoded
+# for the record store (see record_store.dump_records), otherwise None
+def analyse_bodies(bodies: list, analysis=None, keep_records=False) -> tuple:
+    if analysis is None:
+        analysis = default_analysis
+    terms = new_terms(analysis)
+    records = extract_records((record for body in bodies for record in json.loads(body)), terms=terms)
+    records_json = None
+    if keep_records:
+        records_json = record_store.dump_records([record.to_list() for record in records])
+    taxonomy_groups = group_records_by_taxonomy(records, analysis['taxonomy_depths'])
+    return analyse_taxonomy_groups(taxonomy_groups, analysis, terms), len(records), records_json
+
+
+# The candidate text lines for the records of one signature grouped by taxonomy
+# terms is the dictionary the annotations of the records were numbered in, if any, which the numpy engine uses
+def analyse_taxonomy_groups(taxonomy_groups: dict, analysis=None, terms=None) -> list:
+    if analysis is None:
+        analysis = default_analysis
+    if analysis['engine'] == 'numpy':
+        import candidates.uniprot.numpy_consistency as numpy_consistency
+        return numpy_consistency.analyse_taxonomy_groups(taxonomy_groups, analysis['cutoff'], terms)
+    all_tax_data = []
+    for taxon in taxonomy_groups:
+        annotation_counts = count_annotations(taxonomy_groups[taxon])
+        consistent_annotations = get_consistent_annotations(annotation_counts, analysis['cutoff'])
+        candidate_data = get_taxonomy_annotation_collection(taxon, consistent_annotations)
+        all_tax_data.extend(candidate_data)
+    return all_tax_data
 
 
 # Result is a json object containing several records
-# Errors are handled by the get_url_with_retry method
+# Errors are raised by the get_url_with_retry method
 # Default thread_id of 1 in case called on main thread
 def get_reviewed_uniprot_jsons_from_interpro_id(interpro: str, thread_id=1) -> json:
-    url = 'https://www.ebi.ac.uk/proteins/api/proteins/InterPro:{0}?offset=0&size=-1&reviewed=true'.format(interpro)
+    url = '{0}/InterPro:{1}?offset=0&size=-1&reviewed=true'.format(utils.proteins_api_url, interpro)
     headers = {"Accept": "application/json"}
-    try:
-        r = utils.get_url_with_retry(url, headers, thread_id)
-    except Exception as e:
-        logger.error(str(e))
-        logger.error('Giving up analysis.')
-        sys.exit(0)
+    r = utils.get_url_with_retry(url, headers, thread_id)
     return json.loads(r.text)
 
 
-# Structure of annotations is a dictionary with either single terms or a list of terms
-def extract_annotations(record_json):
-    # Add placeholders for all the possible keys
-    record = {}
-    for a in annotation_list_types:
-        record[a] = []
-    for a in annotation_string_types:
-        record[a] = ''
+# The same records as get_reviewed_uniprot_jsons_from_interpro_id, but parsed one at a time from the response
+# as it arrives, so the whole response is never held in memory.
+# If the number of records is given and is more than page_size, the records are fetched in pages instead.
+# Closing the iterator closes the response at once, eg when the records are not all read.
+def iter_reviewed_uniprot_jsons_from_interpro_id(interpro: str, thread_id=1, total=None):
+    if total is not None and total > page_size:
+        return iter_reviewed_uniprot_json_pages(interpro, total, thread_id)
+    url = '{0}/InterPro:{1}?offset=0&size=-1&reviewed=true'.format(utils.proteins_api_url, interpro)
+    headers = {"Accept": "application/json"}
+    return utils.stream_json_array(url, headers, thread_id)
+
+
+# The same records as iter_reviewed_uniprot_jsons_from_interpro_id, as the raw bodies of the responses (one for
+# each page if the records are fetched in pages), each a json array of records
+def get_reviewed_uniprot_bodies(interpro: str, thread_id=1, total=None) -> list:
+    if total is not None and total > page_size:
+        return list(iter_reviewed_uniprot_json_pages(interpro, total, thread_id, parse=False))
+    url = '{0}/InterPro:{1}?offset=0&size=-1&reviewed=true'.format(utils.proteins_api_url, interpro)
+    headers = {"Accept": "application/json"}
+    return [b''.join(utils.stream_url_with_retry(url, headers, thread_id))]
+
+
+# Yields the records of a family from pages of page_size records, in the same order as the single request.
+# The pages are fetched on the shared page threads, up to pages_ahead in front of the page being read,
+# and a page that fails is tried once more on its own before giving up.
+# Each page reports the current number of records, and PagesChanged is raised if that is not the total the
+# pages were planned from, as the pages would no longer line up with each other.
+# If parse is False the raw body of each page is yielded rather than its records.
+def iter_reviewed_uniprot_json_pages(interpro: str, total: int, thread_id=1, parse=True):
+    offsets = list(range(0, total, page_size))
+    executor = get_page_executor()
+    futures = {}
+
+    def submit(offset):
+        futures[offset] = executor.submit(get_reviewed_uniprot_json_page, interpro, offset, thread_id, parse)
+
+    try:
+        for offset in offsets[:pages_ahead]:
+            submit(offset)
+        for i, offset in enumerate(offsets):
+            if i + pages_ahead < len(offsets):
+                submit(offsets[i + pages_ahead])
+            try:
+                records, page_total = futures.pop(offset).result()
+            except Exception as e:
+                logger.warning('Thread {0}. Trying page at offset {1} of {2} again: {3}'.format(
+                                                                                    thread_id, offset, interpro, e))
+                submit(offset)
+                records, page_total = futures.pop(offset).result()
+            if page_total != total:
+                raise PagesChanged('{0} has {1} reviewed records rather than {2}'.format(interpro, page_total, total))
+            if not parse:
+                yield records
+                continue
+            for record in records:
+                yield record
+    finally:
+        for future in futures.values():
+            future.cancel()
+
+
+# Returns a tuple of the records in one page, or its raw body if parse is False, and the total number of records
+# reported with it
+def get_reviewed_uniprot_json_page(interpro: str, offset: int, thread_id=1, parse=True) -> tuple:
+    url = '{0}/InterPro:{1}?offset={2}&size={3}&reviewed=true'.format(utils.proteins_api_url, interpro,
+                                                                        offset, page_size)
+    headers = {"Accept": "application/json"}
+    r = utils.get_url_with_retry(url, headers, thread_id)
+    return json.loads(r.text) if parse else r.content, int(r.headers['x-pagination-totalrecords'])
+
+
+def get_page_executor() -> concurrent.futures.ThreadPoolExecutor:
+    global _page_executor
+    with _page_executor_lock:
+        if _page_executor is None:
+            _page_executor = concurrent.futures.ThreadPoolExecutor(max_workers=page_threads)
+        return _page_executor
+
+
+def close_page_executor():
+    global _page_executor
+    with _page_executor_lock:
+        if _page_executor is not None:
+            _page_executor.shutdown()
+            _page_executor = None
+
+
+# What an annotation a record does not have reads as
+missing_annotations = dict([(atype, '') for atype in annotation_string_types] +
+                           [(atype, ()) for atype in annotation_list_types])
+_no_default = object()
+
+
+# The annotations of one reviewed record. Only the annotations the record has are set, the others read as
+# empty, and lists of terms are kept as tuples. Records can be read as the dictionaries they replaced, eg
+# record['DERF'] or record['SPKW'].
+# If the record was read with a terms dictionary, term_ids holds the number of each of its annotations there (see
+# extract_annotations), for the numpy engine.
+class AnnotationRecord:
+    __slots__ = ['accession', 'SPOC', 'lineage_node', 'DERF', 'GNNM', 'DERS', 'DEEC', 'DEAF',
+                 'CCCA', 'CCCO', 'CCFU', 'CCLO', 'CCPA', 'CCSI', 'CCSU', 'SPKW', 'term_ids']
+
+    def __init__(self, accession, lineage_node, annotations, index=None, term_ids=None):
+        self.accession = accession
+        self.lineage_node = lineage_node
+        if index is None:
+            index = lineage_index
+        self.SPOC = index.lineages[lineage_node]
+        for atype, value in annotations.items():
+            setattr(self, atype, value)
+        if term_ids is not None:
+            self.term_ids = term_ids
+
+    def __getitem__(self, key):
+        default = missing_annotations.get(key, _no_default)
+        value = getattr(self, key, default)
+        if value is _no_default:
+            raise KeyError(key)
+        return value
+
+    # The record as a list [accession, lineage, {annotation type: annotations}] that can be saved as json
+    def to_list(self) -> list:
+        annotations = {}
+        for atype in consistency_string_types + consistency_list_types:
+            if hasattr(self, atype):
+                annotations[atype] = getattr(self, atype)
+        return [self.accession, self.SPOC, annotations]
+
+    @classmethod
+    def from_list(cls, item, strings=None, index=None, terms=None):
+        if strings is None:
+            strings = {}
+        if index is None:
+            index = lineage_index
+        accession, lineage_names, stored = item
+        annotations = {}
+        for atype, value in stored.items():
+            if atype in annotation_list_types:
+                value = tuple(strings.setdefault(v, v) for v in value)
+            annotations[atype] = strings.setdefault(value, value)
+        term_ids = None
+        if terms is not None:
+            term_ids = []
+            for atype, value in annotations.items():
+                for annotation in (value,) if atype in annotation_string_types else value:
+                    if annotation != '':
+                        term_ids.append(get_term_id(terms, atype, annotation))
+            term_ids = tuple(term_ids)
+        return cls(accession, index.add(lineage_names), annotations, index, term_ids)
+
+
+# strings is a dictionary shared by the records of one family so each annotation text and tuple of terms
+# is held once rather than once per record. The lineage is added to the lineage index, by default the shared one.
+# If terms is given, a dictionary shared by the records of one family, each annotation is numbered there as it is
+# read and the numbers kept as the term_ids of the record, so the numpy engine does not have to read the
+# annotations again.
+def extract_annotations(record_json, strings=None, index=None, terms=None) -> AnnotationRecord:
+    if strings is None:
+        strings = {}
+    annotations = {}
+    term_ids = [] if terms is not None else None
+
+    def add(atype, value):
+        value = strings.setdefault(value, value)
+        if term_ids is not None and value != '':
+            term_ids.append(get_term_id(terms, atype, value))
+        if atype in annotation_string_types:
+            annotations[atype] = value
+        elif atype in annotations:
+            annotations[atype].append(value)
+        else:
+            annotations[atype] = [value]
 
-    record['accession'] = record_json['accession']
-    record['SPOC'] = record_json['organism']['lineage']
     protein = record_json['protein']
     if 'recommendedName' in protein:
         recnames = protein['recommendedName']
-        record['DERF'] = recnames['fullName']['value']
+        add('DERF', recnames['fullName']['value'])
         if 'shortName' in recnames:
             for s in recnames['shortName']:
-                record['DERS'].append(s['value'])
+                add('DERS', s['value'])
 
         if 'ecNumber' in recnames:
             for ec in recnames['ecNumber']:
-                record['DEEC'].append(ec['value'])
+                add('DEEC', ec['value'])
 
     if 'alternativeName' in protein:
         altnames = record_json['protein']['alternativeName']
         for alt in altnames:
-            record['DEAF'].append(alt['fullName']['value'])
+            add('DEAF', alt['fullName']['value'])
 
     # only one gene name collected
     if 'gene' in record_json:
         if 'name' in record_json['gene'][0]:
-            record['GNNM'] = record_json['gene'][0]['name']['value']
+            add('GNNM', record_json['gene'][0]['name']['value'])
 
     if 'comments' in record_json:
         try:
-            collect_comments(record, record_json['comments'])
-        except:
-            logger.error('Failed extracting Comments from {0}'.format(record_json['accession']))
-            traceback.print_exc(file=sys.stdout)
-            sys.exit(0)
+            collect_comments(add, record_json['comments'])
+        except Exception as e:
+            # An ordinary exception, so the signature is journalled as failed and tried again
+            raise Exception('Failed extracting Comments from {0}: {1!r}'.format(record_json['accession'], e)) from e
 
     if 'keywords' in record_json:
         for kw in record_json['keywords']:
             if kw not in excluded_keywords:
-                record['SPKW'].append(kw['value'])
-
-    return record
-
-
-def collect_comments(record, comment_json):
+                add('SPKW', kw['value'])
+
+    for atype in annotation_list_types:
+        if atype in annotations:
+            terms = tuple(annotations[atype])
+            annotations[atype] = strings.setdefault(terms, terms)
+    if index is None:
+        index = lineage_index
+    lineage_node = index.add(record_json['organism']['lineage'])
+    if term_ids is not None:
+        term_ids = tuple(term_ids)
+    return AnnotationRecord(record_json['accession'], lineage_node, annotations, index, term_ids)
+
+
+# The number of an annotation of a type in terms, a dictionary (annotation type, annotation): number, adding it if new
+def get_term_id(terms: dict, atype, annotation) -> int:
+    term = terms.get((atype, annotation))
+    if term is None:
+        term = terms[(atype, annotation)] = len(terms)
+    return term
+
+
+# add(atype, value) adds one annotation to the record
+def collect_comments(add, comment_json):
     for comment in comment_json:
         ctype = comment['type']
         if ctype == 'CATALYTIC_ACTIVITY':
@@ -221,7 +565,7 @@ def collect_comments(record, comment_json):
                     if xref['type'] == 'Rhea':
                         rhea = xref['id']
                         break
-            record['CCCA'].append('{0} {1}'.format(rhea, name))
+            add('CCCA', '{0} {1}'.format(rhea, name))
 
         elif ctype == 'COFACTOR':
             if 'cofactors' in comment:
@@ -231,108 +575,113 @@ def collect_comments(record, comment_json):
                     if 'dbReference' in cofactor:
                         if cofactor['dbReference']['type'] == 'CHEBI':
                             chebi = cofactor['dbReference']['id']
-                    record['CCCO'].append('{0} {1}'.format(chebi, name))
+                    add('CCCO', '{0} {1}'.format(chebi, name))
             if 'text' in comment:
                 #print('Cofactor Text ' + record['accession'])
                 for commenttext in comment['text']:
-                    record['CCCO'].append(commenttext['value'])
+                    add('CCCO', commenttext['value'])
 
         elif ctype == 'FUNCTION':
             for text in comment['text']:
-                record['CCFU'].extend(text['value'].split('. '))
+                for sentence in text['value'].split('. '):
+                    add('CCFU', sentence)
 
         elif ctype == 'SUBCELLULAR_LOCATION':
             if 'locations' in comment:
                 for location in comment['locations']:
-                    record['CCLO'].append(location['location']['value'])
+                    add('CCLO', location['location']['value'])
             if 'text' in comment:
                 #print('SubcellularLocation Text ' + record['accession'])
                 for locationtext in comment['text']:
-                    record['CCLO'].append(locationtext['value'])
+                    add('CCLO', locationtext['value'])
 
         elif ctype == 'PATHWAY':
             for text in comment['text']:
-                record['CCPA'].append(text['value'])
+                add('CCPA', text['value'])
 
         elif ctype == 'SIMILARITY':
             for text in comment['text']:
-                record['CCSI'].append(text['value'])
+                add('CCSI', text['value'])
 
         elif ctype == 'SUBUNIT':
             for text in comment['text']:
-                record['CCSU'].append(text['value'])
+                add('CCSU', text['value'])
 
 
 # Converts a json object containing records into a dictionary with key: taxonomy_group and value: list of records
-def group_records_by_taxonomy_from_json(json):
+def group_records_by_taxonomy_from_json(json, depths=default_taxonomy_depths, index=None):
+    return group_records_by_taxonomy(extract_records(json, index), depths, index)
+
+
+# The annotation records for a json object containing records, sharing their strings
+# and, if a terms dictionary is given, numbering their annotations there (see extract_annotations)
+def extract_records(json, index=None, terms=None) -> list:
+    strings = {}
+    return [extract_annotations(item, strings, index, terms) for item in json]
+
+
+# The records are grouped at each of the depths in one pass, and the groups for the first depth come first.
+# A record whose lineage is shorter than a depth is only in the group for its lineage at the shallower depth.
+def group_records_by_taxonomy(records, depths=default_taxonomy_depths, index=None) -> dict:
+    if index is None:
+        index = lineage_index
+    depth_groups = [{} for depth in depths]
+    for record in records:
+        for depth, groups in zip(depths, depth_groups):
+            node = index.ancestor(record.lineage_node, depth)
+            if node not in groups:
+                groups[node] = []
+            groups[node].append(record)
+
     taxongroups = {}
-    for item in json:
-        record = extract_annotations(item)
-        taxon = ' '.join(record['SPOC'][:2])
-        if taxon not in taxongroups:
-            taxongroups[taxon] = []
-        taxongroups[taxon].append(record)
+    grouped_nodes = set()
+    for groups in depth_groups:
+        for node in groups:
+            if node not in grouped_nodes:
+                grouped_nodes.add(node)
+                taxongroups[index.labels[node]] = groups[node]
     return taxongroups
 
 
-def get_json_data_grouped_by_annotations(json_list) -> dict:
-    # Add all the annotations
-    annotation_collection = {'accession_list': [], 'taxonomy': set()}
-    for record in json_list:
-        annotation_collection['accession_list'].append(record['accession'])
-        annotation_collection['taxonomy'].add(' '.join(record['SPOC'][:2]))
+# Counts how many times each annotation appears in the records in a single pass.
+# Only the counts are kept, as the accessions themselves are not needed for the consistency test.
+def count_annotations(json_list) -> dict:
+    annotation_counts = {'record_count': 0}
+    for atype in consistency_string_types + consistency_list_types:
+        annotation_counts[atype] = {}
 
-    for atype in ['DERF', 'GNNM']:
-        annotation_collection[atype] = {}
-        for record in json_list:
+    for record in json_list:
+        annotation_counts['record_count'] += 1
+        for atype in consistency_string_types:
             annotation = record[atype]
-            if annotation == '':
-                continue
-            add_to_annotation_collection(annotation_collection, atype, annotation, record['accession'])
-
-    for atype in ['DERS', 'DEEC', 'DEAF', 'CCFU', 'CCLO', 'CCPA', 'CCSI', 'CCSU', 'SPKW', 'CCCO', 'CCCA']:
-        annotation_collection[atype] = {}
-        for record in json_list:
-            annotationlist = record[atype]
-            for annotation in annotationlist:
-                if annotation == '':
-                    continue
-                add_to_annotation_collection(annotation_collection, atype, annotation, record['accession'])
-
-    return annotation_collection
-
-
-def get_consistent_annotations(annotation_collection) -> dict:
-    cutoff = len(annotation_collection['accession_list']) * 0.9
-    filtered_annotations = deepcopy(annotation_collection)
-    for atype in ['DERF', 'GNNM']:
-        for a in annotation_collection[atype]:
-            if len(annotation_collection[atype][a]) < cutoff:
-                del filtered_annotations[atype][a]
-
-    for atype in ['DERS', 'DEEC', 'DEAF', 'CCFU', 'CCLO', 'CCPA', 'CCSI', 'CCSU', 'SPKW', 'CCCO', 'CCCA']:
-        for a in annotation_collection[atype]:
-            if len(annotation_collection[atype][a]) < cutoff:
-                del filtered_annotations[atype][a]
+            if annotation != '':
+                counts = annotation_counts[atype]
+                counts[annotation] = counts.get(annotation, 0) + 1
+        for atype in consistency_list_types:
+            counts = annotation_counts[atype]
+            for annotation in record[atype]:
+                if annotation != '':
+                    counts[annotation] = counts.get(annotation, 0) + 1
 
-    return filtered_annotations
+    return annotation_counts
 
 
-def add_to_annotation_collection(annotation_collection, atype, annotation, accession):
-    if annotation not in annotation_collection[atype]:
-        annotation_collection[atype][annotation] = []
-    annotation_collection[atype][annotation].append(accession)
+# Keeps the annotations found in at least the cutoff fraction (by default 90%) of the records
+def get_consistent_annotations(annotation_counts, cutoff_fraction=consistency_cutoff) -> dict:
+    cutoff = annotation_counts['record_count'] * cutoff_fraction
+    consistent_annotations = {'record_count': annotation_counts['record_count']}
+    for atype in consistency_string_types + consistency_list_types:
+        consistent_annotations[atype] = {a: count for a, count in annotation_counts[atype].items() if count >= cutoff}
+    return consistent_annotations
 
 
 # Collects for one taxonomy which will be only part of the data for one InterPro Id
 def get_taxonomy_annotation_collection(taxonomy, consistent_annotation, outfile=None):
-    totalrecords = len(consistent_annotation['accession_list'])
+    totalrecords = consistent_annotation['record_count']
     text_data = []
-    for atype in ['DERF', 'GNNM', 'DERS', 'DEEC', 'DEAF', 'CCFU',
-                  'CCLO', 'CCPA', 'CCSI', 'CCSU', 'SPKW', 'CCCO', 'CCCA']:
+    for atype in consistency_string_types + consistency_list_types:
         if atype in consistent_annotation:
-            for annotation in consistent_annotation[atype]:
-                consistentnumber = len(consistent_annotation[atype][annotation])
+            for annotation, consistentnumber in consistent_annotation[atype].items():
                 text = '{0}\t{1}\t{2}\t{3}\t{4}'.format(taxonomy, atype, totalrecords, consistentnumber, annotation)
                 text_data.append(text)
                 if outfile:
@@ -3,126 +3,132 @@ Use the proteins API to find out how many reviewed and unreviewed hits there are
 InterPro id and save the result to a file.  Ask the API to return only one fasta as the number
 we want is in the header regardless of how many results are returned.
 """
-import concurrent.futures
-import sys
 import candidates.utils as utils
+import candidates.journal as journal
 import logging
 logger = logging.getLogger(__name__)
 
-
-def collect_counts_main_thread(input_list: list, min_rev, min_unrev, output_filepath):
-    logger.info('Collecting reviewed and unreviewed count data from {0} InterPro ids'
-                ' without using threads'.format(len(input_list)))
-    outfile = open(output_filepath, 'w')
-    count = 0
-    for ip in input_list:
-        count += 1
-        if count % 20 == 0:
-            logger.info('Collected reviewed and unreviewed counts for {0} signatures'.format(count))
-            outfile.flush()
-        reviewedcount = get_count(ip, True)
-        if reviewedcount >= min_rev:
-            unreviewedcount = get_count(ip, False)
-            if unreviewedcount >= min_unrev:
-                outfile.write('{0}\t{1}\t{2}\n'.format(ip, reviewedcount, unreviewedcount))
-    logger.info('Collected reviewed and unreviewed counts for {0} signatures'.format(count))
-    outfile.close()
+# Only the x-pagination-totalrecords header is used so ask for the smallest response
+count_headers = {"Accept": "text/x-fasta"}
 
 
 # First get all the reviewed data and then all the unreviewed data for those that pass min_rev
-def collect_counts(input_list_path, min_rev, min_unrev, output_filepath):
+# engine is either 'threads' or 'asyncio' (which needs aiohttp to be installed)
+# If a journal_dir is given each count is saved there as it is collected, and counts already saved are reused
+def collect_counts(input_list_path, min_rev, min_unrev, output_filepath, engine='threads', journal_dir=None):
     interpro_list = utils.get_file_lines(input_list_path)
+    reviewed_journal = journal.open_journal(journal_dir, 'stage3_reviewed')
+    unreviewed_journal = journal.open_journal(journal_dir, 'stage3_unreviewed')
+
+    final_interpro_hits_list = None
+    if engine == 'asyncio':
+        # Imported here as the engine is optional and aiohttp may not be installed
+        import candidates.uniprot.async_counts as async_counts
+        if async_counts.is_available():
+            final_interpro_hits_list = async_counts.collect_counts(interpro_list, min_rev, min_unrev,
+                                                                   reviewed_journal, unreviewed_journal)
+        else:
+            logger.warning('The asyncio engine needs aiohttp to be installed, so threads will be used instead')
+    if final_interpro_hits_list is None:
+        final_interpro_hits_list = collect_counts_with_threads(interpro_list, min_rev, min_unrev,
+                                                               reviewed_journal, unreviewed_journal)
+    for j in (reviewed_journal, unreviewed_journal):
+        if j is not None:
+            j.close()
 
+    # gather the data temp data together and write to file
+    write_counts(final_interpro_hits_list, output_filepath)
+    logger.info('Collected reviewed and unreviewed counts for {0} signatures using {1}'.format(
+                                                                                len(final_interpro_hits_list), engine))
+
+
+# Returns a list of tuples (InterProId, reviewed_count, unreviewed_count) for the signatures passing both filters
+def collect_counts_with_threads(interpro_list: list, min_rev, min_unrev,
+                                reviewed_journal=None, unreviewed_journal=None) -> list:
     # Calculate thread count for reviewed hits collection only
     thread_count = utils.calculate_thread_count(len(interpro_list))
-    if thread_count == 1:
-        collect_counts_main_thread(interpro_list, min_rev, min_unrev, output_filepath)
-        return
-    else:
-        logger.info('Collecting reviewed hits from {0} InterPro ids using {1} threads'.format(
+    logger.info('Collecting reviewed hits from {0} InterPro ids using {1} threads'.format(
                                                                                 len(interpro_list), thread_count))
+    reviewed_results_dict = get_hit_counts_with_threads(interpro_list, True, thread_count, reviewed_journal)
+    filtered_interpro_list = [x for x in interpro_list
+                              if x in reviewed_results_dict and reviewed_results_dict[x] >= min_rev]
 
-    # Get reviewed hit counts (Get hit counts needs a string true / false not a boolean
-    parameters = get_hitcount_parameters_for_executor_map(thread_count, interpro_list, True)
-    reviewed_results_dict = get_hit_counts_with_threads(parameters)
-    filtered_interpro_list = [x for x in reviewed_results_dict if reviewed_results_dict[x] >= 10]
-
-    # Recalculate the threads needed for this list and set the parameters for collecting unreviewed data
+    # Recalculate the threads needed for this list and collect the unreviewed data,
+    # starting with the largest families as these are the slowest to count
     thread_count = utils.calculate_thread_count(len(filtered_interpro_list))
     logger.info('Collecting unreviewed hits from {0} InterPro ids using {1} threads'.format(
                                                                           len(filtered_interpro_list), thread_count))
-    parameters = get_hitcount_parameters_for_executor_map(thread_count, filtered_interpro_list, False)
-    unreviewed_results_dict = get_hit_counts_with_threads(parameters)
-
-    filtered_unreviewed_list = [x for x in unreviewed_results_dict if unreviewed_results_dict[x] >= 100]
+    largest_first = sorted(filtered_interpro_list, key=lambda x: reviewed_results_dict[x], reverse=True)
+    unreviewed_results_dict = get_hit_counts_with_threads(largest_first, False, thread_count, unreviewed_journal)
 
     final_interpro_hits_list = []
-    for ipr in filtered_unreviewed_list:
-        final_interpro_hits_list.append((ipr, reviewed_results_dict[ipr], unreviewed_results_dict[ipr]))
+    for ipr in filtered_interpro_list:
+        if ipr in unreviewed_results_dict and unreviewed_results_dict[ipr] >= min_unrev:
+            final_interpro_hits_list.append((ipr, reviewed_results_dict[ipr], unreviewed_results_dict[ipr]))
+    return final_interpro_hits_list
 
-    # gather the data temp data together and write to file
+
+# Applies the thresholds again to the counts saved in the journals of an earlier run, without looking any up.
+# Unreviewed counts were only collected for the signatures passing the earlier reviewed threshold,
+# so signatures without one are left out.
+def filter_saved_counts(input_list_path, min_rev, min_unrev, output_filepath, journal_dir):
+    interpro_list = utils.get_file_lines(input_list_path)
+    reviewed_journal = journal.open_journal(journal_dir, 'stage3_reviewed')
+    unreviewed_journal = journal.open_journal(journal_dir, 'stage3_unreviewed')
+    reviewed_journal.close()
+    unreviewed_journal.close()
+    reviewed_results_dict = reviewed_journal.completed
+    unreviewed_results_dict = unreviewed_journal.completed
+
+    final_interpro_hits_list = []
+    missing = 0
+    for ipr in interpro_list:
+        if ipr not in reviewed_results_dict or reviewed_results_dict[ipr] < min_rev:
+            continue
+        if ipr not in unreviewed_results_dict:
+            missing += 1
+        elif unreviewed_results_dict[ipr] >= min_unrev:
+            final_interpro_hits_list.append((ipr, reviewed_results_dict[ipr], unreviewed_results_dict[ipr]))
+    if missing:
+        logger.warning('No unreviewed count was collected for {0} signatures with {1} or more reviewed hits, '
+                       'these are left out'.format(missing, min_rev))
+    write_counts(final_interpro_hits_list, output_filepath)
+    logger.info('Filtered the saved counts to {0} signatures'.format(len(final_interpro_hits_list)))
+
+
+# hits_list is a list of tuples (InterProId, reviewed_count, unreviewed_count)
+def write_counts(hits_list: list, output_filepath):
     outfile = open(output_filepath, 'w')
-    for t in final_interpro_hits_list:
+    for t in hits_list:
         outfile.write('{0}\t{1}\t{2}\n'.format(t[0], t[1], t[2]))
     outfile.close()
-    logger.info('Collected reviewed and unreviewed counts for {0} signatures using {1} threads'.format(
-                                                                         len(final_interpro_hits_list), thread_count))
-
-
-def get_hitcount_parameters_for_executor_map(threads: int, id_list: list, reviewed: bool) -> list:
-    parameter_list = []
-    for split in utils.calculate_split_positions(len(id_list), threads):
-        thread_id, start, end = split
-        parameter_list.append((thread_id, id_list[start:end], reviewed))
-    return parameter_list
-
-
-def get_hit_counts_with_threads(params: list) -> dict:
-    with concurrent.futures.ThreadPoolExecutor(max_workers=len(params)) as executor:
-        results = executor.map(collect_batch_of_hit_counts, params)
-        # This is a list of dictionaries
-        all_results = list(results)
-    # Merge the results
-    all_results_dict = all_results[0]
-    for i in range(1, len(all_results)):
-        all_results_dict.update(all_results[i])
-
-    return all_results_dict
 
 
-def collect_batch_of_hit_counts(params: tuple) -> dict:
-    thread_id, id_list, reviewed = params
+# Threads take the signatures one at a time from a shared queue
+# Signatures whose count could not be collected are left out of the results
+def get_hit_counts_with_threads(id_list: list, reviewed: bool, thread_count: int, count_journal=None) -> dict:
     if reviewed:
         status = 'reviewed'
     else:
         status = 'unreviewed'
-    result_dict = {}
-    # logger.info(f'Thread {thread_id} has started collecting {len(id_list)} {status} items')
-    count = 0
-    for ipr in id_list:
-        count += 1
-        # Only report as thread 1 progresses
-        if count % 5 == 0 and thread_id == 1:
-            logger.info('Thread {0} has collected {1} out of {2} {3} items'.format(
-                                                                          thread_id, count, len(id_list), status))
-        result_dict[ipr] = get_count(ipr, reviewed, thread_id)
-    if thread_id == 1:
-        logger.info('Thread {0} has finished collecting {1} out of {2} {3} items'.format(
-                                                                            thread_id, count, len(id_list), status))
-    return result_dict
 
+    def count_hits(ipr, thread_id):
+        return get_count(ipr, reviewed, thread_id)
 
-def get_count(ip: str, isreviewed: bool, thread_id=1):
-    baseurl = 'https://www.ebi.ac.uk/proteins/api/proteins/InterPro:{0}?offset=0&size=1&reviewed='.format(ip)
+    return journal.run_with_journal(count_hits, id_list, thread_count, count_journal,
+                                    description='{0} counts'.format(status))
+
+
+def get_count_url(ip: str, isreviewed: bool) -> str:
+    baseurl = '{0}/InterPro:{1}?offset=0&size=1&reviewed='.format(utils.proteins_api_url, ip)
     if isreviewed:
-        url = baseurl + 'true'
+        return baseurl + 'true'
     else:
-        url = baseurl + 'false'
-    headers = {"Accept": "text/x-fasta"}
-    try:
-        r = utils.get_url_with_retry(url, headers, thread_id)
-    except Exception as e:
-        logger.error(str(e))
-        logger.error('Giving up analysis.')
-        sys.exit(0)
+        return baseurl + 'false'
+
+
+# Errors are raised by the get_url_with_retry method
+def get_count(ip: str, isreviewed: bool, thread_id=1):
+    url = get_count_url(ip, isreviewed)
+    r = utils.get_url_with_retry(url, count_headers, thread_id)
     return int(r.headers['x-pagination-totalrecords'])
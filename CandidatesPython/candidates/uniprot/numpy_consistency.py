@@ -0,0 +1,101 @@
+"""
+An optional NumPy engine for the Stage 4 consistency test, giving the same candidate text lines as
+collect_candidates.analyse_taxonomy_groups.
+
+The records of a family are encoded as a sparse records x annotation terms matrix, held as one
+entry per (record, term) pair along with the taxonomic group of the record. The support for each term
+in each group is then the column sum for that group, found for all groups and terms at once by counting
+the unique (group, term) keys, and compared with the cutoff fraction (by default 90%) of the size of each group.
+An annotation repeated within a record is counted each time, as in collect_candidates.count_annotations.
+
+The terms of each record are numbered once, as it is read (see collect_candidates.extract_annotations), so
+only the arrays of numbers are put together here, however many groups a record is in. Records read without
+numbers have their annotations numbered here instead, which is slower.
+
+This engine needs numpy, which is not installed with the other requirements.
+"""
+import itertools
+import candidates.uniprot.collect_candidates as collector
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def is_available() -> bool:
+    return numpy is not None
+
+
+# taxonomy_groups is a dictionary with key: taxonomy_group and value: list of records
+# terms is the dictionary (annotation type, annotation): number the records of the family were numbered in when
+# they were read, if they were
+def analyse_taxonomy_groups(taxonomy_groups: dict, cutoff_fraction=None, terms=None) -> list:
+    if cutoff_fraction is None:
+        cutoff_fraction = collector.consistency_cutoff
+    atypes = collector.consistency_string_types + collector.consistency_list_types
+    group_names = list(taxonomy_groups)
+    group_sizes = numpy.array([len(taxonomy_groups[taxon]) for taxon in group_names], dtype=numpy.int64)
+
+    # The entries are listed in the order the records and their annotations are read, so the first entry
+    # for a term in a group gives the order the annotations are written in
+    if terms is None:
+        terms = {}
+        record_terms = [number_terms(record, terms) for taxon in group_names for record in taxonomy_groups[taxon]]
+    else:
+        record_terms = [get_term_ids(record, terms) for taxon in group_names for record in taxonomy_groups[taxon]]
+    entry_counts = numpy.fromiter(map(len, record_terms), dtype=numpy.int64, count=len(record_terms))
+    entry_count = int(entry_counts.sum())
+    if entry_count == 0:
+        return []
+    entry_terms = numpy.fromiter(itertools.chain.from_iterable(record_terms), dtype=numpy.int64, count=entry_count)
+    entry_groups = numpy.repeat(numpy.repeat(numpy.arange(len(group_names), dtype=numpy.int64), group_sizes),
+                                entry_counts)
+
+    term_count = len(terms)
+    term_names = [None] * term_count
+    term_atypes = numpy.empty(term_count, dtype=numpy.int64)
+    atype_numbers = {atype: a for a, atype in enumerate(atypes)}
+    for (atype, annotation), term in terms.items():
+        term_names[term] = annotation
+        term_atypes[term] = atype_numbers[atype]
+    keys = entry_groups * term_count + entry_terms
+    keys, first_entries, support = numpy.unique(keys, return_index=True, return_counts=True)
+    groups, group_terms = keys // term_count, keys % term_count
+
+    consistent = support >= group_sizes[groups] * cutoff_fraction
+    groups, group_terms = groups[consistent], group_terms[consistent]
+    support, first_entries = support[consistent], first_entries[consistent]
+    # Order by group, then annotation type, then the first time the annotation was seen in the group
+    order = numpy.lexsort((first_entries, term_atypes[group_terms], groups))
+
+    text_data = []
+    for i in order:
+        term = group_terms[i]
+        text_data.append('{0}\t{1}\t{2}\t{3}\t{4}'.format(group_names[groups[i]], atypes[term_atypes[term]],
+                                                          group_sizes[groups[i]], support[i], term_names[term]))
+    return text_data
+
+
+# The term numbers of a record read with terms, or numbered now if it was read without them
+def get_term_ids(record, terms: dict) -> tuple:
+    try:
+        return record.term_ids
+    except AttributeError:
+        return number_terms(record, terms)
+
+
+# Numbers the annotations of a record in terms, in the order of the annotation types
+def number_terms(record, terms: dict) -> tuple:
+    term_ids = []
+    for atype in collector.consistency_string_types:
+        annotation = record[atype]
+        if annotation != '':
+            term_ids.append(collector.get_term_id(terms, atype, annotation))
+    for atype in collector.consistency_list_types:
+        for annotation in record[atype]:
+            if annotation != '':
+                term_ids.append(collector.get_term_id(terms, atype, annotation))
+    return tuple(term_ids)
@@ -5,6 +5,7 @@ The list includes InterPro signatures used as well as individual member database
 '''
 
 from lxml import etree
+import candidates.utils as utils
 import logging
 logger = logging.getLogger(__name__)
 
@@ -19,7 +20,8 @@ def collect_used_signatures(rules_xml_filepath, outfilepath):
     allsigset = set()
     outfile = open(outfilepath, 'w')
 
-    context = etree.iterparse(rules_xml_filepath, events=('end',), tag=full_tag('rule'))
+    xmlfile = utils.open_input(rules_xml_filepath)
+    context = etree.iterparse(xmlfile, events=('end',), tag=full_tag('rule'))
     for event, rule in context:
         conditions = rule.find(full_tag('conditions'))
         conditionset = conditions.findall('.//' + full_tag('condition'))
@@ -37,6 +39,7 @@ def collect_used_signatures(rules_xml_filepath, outfilepath):
         rule.clear()
         while rule.getprevious() is not None:
             del rule.getparent()[0]
+    xmlfile.close()
     for s in sorted(allsigset):
         outfile.write(s + '\n')
     outfile.close()
@@ -1,9 +1,19 @@
+import os
+import json
+import codecs
 import time
-import requests
-import math
+import gzip
+import lzma
+import queue
+import threading
+import candidates.rate_limit as rate_limit
+import candidates.metrics as metrics
 import logging
 logger = logging.getLogger(__name__)
 
+# Base address for all the UniProtKB lookups
+proteins_api_url = 'https://www.ebi.ac.uk/proteins/api/proteins'
+
 
 def file_list_to_set(filepath):
     newset = set()
@@ -33,32 +43,288 @@ def fileline_filter(filename, text):
     outfile.close()
 
 
+# Extensions of the compressed input files that can be read directly
+compressed_extensions = ('.gz', '.xz', '.zst')
+
+
+# Returns the path of the input file, or of a compressed copy of it, or None if neither exists.
+# When there are several, the newest is used, so an old unzipped file left next to a newly
+# downloaded compressed release is not read instead of it.
+def find_input_file(filepath):
+    paths = [path for path in [filepath] + [filepath + extension for extension in compressed_extensions]
+             if os.path.isfile(path)]
+    if not paths:
+        return None
+    newest = max(paths, key=os.path.getmtime)
+    if len(paths) > 1:
+        logger.warning('Found {0}, reading the newest, {1}'.format(', '.join(paths), newest))
+    return newest
+
+
+# Opens an input file for reading as bytes. Compressed files are decompressed in a background thread
+# so that decompressing overlaps with parsing the data.
+def open_input(filepath):
+    if filepath.endswith('.gz'):
+        return BackgroundReader(gzip.open(filepath, 'rb'))
+    elif filepath.endswith('.xz'):
+        return BackgroundReader(lzma.open(filepath, 'rb'))
+    elif filepath.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception('The zstandard package is needed to read {0}'.format(filepath))
+        return BackgroundReader(zstandard.ZstdDecompressor().stream_reader(open(filepath, 'rb'), closefd=True))
+    else:
+        return open(filepath, 'rb')
+
+
+class BackgroundReader:
+    """
+    File-like object that reads chunks from another file object in a background thread.
+    Chunks are held in a bounded queue, so at most queue_size chunks are read ahead.
+    """
+    def __init__(self, fileobj, chunk_size=1024 * 1024, queue_size=8):
+        self.fileobj = fileobj
+        self.chunk_size = chunk_size
+        self._chunks = queue.Queue(maxsize=queue_size)
+        self._buffer = b''
+        self._position = 0
+        self._finished = False
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._fill, daemon=True)
+        self._thread.start()
+
+    def _fill(self):
+        try:
+            while not self._closed.is_set():
+                chunk = self.fileobj.read(self.chunk_size)
+                self._put(chunk)
+                if not chunk:
+                    break
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._closed.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _next_chunk(self):
+        chunk = self._chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+        if not chunk:
+            self._finished = True
+        return chunk
+
+    # Like a raw file read, this may return fewer bytes than asked for, and returns b'' only at the end of the file
+    def read(self, size=-1) -> bytes:
+        if size is None or size < 0:
+            parts = [self._buffer[self._position:]]
+            while not self._finished:
+                parts.append(self._next_chunk())
+            self._buffer, self._position = b'', 0
+            return b''.join(parts)
+        if self._position >= len(self._buffer) and not self._finished:
+            self._buffer, self._position = self._next_chunk(), 0
+        data = self._buffer[self._position:self._position + size]
+        self._position += len(data)
+        return data
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 # Use default thread_id of 1 for methods that run on main thread
-# Requests has its own retry system which should really be used here instead
+# Requests go through the shared rate limiter, see limited_get
+# If a response cache is enabled it is checked first and successful responses are saved to it
+# requests is imported in the functions that make lookups, so the file functions here can be used without it
 def get_url_with_retry(url, headers, thread_id=1):
-    max_tries = 5
-    tries = 1
-    r = None
+    import requests
+    import candidates.session as session
+    import candidates.cache as cache
+    response_cache = cache.get_cache()
+    if response_cache is not None:
+        cached = response_cache.get(url, headers)
+        if cached is not None:
+            return cached
     try:
-        r = requests.get(url, headers=headers)
-    except:
-        logger.error('Thread {0}. Try {1}/{2} for {3}'.format(thread_id, tries, max_tries, url))
-    if r is not None and r.ok:
+        r = limited_get(url, headers, thread_id)
+    except requests.exceptions.RequestException as e:
+        logger.error('Thread {0}. Failed after {1} retries for {2}: {3}'.format(
+                                                        thread_id, session.settings['max_retries'], url, e))
+        # Throw an exception if this method failed to access the data
+        raise Exception('Thread {0} completely failed to access {1}'.format(thread_id, url))
+    if r.ok:
+        if response_cache is not None:
+            return response_cache.put_response(url, headers, r)
         return r
-    else:
-        while tries <= max_tries:
-            tries += 1
-            time.sleep(tries * 2)
-            try:
-                r = requests.get(url, headers=headers)
-            except:
-                logger.error('Thread {0}. Try {1}/{2} for {3}'.format(thread_id, tries, max_tries, url))
-            if r is not None and r.ok:
+    logger.error('Thread {0}. Status {1} after {2} retries for {3}'.format(
+                                                        thread_id, r.status_code, session.settings['max_retries'], url))
+    r.raise_for_status()
+
+
+# Yields the response body in chunks of bytes so the whole body never needs to be held in memory.
+# The request is only made when the first chunk is asked for. Like get_url_with_retry, a response cache
+# is used if enabled, with the body saved to it as it arrives.
+# A connection lost part way through the body raises an exception and the whole url has to be tried again.
+def stream_url_with_retry(url, headers, thread_id=1, chunk_size=64 * 1024):
+    import requests
+    import candidates.session as session
+    import candidates.cache as cache
+    response_cache = cache.get_cache()
+    if response_cache is not None:
+        body = response_cache.open_body(url, headers)
+        if body is not None:
+            with body:
+                chunk = body.read(chunk_size)
+                while chunk:
+                    yield chunk
+                    chunk = body.read(chunk_size)
+            return
+    try:
+        r = limited_get(url, headers, thread_id, stream=True)
+    except requests.exceptions.RequestException as e:
+        logger.error('Thread {0}. Failed after {1} retries for {2}: {3}'.format(
+                                                        thread_id, session.settings['max_retries'], url, e))
+        raise Exception('Thread {0} completely failed to access {1}'.format(thread_id, url))
+    writer = None
+    metrics.responses_streaming.inc()
+    try:
+        if not r.ok:
+            logger.error('Thread {0}. Status {1} after {2} retries for {3}'.format(
+                                                        thread_id, r.status_code, session.settings['max_retries'], url))
+            r.raise_for_status()
+        if response_cache is not None:
+            writer = response_cache.start_put(url, headers, r.status_code, r.headers)
+        for chunk in r.iter_content(chunk_size):
+            metrics.record_bytes(len(chunk))
+            if writer is not None:
+                writer.write(chunk)
+            yield chunk
+        if writer is not None:
+            writer.commit()
+            writer = None
+    finally:
+        if writer is not None:
+            writer.abort()
+        r.close()
+        metrics.responses_streaming.dec()
+
+
+# The items of the JSON array in a response body, read one at a time as the body arrives (see iter_json_array).
+# Closing the iterator closes the response at once, eg when the items are not all read.
+def stream_json_array(url, headers, thread_id=1):
+    chunks = stream_url_with_retry(url, headers, thread_id)
+    try:
+        for item in iter_json_array(chunks):
+            yield item
+    finally:
+        chunks.close()
+
+
+# Makes a request through the shared rate limiter (see rate_limit), and tries it again after a failure.
+# A response of 429 or 503 means the server is overloaded, so the request is tried again after a backoff,
+# up to max_throttle_retries times (see rate_limit.backoff_delay). Connection errors, timeouts and the
+# retry_statuses of the session settings are tried again up to max_retries times (see session.backoff_delay).
+# The last response is returned if it is still refused, and the last exception raised if it still fails.
+# Each try goes through the limiter on its own and is recorded with it, so the limiter sees every failure and the
+# latency of each response rather than that of all the tries, and no slot is held during the backoff.
+# A request counts as in flight until its headers arrive, also when stream is True, so a caller that is slow to
+# read the body does not hold up the requests of the other threads.
+# Every response and every error is recorded in the metrics
+def limited_get(url, headers, thread_id=1, stream=False):
+    import requests
+    import candidates.session as session
+    limiter = rate_limit.get_limiter()
+    kind = rate_limit.get_request_kind(url)
+    throttled = failed = 0
+    while True:
+        limiter.acquire()
+        try:
+            r = session.get_session().get(url, headers=headers, timeout=session.get_timeout(), stream=stream)
+        except requests.exceptions.RequestException as e:
+            limiter.record(None, kind=kind)
+            metrics.record_request(None)
+            if failed >= session.settings['max_retries']:
+                raise
+            failed += 1
+            reason, delay = 'error', session.backoff_delay(failed)
+            logger.warning('Thread {0}. {1}, trying again in {2:.1f} seconds ({3}/{4}) for {5}'.format(
+                        thread_id, type(e).__name__, delay, failed, session.settings['max_retries'], url))
+        else:
+            retry_after = rate_limit.get_retry_after(r.headers)
+            limiter.record(r.status_code, r.elapsed.total_seconds(), retry_after, kind)
+            metrics.record_request(r.status_code, r.elapsed.total_seconds(), 0 if stream else len(r.content))
+            if r.status_code in rate_limit.settings['throttle_statuses'] and \
+                    throttled < rate_limit.settings['max_throttle_retries']:
+                throttled += 1
+                reason, delay = 'throttled', rate_limit.backoff_delay(throttled, retry_after)
+                tries, max_tries = throttled, rate_limit.settings['max_throttle_retries']
+            elif r.status_code in session.settings['retry_statuses'] and failed < session.settings['max_retries']:
+                failed += 1
+                reason, delay = 'error', retry_after or session.backoff_delay(failed)
+                tries, max_tries = failed, session.settings['max_retries']
+            else:
                 return r
-    if r is not None:
-        r.raise_for_status()
-    # Throw an exception if this method failed to access the data
-    raise Exception('Thread {0} completely failed to access {1}'.format(thread_id, url))
+            r.close()
+            logger.warning('Thread {0}. Status {1}, trying again in {2:.1f} seconds ({3}/{4}) for {5}'.format(
+                                                    thread_id, r.status_code, delay, tries, max_tries, url))
+        finally:
+            limiter.release()
+        metrics.record_retry(reason)
+        time.sleep(delay)
+
+
+# Yields the items of a JSON array one at a time from an iterable of utf-8 encoded chunks,
+# so only the item being read is held in memory rather than the whole array.
+# The items are expected to be JSON objects, as in the Proteins API responses.
+def iter_json_array(byte_chunks):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buffer = ''
+    position = 0
+    started = False
+    finished = False
+    for chunk in byte_chunks:
+        # Read to the end of the chunks after the array so that the source (eg the response cache) sees it all
+        if finished:
+            continue
+        buffer = buffer[position:] + text_decoder.decode(chunk)
+        position = 0
+        while not finished:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array but found {0!r}'.format(buffer[position:position + 20]))
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                finished = True
+                break
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                # The item is not complete yet so wait for the next chunk
+                break
+            yield item
+    if not finished:
+        raise ValueError('The JSON array ended before its closing bracket')
 
 
 # Calculate number of threads (t) to use for list length of n
@@ -78,22 +344,58 @@ def calculate_thread_count(n: int):
                 return t
 
 
-# Returns a tuple of 3 integers. The first element of each is used as thread id
-# The other two show where to split the list
-def calculate_split_positions(list_length: int, threadcount: int) -> list:
-    param_list = []
-    j = int(math.ceil(list_length / threadcount))
-    start, end = 0, 0
-    i = 0
-    for i in range(threadcount - 1):
-        start = i * j
-        end = start + j
-        param_list.append((i + 1, start, end))
-    param_list.append((i + 2, end, list_length))
-    return param_list
-
+# Runs worker(item, thread_id) for every item on thread_count threads that take items from a shared queue.
+# A thread that finishes early keeps taking items, so the run ends when the total work is done rather than
+# when the slowest fixed slice of the list is done. Items are started in the order given, so pass the largest first.
+# Returns a list of futures in the same order as items.
+def run_work_queue(worker, items: list, thread_count: int, description='items') -> list:
+    import concurrent.futures
+    work = queue.Queue()
+    futures = []
+    for item in items:
+        future = concurrent.futures.Future()
+        futures.append(future)
+        work.put((item, future))
 
+    progress = {'done': 0}
+    progress_lock = threading.Lock()
+    report_interval = max(5, len(items) // 20)
 
+    def report_progress(future):
+        with progress_lock:
+            progress['done'] += 1
+            done = progress['done']
+        if done % report_interval == 0 or done == len(items):
+            logger.info('Completed {0} out of {1} {2}'.format(done, len(items), description))
 
+    # The number of items waiting, the threads busy and the items finished are kept in the metrics
+    waiting = metrics.queue_items.labels(description)
+    busy = metrics.busy_threads.labels(description)
+    waiting.set(len(items))
 
+    def consume(thread_id):
+        while True:
+            try:
+                item, future = work.get_nowait()
+            except queue.Empty:
+                return
+            waiting.set(work.qsize())
+            if not future.set_running_or_notify_cancel():
+                continue
+            busy.inc()
+            try:
+                future.set_result(worker(item, thread_id))
+                metrics.items_total.labels(description, 'done').inc()
+            # Catch everything (including sys.exit in a worker) so no future is left waiting
+            except BaseException as e:
+                future.set_exception(e)
+                metrics.items_total.labels(description, 'failed').inc()
+            finally:
+                busy.dec()
 
+    for future in futures:
+        future.add_done_callback(report_progress)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=thread_count) as executor:
+        for thread_id in range(1, thread_count + 1):
+            executor.submit(consume, thread_id)
+    return futures
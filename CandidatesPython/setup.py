@@ -3,5 +3,7 @@ setup(name='candidates',
       version='1.0',
       packages=['candidates',
                 'candidates.uniprot'],
-      install_requires=['requests']
+      install_requires=['requests'],
+      entry_points={'console_scripts': ['candidates = candidates.cli:main']},
+      extras_require={'async': ['aiohttp'], 'numpy': ['numpy'], 'parquet': ['pyarrow']}
       )
@@ -0,0 +1,68 @@
+import os
+import shutil
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+import pytest
+import candidates.utils as utils
+import candidates.cache as cache
+import candidates.uniprot.async_counts as async_counts
+
+pytest.importorskip('aiohttp')
+
+data_out = os.sep.join(['testdata', 'output'])
+# InterProId: (reviewed, unreviewed)
+counts = {'IPR000001': (5, 1000), 'IPR000002': (12, 50), 'IPR000003': (40, 2000), 'IPR000004': (10, 100)}
+
+
+class CountHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        ipr = url.path.split('InterPro:')[1]
+        reviewed = parse_qs(url.query)['reviewed'][0] == 'true'
+        self.send_response(200)
+        self.send_header('x-pagination-totalrecords', str(counts[ipr][0 if reviewed else 1]))
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def test_collect_counts_with_asyncio():
+    server = HTTPServer(('127.0.0.1', 0), CountHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    original_url = utils.proteins_api_url
+    utils.proteins_api_url = 'http://127.0.0.1:{0}/proteins/api/proteins'.format(server.server_port)
+    try:
+        results = async_counts.collect_counts(sorted(counts), 10, 100, concurrency=2, per_host=2)
+    finally:
+        utils.proteins_api_url = original_url
+        server.shutdown()
+        server.server_close()
+    assert results == [('IPR000003', 40, 2000), ('IPR000004', 10, 100)]
+
+
+# Responses are saved to the cache away from the event loop, and are read back from it once the server has gone
+def test_async_counts_cached():
+    cache_dir = os.sep.join([data_out, 'async_cache'])
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    server = HTTPServer(('127.0.0.1', 0), CountHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    original_url = utils.proteins_api_url
+    utils.proteins_api_url = 'http://127.0.0.1:{0}/proteins/api/proteins'.format(server.server_port)
+    response_cache = cache.enable(cache_dir)
+    try:
+        results = async_counts.collect_counts(sorted(counts), 10, 100, concurrency=2, per_host=2)
+        server.shutdown()
+        server.server_close()
+        assert response_cache.stats()['entries'] == 7
+        assert async_counts.collect_counts(sorted(counts), 10, 100, concurrency=2, per_host=2) == results
+    finally:
+        cache.disable()
+        utils.proteins_api_url = original_url
+        server.shutdown()
+        server.server_close()
+    assert results == [('IPR000003', 40, 2000), ('IPR000004', 10, 100)]
@@ -0,0 +1,77 @@
+import os
+import shutil
+import time
+import candidates.cache as cache
+data_out = os.sep.join(['testdata', 'output'])
+headers = {"Accept": "application/json"}
+
+
+def new_cache(name, **kwargs):
+    cache_dir = os.sep.join([data_out, name])
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    return cache.ResponseCache(cache_dir, **kwargs)
+
+
+def test_put_and_get():
+    response_cache = new_cache('cache_put_get')
+    url = 'https://www.ebi.ac.uk/proteins/api/proteins/InterPro:IPR038987?offset=0&size=-1&reviewed=true'
+    assert response_cache.get(url, headers) is None
+    response_cache.put(url, headers, 200, {'x-pagination-totalrecords': '28'}, b'[{"accession": "P12345"}]')
+    r = response_cache.get(url, headers)
+    assert r.ok
+    assert r.headers['X-Pagination-TotalRecords'] == '28'
+    assert r.text == '[{"accession": "P12345"}]'
+    # A different Accept header is a different entry
+    assert response_cache.get(url, {"Accept": "text/x-fasta"}) is None
+    assert response_cache.stats()['hits'] == 1
+    # Entries are found again when the cache is reopened
+    assert cache.ResponseCache(response_cache.cache_dir).get(url, headers).text == r.text
+
+
+def test_expired_and_other_release():
+    response_cache = new_cache('cache_expiry', ttl=0.05, release='2020_01')
+    response_cache.put('url1', headers, 200, {}, b'one')
+    assert response_cache.get('url1', headers).text == 'one'
+    time.sleep(0.1)
+    assert response_cache.get('url1', headers) is None
+    response_cache.put('url2', headers, 200, {}, b'two')
+    response_cache.release = '2020_02'
+    assert response_cache.get('url2', headers) is None
+
+
+def test_least_recently_used_evicted():
+    response_cache = new_cache('cache_eviction', max_bytes=3000)
+    body = os.urandom(900)
+    response_cache.put('url1', headers, 200, {}, body)
+    time.sleep(0.01)
+    response_cache.put('url2', headers, 200, {}, body)
+    time.sleep(0.01)
+    response_cache.get('url1', headers)
+    response_cache.put('url3', headers, 200, {}, body)
+    assert response_cache.stats()['bytes'] <= 3000
+    assert response_cache.get('url2', headers) is None
+    assert response_cache.get('url1', headers) is not None
+    assert response_cache.get('url3', headers) is not None
+
+
+# A body that does not match its details is not read, and abandoned temporary files are removed on opening
+def test_mismatched_body_and_stale_tmp():
+    import requests
+    response_cache = new_cache('cache_mismatch')
+    response_cache.put('url1', headers, 200, {}, b'one')
+    response_cache.put('url2', headers, 404, {}, b'two')
+    try:
+        response_cache.get('url2', headers).raise_for_status()
+        assert False
+    except requests.HTTPError as e:
+        assert e.response.status_code == 404
+    # As if a crash came after the body of url1 was replaced but before its details were
+    meta_path, body_path = response_cache._paths(response_cache.make_key('url1', headers))
+    shutil.copy(response_cache._paths(response_cache.make_key('url2', headers))[1], body_path)
+    assert response_cache.get('url1', headers) is None
+    tmp_path = body_path + '.1.1.tmp'
+    open(tmp_path, 'w').close()
+    old = time.time() - cache.stale_tmp_age - 1
+    os.utime(tmp_path, (old, old))
+    cache.ResponseCache(response_cache.cache_dir)
+    assert not os.path.exists(tmp_path)
@@ -0,0 +1,47 @@
+import os
+import sys
+import shutil
+import subprocess
+import candidates.cli as cli
+import candidates.cache as cache
+data_out = os.sep.join(['testdata', 'output'])
+package_dir = os.path.dirname(os.getcwd())
+
+
+def run_python(*args) -> subprocess.CompletedProcess:
+    env = dict(os.environ, PYTHONPATH=package_dir)
+    return subprocess.run([sys.executable] + list(args), env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+# The command line loads none of the modules used for the lookups and the analysis
+def test_light_imports():
+    heavy = ['requests', 'lxml', 'pyarrow', 'numpy', 'aiohttp', 'asyncio', 'http.server', 'concurrent.futures',
+             'candidates.utils', 'candidates.uniprot.collect_candidates']
+    result = run_python('-c', 'import sys, candidates.cli, candidates.cache; print(" ".join(sorted(sys.modules)))')
+    assert result.returncode == 0
+    loaded = set(result.stdout.split())
+    assert [module for module in heavy if module in loaded] == []
+
+
+def test_subcommands():
+    result = run_python('-m', 'candidates', '--help')
+    assert result.returncode == 0
+    for command in ['run', 'stage2-only', 'counts-only', 'reanalyse', 'cache-stats']:
+        assert command in result.stdout
+    options = cli.get_run_options(cli.build_parser().parse_args(['counts-only', 'main', '--min-reviewed', '50']))
+    assert (options.run_type, options.stop_after, options.min_reviewed) == ('main', 'stage3', 50)
+    assert options.reanalyse is None and options.processes == cli.candidates_main.parse_arguments([]).processes
+    options = cli.get_run_options(cli.build_parser().parse_args(['reanalyse', '2020-03-01_120000', 'main']))
+    assert (options.reanalyse, options.run_type, options.stop_after) == ('2020-03-01_120000', 'main', None)
+
+
+def test_cache_stats(capsys):
+    cache_dir = os.sep.join([data_out, 'cli_cache'])
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    cli.show_cache_stats(cache_dir)
+    assert 'No response cache' in capsys.readouterr().out
+    assert not os.path.exists(cache_dir)
+    cache.ResponseCache(cache_dir).put('https://example.org/a', None, 200, {}, b'x' * 2048)
+    cli.show_cache_stats(cache_dir)
+    assert 'Entries: 1' in capsys.readouterr().out
@@ -1,3 +1,4 @@
+import candidates.lineage as lineage
 import candidates.uniprot.collect_candidates as collector
 import json
 data_in = 'testdata/input/'
@@ -64,3 +65,83 @@ def test_cofactor_text_comment():
         json_data = json.load(f)
     record = collector.extract_annotations(json_data)
     assert record['CCCO'][0] == 'PSII binds multiple chlorophylls, carotenoids and specific lipids'
+
+
+def test_consistent_annotations():
+    with open(data_in + 'IPR038987.json') as f:
+        json_data = json.load(f)
+    taxonomy_groups = collector.group_records_by_taxonomy_from_json(json_data)
+    annotation_counts = collector.count_annotations(taxonomy_groups['Eukaryota Metazoa'])
+    assert annotation_counts['record_count'] == 5
+    consistent = collector.get_consistent_annotations(annotation_counts)
+    for atype in collector.consistency_string_types + collector.consistency_list_types:
+        for annotation, count in consistent[atype].items():
+            assert count == annotation_counts[atype][annotation]
+            assert count >= 4.5
+        assert len(consistent[atype]) == len([c for c in annotation_counts[atype].values() if c >= 4.5])
+
+
+# The processes parse the raw responses, here split into two pages, and give the same lines and records
+def test_analysis_pool_matches_threads():
+    with open(data_in + 'IPR038987.json') as f:
+        json_data = json.load(f)
+    records = collector.extract_records(json_data)
+    taxonomy_groups = collector.group_records_by_taxonomy(records)
+    bodies = [json.dumps(json_data[:10]).encode(), json.dumps(json_data[10:]).encode()]
+    pool = collector.AnalysisPool(2)
+    try:
+        lines, record_count, records_json = pool.analyse(bodies, keep_records=True)
+    finally:
+        pool.close()
+    assert lines == collector.analyse_taxonomy_groups(taxonomy_groups)
+    assert record_count == len(json_data)
+    assert json.loads(records_json) == json.loads(json.dumps([record.to_list() for record in records]))
+
+
+def test_record_shares_strings_and_reads_missing_annotations_as_empty():
+    minimal = {'accession': 'X00001', 'organism': {'lineage': ['Eukaryota', 'Metazoa', 'Chordata']}, 'protein': {}}
+    record = collector.extract_annotations(minimal)
+    assert record['DERF'] == ''
+    assert record['CCPA'] == ()
+    assert collector.lineage_index.labels[collector.lineage_index.ancestor(record.lineage_node, 2)] == \
+        'Eukaryota Metazoa'
+    failed = False
+    try:
+        record['XXXX']
+    except KeyError:
+        failed = True
+    assert failed
+
+    with open(data_in + 'IPR038987.json') as f:
+        json_data = json.load(f)
+    strings = {}
+    records = [collector.extract_annotations(item, strings) for item in json_data]
+    same_lineage = [r for r in records if r['SPOC'] == records[0]['SPOC']]
+    assert all(r['SPOC'] is records[0]['SPOC'] for r in same_lineage)
+
+
+def test_group_by_taxonomy_at_several_depths():
+    with open(data_in + 'IPR038987.json') as f:
+        json_data = json.load(f)
+    index = lineage.LineageIndex()
+    by_kingdom = collector.group_records_by_taxonomy_from_json(json_data, (1,), index)
+    by_two = collector.group_records_by_taxonomy_from_json(json_data, (2,), index)
+    both = collector.group_records_by_taxonomy_from_json(json_data, (1, 2), index)
+    assert sum(len(records) for records in by_kingdom.values()) == len(json_data)
+    assert len(by_two['Eukaryota Metazoa']) == 5
+    assert list(both) == list(by_kingdom) + [taxon for taxon in by_two if taxon not in by_kingdom]
+    for taxon in both:
+        assert [r.accession for r in both[taxon]] == \
+            [r.accession for r in (by_kingdom[taxon] if taxon in by_kingdom else by_two[taxon])]
+
+
+# Comments that cannot be read raise an ordinary exception, so the failure is journalled
+def test_unreadable_comments_raise_exception():
+    broken = {'accession': 'X00002', 'organism': {'lineage': ['Bacteria']}, 'protein': {},
+              'comments': [{}]}
+    failed = False
+    try:
+        collector.extract_annotations(broken)
+    except Exception as e:
+        failed = 'X00002' in str(e)
+    assert failed
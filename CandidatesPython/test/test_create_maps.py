@@ -44,4 +44,3 @@ def test_get_used_unirule_signatures():
     test_lines = open(test_outfilepath).readlines()
     assert len(test_lines) == 15
     assert test_lines[4].rstrip() == 'PF03211'
-
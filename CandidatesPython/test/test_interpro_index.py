@@ -0,0 +1,60 @@
+import os
+import gzip
+import lzma
+import candidates.interpro as interpro
+import candidates.interpro_index as interpro_index
+data_in = os.sep.join(['testdata', 'input'])
+data_out = os.sep.join(['testdata', 'output'])
+interpro_xmlpath = os.sep.join([data_in, 'short_interpro.xml'])
+
+
+def test_index_round_trip():
+    index_path = os.sep.join([data_out, 'InterPro_index_test.bin'])
+    if os.path.isfile(index_path):
+        os.remove(index_path)
+    built = interpro_index.load_or_build_index(interpro_xmlpath, index_path)
+    loaded = interpro_index.load_index(index_path, built.key)
+    assert loaded is not None
+    assert loaded.entries == built.entries
+    assert loaded.get_member_map() == built.get_member_map()
+    assert loaded.get_nochild_list() == built.get_nochild_list()
+    assert len(loaded.get_nochild_list()) == 34
+    assert interpro_index.load_index(index_path, 'another release') is None
+
+
+def test_index_text_outputs_match_xml_extraction():
+    index = interpro_index.build_index(interpro_xmlpath)
+    names = ('InterProId_MemberId', 'InterProId_Type', 'InterPro_NoChild')
+    index_paths = [os.sep.join([data_out, name + '_from_index.txt']) for name in names]
+    xml_paths = [os.sep.join([data_out, name + '_from_xml.txt']) for name in names]
+    index.write_text_outputs(*index_paths)
+    interpro.create_interproid_to_memberid_map(interpro_xmlpath, xml_paths[0])
+    interpro.create_interproid_to_type_map(interpro_xmlpath, xml_paths[1])
+    interpro.get_family_nochild_interpro(interpro_xmlpath, xml_paths[2])
+    for index_path, xml_path in zip(index_paths, xml_paths):
+        with open(index_path) as index_file, open(xml_path) as xml_file:
+            assert index_file.read() == xml_file.read()
+    assert len(index.members) == 273
+
+
+def test_index_from_compressed_xml():
+    index = interpro_index.build_index(interpro_xmlpath)
+    for extension, module in (('.gz', gzip), ('.xz', lzma)):
+        compressed_path = os.sep.join([data_out, 'short_interpro.xml' + extension])
+        with open(interpro_xmlpath, 'rb') as f, module.open(compressed_path, 'wb') as out:
+            out.write(f.read())
+        compressed = interpro_index.build_index(compressed_path)
+        assert compressed.get_member_map() == index.get_member_map()
+        assert compressed.get_nochild_list() == index.get_nochild_list()
+
+
+# An edit anywhere in the file, not only near its start or end, gives a new key
+def test_index_key_whole_file():
+    edited_path = os.sep.join([data_out, 'short_interpro_edited.xml'])
+    with open(interpro_xmlpath, 'rb') as f:
+        data = bytearray(f.read())
+    middle = len(data) // 2
+    data[middle:middle + 1] = b'x' if data[middle:middle + 1] != b'x' else b'y'
+    with open(edited_path, 'wb') as out:
+        out.write(data)
+    assert interpro_index.get_index_key(edited_path) != interpro_index.get_index_key(interpro_xmlpath)
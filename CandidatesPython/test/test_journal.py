@@ -0,0 +1,63 @@
+import os
+import shutil
+import candidates.journal as journal
+data_out = os.sep.join(['testdata', 'output'])
+
+
+def new_journal(name):
+    path = os.sep.join([data_out, name + '.jsonl'])
+    if os.path.isfile(path):
+        os.remove(path)
+    return journal.Journal(path)
+
+
+def test_journal_reload():
+    test_journal = new_journal('journal_reload')
+    test_journal.record('IPR000001', 12)
+    test_journal.record_failure('IPR000002', 'Timeout')
+    test_journal.record('IPR000003', ['a', 'b'])
+    test_journal.record_failure('IPR000003', 'Timeout')
+    test_journal.close()
+    # Simulate a run killed while writing a line
+    with open(test_journal.path, 'a') as f:
+        f.write('{"key": "IPR0000')
+    assert test_journal.completed == {'IPR000001': 12}
+    reloaded = journal.Journal(test_journal.path)
+    # The last line for each key wins
+    assert reloaded.completed == {'IPR000001': 12}
+    assert sorted(reloaded.failed) == ['IPR000002', 'IPR000003']
+
+
+def test_run_with_journal_resumes_and_retries():
+    test_journal = new_journal('journal_run')
+    test_journal.record('IPR000001', 1)
+    calls = []
+
+    def worker(item, thread_id):
+        calls.append(item)
+        # IPR000002 fails the first time only, IPR000003 always fails
+        if item == 'IPR000003' or calls.count(item) == 1 and item == 'IPR000002':
+            raise Exception('Failed to access ' + item)
+        return int(item[-1])
+
+    items = ['IPR000001', 'IPR000002', 'IPR000003', 'IPR000004']
+    results = journal.run_with_journal(worker, items, 2, test_journal)
+    test_journal.close()
+    assert results == {'IPR000001': 1, 'IPR000002': 2, 'IPR000004': 4}
+    assert 'IPR000001' not in calls
+    assert calls.count('IPR000003') == 2
+    reloaded = journal.Journal(test_journal.path)
+    assert reloaded.completed == results
+    assert list(reloaded.failed) == ['IPR000003']
+
+
+# The file is only created by the first write
+def test_journal_created_on_write():
+    journal_dir = os.sep.join([data_out, 'journal_lazy'])
+    shutil.rmtree(journal_dir, ignore_errors=True)
+    test_journal = journal.open_journal(journal_dir, 'stage3_reviewed')
+    test_journal.close()
+    assert not os.path.exists(journal_dir)
+    test_journal.record('IPR000001', 1)
+    test_journal.close()
+    assert journal.open_journal(journal_dir, 'stage3_reviewed').completed == {'IPR000001': 1}
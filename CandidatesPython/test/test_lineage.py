@@ -0,0 +1,17 @@
+import candidates.lineage as lineage
+
+
+def test_lineage_index():
+    index = lineage.LineageIndex()
+    human = index.add(['Eukaryota', 'Metazoa', 'Chordata', 'Mammalia'])
+    fly = index.add(['Eukaryota', 'Metazoa', 'Arthropoda'])
+    ecoli = index.add(('Bacteria', 'Proteobacteria'))
+    assert index.add(('Eukaryota', 'Metazoa', 'Chordata', 'Mammalia')) == human
+    assert index.depth(human) == 4
+    assert index.ancestor(human, 2) == index.ancestor(fly, 2)
+    assert index.labels[index.ancestor(human, 2)] == 'Eukaryota Metazoa'
+    assert index.labels[index.ancestor(human, 1)] == 'Eukaryota'
+    assert index.ancestor(ecoli, 3) == ecoli
+    assert index.lineages[human] == ('Eukaryota', 'Metazoa', 'Chordata', 'Mammalia')
+    assert index.labels[index.add([])] == ''
+    assert len(index) == 8
@@ -0,0 +1,71 @@
+import os
+import json
+import urllib.request
+import candidates.utils as utils
+import candidates.metrics as metrics
+import candidates.standin as standin
+import candidates.uniprot.count_candidate_hits as uniprotcounter
+data_in = os.sep.join(['testdata', 'input'])
+data_out = os.sep.join(['testdata', 'output'])
+
+
+def test_prometheus_text():
+    metrics.reset()
+    with metrics.stage('stage3'):
+        metrics.record_request(200, 0.07, 120)
+        metrics.record_request(200, 0.3, 80)
+        metrics.record_request(None)
+        metrics.record_retry('error')
+        metrics.record_retry('error')
+        metrics.record_retry('throttled')
+    metrics.queue_items.labels('reviewed "counts"').set(5)
+    text = metrics.to_prometheus()
+    assert '# TYPE candidates_requests_total counter' in text
+    assert 'candidates_requests_total{stage="stage3",status="200"} 2' in text
+    assert 'candidates_requests_total{stage="stage3",status="error"} 1' in text
+    assert 'candidates_request_duration_seconds_bucket{stage="stage3",le="0.05"} 0' in text
+    assert 'candidates_request_duration_seconds_bucket{stage="stage3",le="0.1"} 1' in text
+    assert 'candidates_request_duration_seconds_bucket{stage="stage3",le="+Inf"} 2' in text
+    assert 'candidates_request_duration_seconds_count{stage="stage3"} 2' in text
+    assert 'candidates_response_bytes_total{stage="stage3"} 200' in text
+    assert 'candidates_retries_total{stage="stage3",reason="error"} 2' in text
+    assert 'candidates_retries_total{stage="stage3",reason="throttled"} 1' in text
+    assert 'candidates_work_queue_items{work="reviewed \\"counts\\""} 5' in text
+    assert 'candidates_stage_duration_seconds{stage="stage3"}' in text
+
+
+def test_quantiles():
+    histogram = {'count': 100, 'sum': 0.0, 'buckets': [0, 50, 50] + [0] * 8}
+    assert metrics.estimate_quantile(histogram, metrics.latency_buckets, 0.5) == 0.1
+    assert abs(metrics.estimate_quantile(histogram, metrics.latency_buckets, 0.75) - 0.175) < 1e-9
+    assert metrics.estimate_quantile({'count': 0, 'sum': 0.0, 'buckets': []}, metrics.latency_buckets, 0.5) is None
+
+
+# Counts looked up from a stand-in are recorded, and summarised at the end
+def test_run_metrics():
+    prom_path = os.sep.join([data_out, 'metrics_test.prom'])
+    summary_path = os.sep.join([data_out, 'summary_test.json'])
+    server = standin.StandInServer(data_in).start()
+    original_url = utils.proteins_api_url
+    utils.proteins_api_url = server.url
+    reporter = metrics.start_reporting(prom_path, interval=60, port=0)
+    try:
+        with metrics.stage('stage3'):
+            uniprotcounter.collect_counts(os.sep.join([data_in, 'stable_candidates_list.list']), 10, 100,
+                                          os.sep.join([data_out, 'CandidateHitCounts_metrics.tsv']))
+        served = urllib.request.urlopen('http://127.0.0.1:{0}/metrics'.format(reporter.server.server_port)).read()
+    finally:
+        utils.proteins_api_url = original_url
+        metrics.stop_reporting()
+        server.stop()
+    assert b'candidates_requests_total{stage="stage3",status="200"}' in served
+    assert 'candidates_items_total{work="reviewed counts",result="done"}' in open(prom_path).read()
+    metrics.write_summary(summary_path, {'run_type': 'test'})
+    summary = json.load(open(summary_path))
+    assert summary['run_type'] == 'test'
+    assert summary['requests'] == server.requests
+    assert summary['requests_by_status'] == {'200': server.requests}
+    assert summary['latency_seconds_by_stage']['stage3']['count'] == server.requests
+    assert summary['stages_seconds']['stage3'] > 0
+    assert summary['items']['reviewed counts done'] > 0
+    assert 'candidates_requests_total' in summary['metrics']
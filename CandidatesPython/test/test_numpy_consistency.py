@@ -0,0 +1,54 @@
+import json
+import random
+import pytest
+import candidates.uniprot.collect_candidates as collector
+import candidates.uniprot.numpy_consistency as numpy_consistency
+
+pytest.importorskip('numpy')
+
+data_in = 'testdata/input/'
+
+
+def test_numpy_engine_matches_python():
+    with open(data_in + 'IPR038987.json') as f:
+        json_data = json.load(f)
+    taxonomy_groups = collector.group_records_by_taxonomy_from_json(json_data)
+    assert numpy_consistency.analyse_taxonomy_groups(taxonomy_groups) == \
+        collector.analyse_taxonomy_groups(taxonomy_groups)
+
+
+# Records numbered as they are read, or again when loaded from a record store, grouped at several depths
+def test_numpy_engine_with_numbered_terms():
+    with open(data_in + 'IPR038987.json') as f:
+        json_data = json.load(f)
+    terms = {}
+    records = collector.extract_records(json_data, terms=terms)
+    assert all(len(record.term_ids) > 0 for record in records)
+    taxonomy_groups = collector.group_records_by_taxonomy(records, (1, 2))
+    expected = collector.analyse_taxonomy_groups(taxonomy_groups)
+    assert numpy_consistency.analyse_taxonomy_groups(taxonomy_groups, None, terms) == expected
+    loaded_terms = {}
+    loaded = [collector.AnnotationRecord.from_list(record.to_list(), {}, None, loaded_terms) for record in records]
+    taxonomy_groups = collector.group_records_by_taxonomy(loaded, (1, 2))
+    assert numpy_consistency.analyse_taxonomy_groups(taxonomy_groups, None, loaded_terms) == expected
+
+
+def test_numpy_engine_matches_python_random_records():
+    rng = random.Random(1)
+    lineages = [['Bacteria', 'Proteobacteria'], ['Eukaryota', 'Metazoa'], ['Archaea', 'Euryarchaeota']]
+    records = []
+    for i in range(300):
+        keywords = [rng.choice(['Membrane', 'Repeat', 'Signal', '']) for k in range(rng.randint(0, 4))]
+        annotations = {'DERF': rng.choice(['Protein A', 'Protein B']),
+                       'SPKW': tuple(keywords),
+                       'CCLO': tuple(rng.sample(['Cytoplasm', 'Nucleus', 'Secreted'], rng.randint(0, 3)))}
+        if rng.random() < 0.95:
+            annotations['CCSI'] = ('Belongs to the A family',)
+        lineage_node = collector.lineage_index.add(rng.choice(lineages))
+        records.append(collector.AnnotationRecord('X{0:05d}'.format(i), lineage_node, annotations))
+    taxonomy_groups = {}
+    for record in records:
+        taxonomy_groups.setdefault(' '.join(record['SPOC'][:2]), []).append(record)
+    assert numpy_consistency.analyse_taxonomy_groups(taxonomy_groups) == \
+        collector.analyse_taxonomy_groups(taxonomy_groups)
+    assert numpy_consistency.analyse_taxonomy_groups({}) == []
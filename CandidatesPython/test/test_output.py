@@ -0,0 +1,86 @@
+import os
+import pytest
+import candidates.output as output
+data_out = os.sep.join(['testdata', 'output'])
+
+
+def new_writer(name):
+    path = os.sep.join([data_out, name])
+    for p in (path, path + '.partial', path + '.index'):
+        if os.path.isfile(p):
+            os.remove(p)
+    return output.CandidateWriter(path)
+
+
+def test_writer_sorts_blocks_and_resumes():
+    writer = new_writer('candidates_writer.tsv')
+    writer.write('IPR000003\t12\t300', ['Bacteria Firmicutes\tSPKW\t12\t12\tRepeat'])
+    writer.write('IPR000001\t15\t100', [])
+    writer.close()
+    # Blocks can be read from the partial file during the run
+    with open(writer.partial_path) as f:
+        assert f.read().startswith('\n# IPR000003  Reviewed:  12  Unreviewed:  300\n')
+    # Simulate a run killed while writing a block and its index line
+    with open(writer.partial_path, 'a') as f:
+        f.write('\n# IPR000002  Rev')
+    with open(writer.index_path, 'a') as f:
+        f.write('IPR000002\t10')
+
+    writer = output.CandidateWriter(writer.outfile_path)
+    assert sorted(writer.blocks) == ['IPR000001', 'IPR000003']
+    writer.write('IPR000002\t10\t200', ['Eukaryota Metazoa\tCCLO\t10\t9\tSecreted'])
+    writer.write('IPR000001\t16\t100', ['Eukaryota Fungi\tCCLO\t16\t16\tNucleus'])
+    writer.finish()
+    assert not os.path.isfile(writer.partial_path)
+    with open(writer.outfile_path) as f:
+        written = f.read()
+    assert written == output.column_header + \
+        '\n# IPR000001  Reviewed:  16  Unreviewed:  100\nEukaryota Fungi\tCCLO\t16\t16\tNucleus\n' + \
+        '\n# IPR000002  Reviewed:  10  Unreviewed:  200\nEukaryota Metazoa\tCCLO\t10\t9\tSecreted\n' + \
+        '\n# IPR000003  Reviewed:  12  Unreviewed:  300\nBacteria Firmicutes\tSPKW\t12\t12\tRepeat\n'
+
+
+def write_results(name):
+    candidates_path = os.sep.join([data_out, name + '.tsv'])
+    counts_path = os.sep.join([data_out, name + '_counts.tsv'])
+    with open(candidates_path, 'w') as f:
+        f.write(output.column_header)
+        f.write('\n# IPR000001  Reviewed:  16  Unreviewed:  100\n\n')
+        f.write('\n# IPR000002  Reviewed:  10  Unreviewed:  200\nEukaryota Metazoa\tCCLO\t10\t9\tSecreted\n'
+                'Eukaryota Metazoa\tSPKW\t10\t10\tSignal\n')
+    with open(counts_path, 'w') as f:
+        f.write('IPR000001\t15\t100\nIPR000002\t10\t200\n')
+    return candidates_path, counts_path
+
+
+def test_read_candidates():
+    candidates_path, counts_path = write_results('export_read')
+    assert list(output.read_candidates(candidates_path)) == [
+        ('IPR000001', 16, 100, []),
+        ('IPR000002', 10, 200, [['Eukaryota Metazoa', 'CCLO', 10, 9, 'Secreted'],
+                                ['Eukaryota Metazoa', 'SPKW', 10, 10, 'Signal']])]
+
+
+def test_export_sqlite():
+    import sqlite3
+    candidates_path, counts_path = write_results('export_sqlite')
+    output.export_results(candidates_path, counts_path, ['sqlite'])
+    connection = sqlite3.connect(os.sep.join([data_out, 'export_sqlite.sqlite']))
+    assert connection.execute('SELECT * FROM filtered_counts ORDER BY interpro').fetchall() == \
+        [('IPR000001', 15, 100), ('IPR000002', 10, 200)]
+    assert connection.execute('SELECT reviewed FROM candidates WHERE interpro = ?', ('IPR000001',)).fetchall() == \
+        [(16,)]
+    assert connection.execute("SELECT interpro, consistent FROM annotations WHERE code = 'CCLO'").fetchall() == \
+        [('IPR000002', 9)]
+    connection.close()
+
+
+def test_export_parquet():
+    parquet = pytest.importorskip('pyarrow.parquet')
+    candidates_path, counts_path = write_results('export_parquet')
+    output.export_results(candidates_path, counts_path, ['parquet'])
+    table = parquet.read_table(os.sep.join([data_out, 'export_parquet.parquet']))
+    assert table.column('annotation').to_pylist() == ['Secreted', 'Signal']
+    assert table.column('reviewed').to_pylist() == [10, 10]
+    counts = parquet.read_table(os.sep.join([data_out, 'export_parquet_filtered_counts.parquet']))
+    assert counts.column('unreviewed').to_pylist() == [100, 200]
@@ -0,0 +1,66 @@
+import os
+import candidates.utils as utils
+import candidates.metrics as metrics
+import candidates.profiling as profiling
+import candidates.standin as standin
+import candidates.uniprot.collect_candidates as collector
+data_in = os.sep.join(['testdata', 'input'])
+data_out = os.sep.join(['testdata', 'output'])
+
+
+def test_function_times():
+    stacks = {('a:main', 'b:fetch', 'socket:recv'): 6,
+              ('a:main', 'c:parse'): 3,
+              ('a:main', 'c:parse', 'c:parse'): 1}
+    times = profiling.get_function_times(stacks, 0.5)
+    assert times['a:main'] == (0, 5)
+    assert times['socket:recv'] == (3, 3)
+    assert times['c:parse'] == (2, 2)
+    folded_path = os.sep.join([data_out, 'profile_test.folded'])
+    profiling.write_folded(stacks, folded_path)
+    assert open(folded_path).read().splitlines() == ['a:main;b:fetch;socket:recv 6', 'a:main;c:parse 3',
+                                                     'a:main;c:parse;c:parse 1']
+
+
+# Stage 4 collects one signature from a stand-in and analyses it in a process, both of which are sampled
+def test_profile_stage4():
+    prefix = os.sep.join([data_out, 'profile_stage4'])
+    infile_path = os.sep.join([data_out, 'profile_candidates.tsv'])
+    outfile = open(infile_path, 'w')
+    outfile.write('IPR038987\t28\t510\n')
+    outfile.close()
+    server = standin.StandInServer(data_in, latency=0.1).start()
+    original_url = utils.proteins_api_url
+    utils.proteins_api_url = server.url
+    profiling.start(prefix, interval=0.002)
+    assert profiling.get_interval() == 0.002
+    try:
+        with metrics.stage('stage4'):
+            collector.collect_candidates_with_threads(infile_path, os.sep.join([data_out, 'profile_rules.tsv']),
+                                                      processes=1)
+    finally:
+        profiling.stop()
+        utils.proteins_api_url = original_url
+        server.stop()
+    assert profiling.get_interval() == profiling.settings['interval']
+    folded = open(prefix + '_stage4.folded').read()
+    assert 'candidates.uniprot.collect_candidates:collect_candidate' in folded
+    functions = open(prefix + '_stage4_functions.tsv').read().splitlines()
+    assert functions[0] == 'function\tself_seconds\tcumulative_seconds'
+    assert any(line.startswith('candidates.utils:get_url_with_retry\t') or
+               line.startswith('candidates.utils:stream_url_with_retry\t') for line in functions)
+    signatures = open(prefix + '_signatures.tsv').read().splitlines()
+    assert signatures[1].startswith('IPR038987\t')
+    assert signatures[1].split('\t')[2] == '28'
+    assert float(signatures[1].split('\t')[1]) >= 0.1
+
+
+# As in an analysis process, only the thread running the function is sampled, and only while it runs
+def test_run_profiled():
+    record = {atype: () for atype in collector.consistency_list_types}
+    record.update({'DERF': 'a', 'GNNM': '', 'SPKW': ('b', 'c')})
+    records = [record] * 100000
+    result, stacks = profiling.run_profiled(0.001, collector.count_annotations, records)
+    assert result['record_count'] == 100000
+    assert any(stack[-1] == 'candidates.uniprot.collect_candidates:count_annotations'
+               for counts in stacks.values() for stack in counts)
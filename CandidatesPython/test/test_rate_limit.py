@@ -0,0 +1,197 @@
+import threading
+import time
+from http.server import HTTPServer, BaseHTTPRequestHandler
+import candidates.utils as utils
+import candidates.rate_limit as rate_limit
+
+
+def new_limiter(initial_limit=4, rate=1000.0, burst=1000):
+    return rate_limit.RateLimiter(rate, burst, initial_limit, min_limit=1, max_limit=8, latency_factor=4.0,
+                                  cooldown=60.0)
+
+
+def test_limit_increase_and_decrease():
+    limiter = new_limiter()
+    # One more for each full set of responses
+    for i in range(5):
+        limiter.record(200, 0.1)
+    assert int(limiter.limit) == 5
+    limiter.record(429)
+    decreased = limiter.limit
+    assert decreased < 3
+    # Only one decrease in a cool-down
+    limiter.record(503)
+    assert limiter.limit == decreased
+    for i in range(100):
+        limiter.record(200, 0.1)
+    assert limiter.limit == 8
+
+
+def test_latency_decrease():
+    limiter = new_limiter()
+    limiter.record(200, 0.1)
+    for i in range(30):
+        limiter.record(200, 2.0)
+    assert limiter.limit < 4
+
+
+# Latencies are compared within a kind of request, and a failure with no response counts as overload
+def test_latency_by_kind():
+    limiter = new_limiter()
+    limiter.record(200, 0.1, kind='1')
+    for i in range(30):
+        limiter.record(200, 2.0, kind='-1')
+    increased = limiter.limit
+    assert increased > 4
+    assert rate_limit.get_request_kind('http://host/proteins/InterPro:IPR000001?offset=0&size=-1') == '-1'
+    limiter.record(None, kind='1')
+    assert limiter.limit == increased / 2
+
+
+def test_retry_after_pauses():
+    limiter = new_limiter()
+    limiter.record(429, 0.1, 0.3)
+    start = time.monotonic()
+    limiter.acquire()
+    limiter.release()
+    assert time.monotonic() - start >= 0.25
+    assert rate_limit.get_retry_after({'Retry-After': '12'}) == 12
+    assert rate_limit.get_retry_after({'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'}) == 0
+    assert rate_limit.get_retry_after({}) is None
+
+
+def test_requests_in_flight_limited():
+    limiter = new_limiter(initial_limit=3)
+    in_flight = {'now': 0, 'most': 0}
+    lock = threading.Lock()
+
+    def request():
+        limiter.acquire()
+        with lock:
+            in_flight['now'] += 1
+            in_flight['most'] = max(in_flight['most'], in_flight['now'])
+        time.sleep(0.02)
+        with lock:
+            in_flight['now'] -= 1
+        limiter.release()
+
+    threads = [threading.Thread(target=request) for i in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert in_flight['most'] == 3
+
+
+def test_token_bucket_rate():
+    limiter = new_limiter(initial_limit=8, rate=50.0, burst=1)
+    start = time.monotonic()
+    for i in range(6):
+        limiter.acquire()
+        limiter.release()
+    assert time.monotonic() - start >= 0.09
+
+
+class ThrottlingHandler(BaseHTTPRequestHandler):
+    refusals = 2
+
+    def do_GET(self):
+        if ThrottlingHandler.refusals > 0:
+            ThrottlingHandler.refusals -= 1
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            body = b''
+        else:
+            self.send_response(200)
+            body = b'[]'
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_limited_get_retries_throttled():
+    server = HTTPServer(('127.0.0.1', 0), ThrottlingHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    saved = dict(rate_limit.settings)
+    rate_limit.configure(backoff_base=0.01, cooldown=0.0)
+    try:
+        url = 'http://127.0.0.1:{0}/proteins'.format(server.server_port)
+        r = utils.get_url_with_retry(url, {'Accept': 'application/json'})
+        limiter = rate_limit.get_limiter()
+        assert r.text == '[]'
+        assert limiter.limit < rate_limit.settings['initial_limit']
+        assert limiter.in_flight == 0
+    finally:
+        rate_limit.configure(**saved)
+        server.shutdown()
+        server.server_close()
+
+
+class FailingHandler(BaseHTTPRequestHandler):
+    failures = 2
+
+    def do_GET(self):
+        if FailingHandler.failures > 0:
+            FailingHandler.failures -= 1
+            self.send_response(502)
+            body = b''
+        else:
+            self.send_response(200)
+            body = b'[]'
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# Server errors are tried again through the limiter, which sees each of them as overload
+def test_limited_get_retries_errors():
+    import candidates.session as session
+    server = HTTPServer(('127.0.0.1', 0), FailingHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    saved = dict(rate_limit.settings)
+    saved_backoff = session.settings['backoff_factor']
+    rate_limit.configure(cooldown=0.0)
+    session.configure(backoff_factor=0.01)
+    try:
+        url = 'http://127.0.0.1:{0}/proteins'.format(server.server_port)
+        r = utils.get_url_with_retry(url, {'Accept': 'application/json'})
+        limiter = rate_limit.get_limiter()
+        assert r.text == '[]'
+        assert limiter.limit < rate_limit.settings['initial_limit'] / 2
+        assert limiter.in_flight == 0
+    finally:
+        rate_limit.configure(**saved)
+        session.configure(backoff_factor=saved_backoff)
+        server.shutdown()
+        server.server_close()
+
+
+# A streamed response gives back its slot when its headers arrive, and is closed when the records stop being read
+def test_stream_releases_slot():
+    import candidates.metrics as metrics
+    import candidates.standin as standin
+    server = standin.StandInServer('testdata/input').start()
+    saved = dict(rate_limit.settings)
+    rate_limit.configure(initial_limit=1, min_limit=1)
+    try:
+        url = '{0}/InterPro:IPR038987?offset=0&size=-1&reviewed=true'.format(server.url)
+        items = utils.stream_json_array(url, {'Accept': 'application/json'})
+        assert next(items)['accession']
+        limiter = rate_limit.get_limiter()
+        assert limiter.in_flight == 0
+        assert metrics.total(metrics.responses_streaming) == 1
+        # The one slot is free for another request while the first body is still open
+        assert utils.get_url_with_retry(url, {'Accept': 'application/json'}).ok
+        items.close()
+        assert metrics.total(metrics.responses_streaming) == 0
+    finally:
+        rate_limit.configure(**saved)
+        server.stop()
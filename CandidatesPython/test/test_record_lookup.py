@@ -1,15 +1,83 @@
+import json
 import time
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
 from unittest.mock import Mock
 
+import candidates.utils as utils
+import candidates.standin as standin
 import candidates.uniprot.collect_candidates as collector
 
 
-# Mock ?
+# Looked up from the stand-in for the Proteins API serving testdata/input
 def test_get_reviewed_jsonrecords_for_signature():
-    json_records = collector.get_reviewed_uniprot_jsons_from_interpro_id('IPR038987')
+    server = standin.StandInServer('testdata/input').start()
+    original_url = utils.proteins_api_url
+    utils.proteins_api_url = server.url
+    try:
+        json_records = collector.get_reviewed_uniprot_jsons_from_interpro_id('IPR038987')
+    finally:
+        utils.proteins_api_url = original_url
+        server.stop()
     assert len(json_records) == 28
 
 
+all_records = json.load(open('testdata/input/IPR038987.json'))
+
+
+# Serves the records in testdata/input/IPR038987.json a page at a time as the Proteins API does
+class PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        offset, size = int(query['offset'][0]), int(query['size'][0])
+        records = all_records[offset:] if size == -1 else all_records[offset:offset + size]
+        body = json.dumps(records).encode('utf-8')
+        self.send_response(200)
+        self.send_header('x-pagination-totalrecords', str(len(all_records)))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class PageServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def fetch_from_page_server(total):
+    server = PageServer(('127.0.0.1', 0), PageHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    original_url, original_page_size = utils.proteins_api_url, collector.page_size
+    utils.proteins_api_url = 'http://127.0.0.1:{0}/proteins/api/proteins'.format(server.server_port)
+    collector.page_size = 5
+    try:
+        return list(collector.iter_reviewed_uniprot_jsons_from_interpro_id('IPR038987', total=total))
+    finally:
+        utils.proteins_api_url, collector.page_size = original_url, original_page_size
+        collector.close_page_executor()
+        server.shutdown()
+        server.server_close()
+
+
+def test_paged_records_match_single_request():
+    assert fetch_from_page_server(len(all_records)) == all_records
+    assert fetch_from_page_server(None) == all_records
+
+
+def test_paged_records_changed_total():
+    failed = False
+    try:
+        fetch_from_page_server(len(all_records) - 3)
+    except collector.PagesChanged:
+        failed = True
+    assert failed
+
+
 def test_get_uniprot_url_with_retry():
     requests = Mock()
     tries = 1
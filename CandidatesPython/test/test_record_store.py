@@ -0,0 +1,126 @@
+import os
+import json
+import shutil
+import candidates.incremental as incremental
+import candidates.journal as journal
+import candidates.record_store as record_store
+import candidates.uniprot.collect_candidates as collector
+import candidates.uniprot.count_candidate_hits as uniprotcounter
+data_in = os.sep.join(['testdata', 'input'])
+data_out = os.sep.join(['testdata', 'output'])
+
+
+def new_dir(name):
+    path = os.sep.join([data_out, name])
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    return path
+
+
+def test_record_store_last_line_wins():
+    store = record_store.open_record_store(new_dir('record_store'))
+    store.write('IPR000001', [1])
+    store.write('IPR000002', [2])
+    store.write('IPR000001', [3])
+    store.close()
+    # Simulate a run killed while writing a line
+    with open(store.path, 'a') as f:
+        f.write('IPR000002\t[4')
+    store = record_store.RecordStore(store.path)
+    store.write('IPR000003', [5])
+    store.close()
+    assert list(record_store.read_record_store(store.path)) == [('IPR000002', [2]), ('IPR000001', [3]),
+                                                                ('IPR000003', [5])]
+    assert list(record_store.read_record_store(store.path, ['IPR000003'])) == [('IPR000003', [5])]
+
+
+def test_reanalyse_saved_records():
+    with open(os.sep.join([data_in, 'IPR038987.json'])) as f:
+        json_data = json.load(f)
+    records = collector.extract_records(json_data)
+    journal_dir = new_dir('reanalyse')
+    store = record_store.open_record_store(journal_dir)
+    store.write('IPR038987', [record.to_list() for record in records])
+    store.close()
+    infile_path = os.sep.join([journal_dir, 'filtered.tsv'])
+    with open(infile_path, 'w') as f:
+        f.write('IPR038987\t28\t500\nIPR000001\t12\t300\n')
+
+    for cutoff in (0.9, 0.5):
+        outfile_path = os.sep.join([journal_dir, 'candidates_{0}.tsv'.format(cutoff)])
+        collector.reanalyse_candidates(infile_path, outfile_path, store.path, {'cutoff': cutoff})
+        lines = collector.analyse_taxonomy_groups(collector.group_records_by_taxonomy(records),
+                                                  {'engine': 'python', 'cutoff': cutoff})
+        with open(outfile_path) as f:
+            assert f.read().split('\n')[2:-1] == ['# IPR038987  Reviewed:  28  Unreviewed:  500'] + lines
+
+
+def test_filter_saved_counts():
+    journal_dir = new_dir('saved_counts')
+    reviewed = journal.open_journal(journal_dir, 'stage3_reviewed')
+    unreviewed = journal.open_journal(journal_dir, 'stage3_unreviewed')
+    for ipr, rev, unrev in [('IPR000001', 5, None), ('IPR000002', 12, 50), ('IPR000003', 40, 2000),
+                            ('IPR000004', 10, 100)]:
+        reviewed.record(ipr, rev)
+        if unrev is not None:
+            unreviewed.record(ipr, unrev)
+    reviewed.close()
+    unreviewed.close()
+    list_path = os.sep.join([journal_dir, 'prelim.list'])
+    with open(list_path, 'w') as f:
+        f.write('IPR000001\nIPR000002\nIPR000003\nIPR000004')
+    outfile_path = os.sep.join([journal_dir, 'filtered.tsv'])
+
+    uniprotcounter.filter_saved_counts(list_path, 10, 100, outfile_path, journal_dir)
+    assert open(outfile_path).read() == 'IPR000003\t40\t2000\nIPR000004\t10\t100\n'
+    uniprotcounter.filter_saved_counts(list_path, 1, 50, outfile_path, journal_dir)
+    assert open(outfile_path).read() == 'IPR000002\t12\t50\nIPR000003\t40\t2000\nIPR000004\t10\t100\n'
+
+
+def test_find_unchanged_signatures():
+    previous_dir = new_dir('incremental_previous')
+    store = record_store.open_record_store(previous_dir)
+    for ipr in ('IPR000001', 'IPR000002', 'IPR000003'):
+        store.write(ipr, [])
+    store.close()
+    previous_filtered_path = os.sep.join([previous_dir, 'filtered.tsv'])
+    with open(previous_filtered_path, 'w') as f:
+        f.write('IPR000001\t12\t300\nIPR000002\t20\t300\nIPR000003\t30\t300\nIPR000004\t40\t300\n')
+    previous_member_path = os.sep.join([previous_dir, 'members.tsv'])
+    with open(previous_member_path, 'w') as f:
+        f.write('IPR000001\tPF00001\nIPR000002\tPF00002\nIPR000003\tPF00003\nIPR000004\tPF00004\n')
+    filtered_path = os.sep.join([previous_dir, 'filtered_new.tsv'])
+    with open(filtered_path, 'w') as f:
+        f.write('IPR000001\t12\t400\nIPR000002\t21\t300\nIPR000003\t30\t300\nIPR000004\t40\t300\n'
+                'IPR000005\t50\t300\n')
+    member_map = {'IPR000001': {'PF00001'}, 'IPR000002': {'PF00002'}, 'IPR000003': {'PF00003', 'PS00003'},
+                  'IPR000004': {'PF00004'}, 'IPR000005': {'PF00005'}}
+
+    # Changed reviewed count, changed members, no saved records and new
+    assert incremental.find_unchanged_signatures(filtered_path, member_map, previous_filtered_path,
+                                                 previous_member_path, store.path) == {'IPR000001'}
+
+
+def test_carry_forward_records():
+    with open(os.sep.join([data_in, 'IPR038987.json'])) as f:
+        json_data = json.load(f)
+    records = collector.extract_records(json_data)
+    previous_dir = new_dir('carry_forward_previous')
+    store = record_store.open_record_store(previous_dir)
+    store.write('IPR038987', [record.to_list() for record in records])
+    store.close()
+    journal_dir = new_dir('carry_forward')
+    infile_path = os.sep.join([journal_dir, 'filtered.tsv'])
+    with open(infile_path, 'w') as f:
+        f.write('IPR038987\t28\t600\n')
+    outfile_path = os.sep.join([journal_dir, 'candidates.tsv'])
+
+    collector.collect_candidates_with_threads(infile_path, outfile_path, journal_dir, 0,
+                                              carry_forward=(store.path, {'IPR038987'}))
+    lines = collector.analyse_taxonomy_groups(collector.group_records_by_taxonomy(records))
+    with open(outfile_path) as f:
+        assert f.read().split('\n')[2:-1] == ['# IPR038987  Reviewed:  28  Unreviewed:  600'] + lines
+    # The records carried forward are saved again for the next run
+    assert [key for key, saved in record_store.read_record_store(
+                record_store.get_record_store_path(journal_dir))] == ['IPR038987']
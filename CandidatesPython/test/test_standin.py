@@ -0,0 +1,93 @@
+import os
+import json
+import threading
+import candidates.utils as utils
+import candidates.rate_limit as rate_limit
+import candidates.standin as standin
+import candidates.uniprot.collect_candidates as collector
+import candidates.uniprot.count_candidate_hits as uniprotcounter
+data_in = os.sep.join(['testdata', 'input'])
+data_out = os.sep.join(['testdata', 'output'])
+
+
+# Runs lookup() with the Proteins API address pointing at a stand-in serving testdata/input
+def with_standin(lookup, **behaviour):
+    server = standin.StandInServer(data_in, **behaviour).start()
+    original_url = utils.proteins_api_url
+    utils.proteins_api_url = server.url
+    try:
+        return lookup(), server.requests
+    finally:
+        utils.proteins_api_url = original_url
+        collector.close_page_executor()
+        server.stop()
+
+
+def test_offline_hit_counts():
+    input_filepath = os.sep.join([data_in, 'stable_candidates_list.list'])
+    test_outfilepath = os.sep.join([data_out, 'CandidateHitCounts_standin.tsv'])
+    with_standin(lambda: uniprotcounter.collect_counts(input_filepath, 10, 100, test_outfilepath))
+    assert open(test_outfilepath).read() == 'IPR000207\t17\t544\nIPR000211\t12\t1513\nIPR000247\t29\t1177\n' \
+                                            'IPR001577\t15\t4437\n'
+
+
+def test_records_from_standin():
+    single, requests = with_standin(lambda: collector.get_reviewed_uniprot_jsons_from_interpro_id('IPR038987'))
+    original_page_size = collector.page_size
+    collector.page_size = 5
+    try:
+        paged, requests = with_standin(lambda: list(collector.iter_reviewed_uniprot_jsons_from_interpro_id(
+                                                                                        'IPR038987', total=28)))
+    finally:
+        collector.page_size = original_page_size
+    assert len(single) == 28
+    assert paged == single
+    assert requests == 6
+    unknown, requests = with_standin(lambda: collector.get_reviewed_uniprot_jsons_from_interpro_id('IPR999999'))
+    assert unknown == []
+
+
+# The raw responses handed to the analysis processes, in one request or in pages, hold the same records
+def test_bodies_from_standin():
+    single, requests = with_standin(lambda: collector.get_reviewed_uniprot_jsons_from_interpro_id('IPR038987'))
+    bodies, requests = with_standin(lambda: collector.get_reviewed_uniprot_bodies('IPR038987'))
+    assert len(bodies) == 1
+    assert json.loads(bodies[0]) == single
+    original_page_size = collector.page_size
+    collector.page_size = 5
+    try:
+        pages, requests = with_standin(lambda: collector.get_reviewed_uniprot_bodies('IPR038987', total=28))
+    finally:
+        collector.page_size = original_page_size
+    assert len(pages) == 6
+    assert [record for page in pages for record in json.loads(page)] == single
+
+
+def test_standin_throttling():
+    saved = dict(rate_limit.settings)
+    rate_limit.configure(backoff_base=0.05)
+    results = []
+
+    def lookups():
+        threads = [threading.Thread(target=lambda: results.append(uniprotcounter.get_count('IPR000247', False)))
+                   for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    try:
+        result, requests = with_standin(lookups, throttle_rate=10, retry_after=0)
+    finally:
+        rate_limit.configure(**saved)
+    assert results == [1177] * 20
+    # Some of the requests were refused and tried again
+    assert requests > 20
+
+
+def test_standin_errors():
+    server = standin.StandInServer(data_in, error_rate=0.5, seed=1)
+    statuses = [server.choose_status() for i in range(200)]
+    server.server_close()
+    assert 60 < statuses.count(500) < 140
+    assert statuses.count(500) + statuses.count(200) == 200
@@ -1,4 +1,11 @@
+import os
+import json
+import io
+import time
+import threading
 import candidates.utils as utils
+import candidates.session as session
+data_out = os.sep.join(['testdata', 'output'])
 
 
 def test_calculate_thread_count():
@@ -7,19 +14,6 @@ def test_calculate_thread_count():
     assert results == [1, 1, 1, 2, 4, 16, 24, 40, 50]
 
 
-def test_calculate_split_positions():
-    list_length = 32
-    threads = 4
-    results = utils.calculate_split_positions(list_length, threads)
-    assert results == [(1, 0, 8), (2, 8, 16), (3, 16, 24), (4, 24, 32)]
-
-
-def test_calculate_split_positions2():
-    list_length = 14368
-    threads = utils.calculate_thread_count(list_length)
-    results = utils.calculate_split_positions(list_length, threads)
-    assert results[-2:] == [(49, 13824, 14112), (50, 14112, 14368)]
-
 # This should be mocked really
 def test_get_url_with_retry_success():
     success = False
@@ -42,3 +36,91 @@ def test_get_url_with_retry_failure():
     except:
         failed = True
     assert failed
+
+
+def test_session_reused_within_thread():
+    first = session.get_session()
+    assert session.get_session() is first
+    other = []
+    thread = threading.Thread(target=lambda: other.append(session.get_session()))
+    thread.start()
+    thread.join()
+    assert other[0] is not first
+    adapter = first.get_adapter('https://www.ebi.ac.uk')
+    # Retries are made through the shared rate limiter by utils.limited_get
+    assert adapter.max_retries.total == 0
+    session.close_sessions()
+
+
+def test_run_work_queue():
+    thread_ids = set()
+
+    def square(n, thread_id):
+        thread_ids.add(thread_id)
+        time.sleep(0.01 * (n % 3))
+        return n * n
+
+    items = list(range(30))
+    futures = utils.run_work_queue(square, items, 4)
+    assert [f.result() for f in futures] == [n * n for n in items]
+    assert thread_ids <= {1, 2, 3, 4}
+    assert len(thread_ids) > 1
+
+
+def test_run_work_queue_failure():
+    def fail_on_three(n, thread_id):
+        if n == 3:
+            raise ValueError('bad item')
+        return n
+
+    futures = utils.run_work_queue(fail_on_three, [1, 2, 3, 4], 2)
+    assert futures[3].result() == 4
+    assert isinstance(futures[2].exception(), ValueError)
+
+
+def test_background_reader():
+    data = bytes(range(256)) * 1000
+    reader = utils.BackgroundReader(io.BytesIO(data), chunk_size=1000, queue_size=2)
+    parts = []
+    part = reader.read(300)
+    while part:
+        parts.append(part)
+        part = reader.read(300)
+    reader.close()
+    assert b''.join(parts) == data
+    reader = utils.BackgroundReader(io.BytesIO(data), chunk_size=1000, queue_size=2)
+    assert reader.read(10) == data[:10]
+    assert reader.read() == data[10:]
+    reader.close()
+    # Closing before the end of the file stops the background thread
+    reader = utils.BackgroundReader(io.BytesIO(data), chunk_size=10, queue_size=1)
+    reader.read(5)
+    reader.close()
+    assert not reader._thread.is_alive()
+
+
+def test_iter_json_array():
+    with open('testdata/input/IPR038987.json', 'rb') as f:
+        data = f.read()
+    expected = json.loads(data.decode('utf-8'))
+    for chunk_size in (1, 1000, len(data)):
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        assert list(utils.iter_json_array(chunks)) == expected
+    assert list(utils.iter_json_array([b' [', b' ] '])) == []
+    failed = False
+    try:
+        list(utils.iter_json_array([b'[{"accession": "P12345"},']))
+    except ValueError:
+        failed = True
+    assert failed
+
+
+def test_find_input_file_newest():
+    filepath = os.sep.join([data_out, 'find_input.xml'])
+    for path, mtime in ((filepath, 1000), (filepath + '.gz', 2000)):
+        open(path, 'w').close()
+        os.utime(path, (mtime, mtime))
+    assert utils.find_input_file(filepath) == filepath + '.gz'
+    os.utime(filepath, (3000, 3000))
+    assert utils.find_input_file(filepath) == filepath
+    assert utils.find_input_file(filepath + '.missing') is None